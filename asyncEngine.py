@@ -0,0 +1,315 @@
+# encoding: UTF-8
+
+'''
+基于asyncio的事件驱动引擎，接口与eventEngine.EventEngine相同（register/unregister/put，
+以及带主题事件的路由和hasSubscribers）。
+
+事件处理、计时器以及各接口的定时查询都作为任务运行在同一个事件循环中，
+不再为每一项工作单独开一个线程轮询；停止时直接取消任务，不必等待1秒超时。
+'''
+
+# 系统模块
+import asyncio
+from collections import deque
+from threading import Thread, get_ident
+import traceback
+
+# 自己开发的模块
+from eventType import *
+from eventEngine import Event, topicType
+
+
+########################################################################
+class AsyncEventEngine(object):
+    """
+    asyncio事件驱动引擎
+
+    变量说明
+    __loop：私有变量，事件循环
+    __queue：私有变量，事件队列（asyncio.Queue，只在事件循环线程中访问）
+    __tasks：私有变量，运行中的任务（事件处理、计时器、定时查询）
+    __handlers：私有变量，事件处理函数字典
+
+    方法说明
+    start：公共方法，启动引擎（未指定事件循环时在单独的线程中运行一个）
+    stop：公共方法，停止引擎，取消所有任务
+    register：公共方法，向引擎中注册监听函数
+    unregister：公共方法，向引擎中注销监听函数
+    put：公共方法，向事件队列中存入新的事件，可以在任意线程中调用，没有监听的事件直接丢弃；
+         start之前存入的事件在启动后处理，stop之后存入的事件丢弃
+    hasSubscribers：公共方法，查看事件类型（及主题）是否有处理函数监听
+    every：公共方法，在事件循环中定时调用函数
+    repeat：公共方法，在事件循环中反复调用函数，间隔由函数的返回值决定
+    call：公共方法，在事件循环中调用函数，可以在任意线程中调用
+    """
+
+    #----------------------------------------------------------------------
+    def __init__(self, loop=None, timer=1.0):
+        """
+        初始化事件引擎
+        loop：使用的事件循环，None时start()会新建事件循环并在单独的线程中运行
+        timer：计时器事件的间隔（秒），0为不启动计时器
+        """
+        self.__loop = loop
+        self.__ownLoop = loop is None
+        self.__thread = None
+        self.__loopThread = None            # 事件循环所在线程的标识
+        self.__queue = None
+        self.__early = deque()              # start之前存入的事件
+        self.__timer = timer
+        self.__tasks = set()
+        self.__active = False
+        self.__handlers = {}
+
+    #----------------------------------------------------------------------
+    @property
+    def loop(self):
+        return self.__loop
+
+    #----------------------------------------------------------------------
+    async def __run(self):
+        """事件处理任务"""
+        queue = self.__queue
+        while True:
+            event = await queue.get()
+            self.__process(event)
+
+    #----------------------------------------------------------------------
+    def __process(self, event):
+        """处理事件，带主题的事件同时交给该主题的处理函数"""
+        handlers = list(self.__handlers.get(event.type_, ()))
+        if event.topic is not None:
+            handlers.extend(self.__handlers.get(topicType(event.type_, event.topic), ()))
+        for handler in handlers:
+            try:
+                handler(event)
+            except Exception:
+                traceback.print_exc()
+
+    #----------------------------------------------------------------------
+    def __onTimer(self):
+        """向事件队列中存入计时器事件"""
+        self.put(Event(type_=EVENT_TIMER))
+
+    #----------------------------------------------------------------------
+    def __startTasks(self):
+        """在事件循环中创建事件处理和计时器任务"""
+        self.__loopThread = get_ident()
+        early = self.__early
+        while early:
+            self.__queue.put_nowait(early.popleft())
+        self.__spawn(self.__run())
+        if self.__timer:
+            self.every(self.__timer, self.__onTimer)
+
+    #----------------------------------------------------------------------
+    def __spawn(self, coro):
+        task = self.__loop.create_task(coro)
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+        return task
+
+    #----------------------------------------------------------------------
+    def start(self):
+        """引擎启动"""
+        self.__queue = asyncio.Queue()
+        if self.__ownLoop:
+            self.__loop = asyncio.new_event_loop()
+        # 事件循环和队列都准备好后才在其他线程中直接转交事件
+        self.__active = True
+        if self.__ownLoop:
+            self.__thread = Thread(target=self.__runLoop, name='AsyncEventEngine')
+            self.__thread.start()
+            self.call(self.__startTasks)
+        else:
+            # 使用外部的事件循环，在循环线程中调用
+            self.__startTasks()
+
+    #----------------------------------------------------------------------
+    def __runLoop(self):
+        asyncio.set_event_loop(self.__loop)
+        self.__loop.run_forever()
+        self.__loop.close()
+
+    #----------------------------------------------------------------------
+    def stop(self):
+        """停止引擎：取消所有任务，使用自己的事件循环时停止循环并等待线程退出"""
+        if not self.__active:
+            return
+        self.__active = False
+        self.__loopThread = None
+        if self.__ownLoop:
+            asyncio.run_coroutine_threadsafe(self.__shutdown(), self.__loop)
+            self.__thread.join()
+        else:
+            self.__cancelTasks()
+
+    #----------------------------------------------------------------------
+    def __cancelTasks(self):
+        tasks = list(self.__tasks)
+        for task in tasks:
+            task.cancel()
+        return tasks
+
+    #----------------------------------------------------------------------
+    async def __shutdown(self):
+        """取消所有任务，等任务结束后停止事件循环"""
+        await asyncio.gather(*self.__cancelTasks(), return_exceptions=True)
+        self.__loop.stop()
+
+    #----------------------------------------------------------------------
+    def register(self, type_, handler):
+        """注册事件处理函数监听"""
+        handlerList = self.__handlers.setdefault(type_, [])
+        if handler not in handlerList:
+            handlerList.append(handler)
+
+    #----------------------------------------------------------------------
+    def unregister(self, type_, handler):
+        """注销事件处理函数监听"""
+        handlerList = self.__handlers.get(type_)
+        if handlerList is None:
+            return
+        if handler in handlerList:
+            handlerList.remove(handler)
+        if not handlerList:
+            del self.__handlers[type_]
+
+    #----------------------------------------------------------------------
+    def hasSubscribers(self, type_, topic=None):
+        """是否有处理函数监听该事件类型（或该事件类型的topic主题）"""
+        if type_ in self.__handlers:
+            return True
+        return topic is not None and topicType(type_, topic) in self.__handlers
+
+    #----------------------------------------------------------------------
+    def put(self, event):
+        """向事件队列中存入事件，在其他线程中调用时转到事件循环线程中存入"""
+        if not self.hasSubscribers(event.type_, event.topic):
+            return
+        if get_ident() == self.__loopThread:
+            self.__queue.put_nowait(event)
+        elif self.__active:
+            try:
+                self.__loop.call_soon_threadsafe(self.__queue.put_nowait, event)
+            except RuntimeError:
+                pass    # 事件循环已关闭
+        elif self.__queue is None:
+            # 尚未启动，启动后再处理
+            self.__early.append(event)
+
+    #----------------------------------------------------------------------
+    def call(self, func, *args):
+        """在事件循环线程中调用func(*args)，事件循环已关闭时忽略"""
+        if get_ident() == self.__loopThread:
+            func(*args)
+        else:
+            try:
+                self.__loop.call_soon_threadsafe(func, *args)
+            except RuntimeError:
+                pass    # 事件循环已关闭（如stop时线程池中还在执行的读取）
+
+    #----------------------------------------------------------------------
+    def every(self, interval, func):
+        """
+        在事件循环中每隔interval秒调用一次func（不带参数），返回任务对象
+        两次调用之间等待interval秒（不含func本身的执行时间）；
+        任务可以单独取消，引擎停止时自动取消
+        """
+        async def loop():
+            while True:
+                try:
+                    func()
+                except Exception:
+                    traceback.print_exc()
+                await asyncio.sleep(interval)
+        return self.__spawn(loop())
+
+    #----------------------------------------------------------------------
+    def repeat(self, func, error=1.0, executor=False, waker=None):
+        """
+        在事件循环中反复调用func（不带参数），func返回下次调用前等待的秒数，
+        返回None时停止；func出错时等待error秒后再调用。返回任务对象
+        executor：func有阻塞的调用（读文件等）时在线程池中执行，不阻塞事件循环
+        waker：Waker对象，wake()时提前结束等待（如刚下单后立即读取回报）
+        """
+        async def loop():
+            while True:
+                try:
+                    if executor:
+                        delay = await self.__loop.run_in_executor(None, func)
+                    else:
+                        delay = func()
+                except Exception:
+                    traceback.print_exc()
+                    delay = error
+                if delay is None:
+                    break
+                if waker is None:
+                    await asyncio.sleep(delay)
+                else:
+                    await waker.sleep(delay)
+        return self.__spawn(loop())
+
+
+########################################################################
+class Waker(object):
+    """
+    repeat任务的唤醒器
+
+    wake可以在任意线程中调用：正在等待的repeat任务立即进行下一次调用；
+    不在等待时（如func正在线程池中执行）下一次等待直接返回，唤醒不会丢失。
+    """
+
+    #----------------------------------------------------------------------
+    def __init__(self, engine):
+        self.__engine = engine
+        self.__woken = False
+        self.__event = None     # asyncio.Event，在事件循环线程中创建
+
+    #----------------------------------------------------------------------
+    def wake(self):
+        self.__engine.call(self.__set)
+
+    #----------------------------------------------------------------------
+    def __set(self):
+        self.__woken = True
+        if self.__event is not None:
+            self.__event.set()
+
+    #----------------------------------------------------------------------
+    async def sleep(self, delay):
+        """等待delay秒，被wake唤醒时提前返回"""
+        if not self.__woken:
+            if self.__event is None:
+                self.__event = asyncio.Event()
+            try:
+                await asyncio.wait_for(self.__event.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+        self.__woken = False
+        if self.__event is not None:
+            self.__event.clear()
+
+
+#----------------------------------------------------------------------
+def test():
+    """测试函数"""
+    from datetime import datetime
+    from time import sleep, time
+
+    def simpletest(event):
+        print(u'处理每秒触发的计时器事件：%s' % str(datetime.now()))
+
+    ee = AsyncEventEngine()
+    ee.register(EVENT_TIMER, simpletest)
+    ee.start()
+    sleep(3.5)
+    start = time()
+    ee.stop()
+    print(u'停止耗时：%.1fms' % ((time() - start) * 1000))
+
+
+# 直接运行脚本可以进行测试
+if __name__ == '__main__':
+    test()
@@ -4,22 +4,31 @@ Created on Wed Aug 30 09:09:35 2017
 
 @author: sunlei
 """
-from queue import Queue, Empty
 from threading import Thread
-from time import sleep, clock
-from collections import defaultdict, namedtuple, OrderedDict
+from time import sleep, clock, time
+from collections import namedtuple, OrderedDict
 import dbf
 # from math import ceil
 # from PyQt5.QtCore import QTimer
 from datetime import datetime
 from random import randint
-from decimal import Decimal
 import msvcrt
 import json
+import numpy as np
+from eventQueue import LANE_HIGH, LANE_LOW
+from eventEngine import EventEngine, Event
+from vnmkt import MktParser, MktSnapshot, MktWatcher
+from vnquote import QuoteBook, TickHistory
+from vnbar import BarGenerator
+from vnshm import SharedQuoteTable, SHM_NAME
+from vndbf import DbfTailReader, DbfAppender, Checkpoint
+from vnorder import OrderBook, OrderWriter
 
 # 系统相关
 EVENT_TIMER = 'eTimer'  # 计时器事件，每隔1秒发送一次
 EVENT_LOG = 'eLog'  # 日志事件，全局通用
+EVENT_MKT_SNAPSHOT = 'eMktSnapshot'  # mktdt00.txt行情快照更新事件
+EVENT_BAR = 'eBar'  # K线完成事件
 
 # Gateway相关
 EVENT_TICK = 'eTick.'  # TICK行情事件，可后接具体的vtSymbol
@@ -34,189 +43,9 @@ Order_rec = namedtuple('Order_rec', ['inst_type', 'client_id', 'acct_type', 'acc
                                      'ord_type'])
 
 
-########################################################################
-class EventEngine(object):
-    """
-    事件驱动引擎
-    事件驱动引擎中所有的变量都设置为了私有，这是为了防止不小心
-    从外部修改了这些变量的值或状态，导致bug。
-
-    变量说明
-    __queue：私有变量，事件队列
-    __active：私有变量，事件引擎开关
-    __thread：私有变量，事件处理线程
-    __timer：私有变量，计时器
-    __handlers：私有变量，事件处理函数字典
-
-
-    方法说明
-    __run: 私有方法，事件处理线程连续运行用
-    __process: 私有方法，处理事件，调用注册在引擎中的监听函数
-    __onTimer：私有方法，计时器固定事件间隔触发后，向事件队列中存入计时器事件
-    start: 公共方法，启动引擎
-    stop：公共方法，停止引擎
-    register：公共方法，向引擎中注册监听函数
-    unregister：公共方法，向引擎中注销监听函数
-    put：公共方法，向事件队列中存入新的事件
-
-    事件监听函数必须定义为输入参数仅为一个event对象，即：
-
-    函数
-    def func(event)
-        ...
-
-    对象方法
-    def method(self, event)
-        ...
-
-    """
-
-    # ----------------------------------------------------------------------
-    def __init__(self):
-        """初始化事件引擎"""
-        # 事件队列
-        self.__queue = Queue()
-
-        # 事件引擎开关
-        self.__active = False
-
-        # 事件处理线程
-        self.__thread = Thread(target=self.__run)
-
-        # 计时器，用于触发计时器事件
-        # self.__timer = QTimer()
-        # self.__timer.timeout.connect(self.__onTimer)
-        self.__timer = Thread(target=self.__onTimer)
-        self.__timeout = 1.0  # 延迟1秒
-        # 这里的__handlers是一个字典，用来保存对应的事件调用关系
-        # 其中每个键对应的值是一个列表，列表中保存了对该事件进行监听的函数功能
-        self.__handlers = defaultdict(list)
-
-        # __generalHandlers是一个列表，用来保存通用回调函数（所有事件均调用）
-        self.__generalHandlers = []
-
-    # ----------------------------------------------------------------------
-    def __run(self):
-        """引擎运行"""
-        while self.__active:
-            try:
-                event = self.__queue.get(
-                    block=True, timeout=1)  # 获取事件的阻塞时间设为1秒
-                self.__process(event)
-            except Empty:
-                pass
-
-    # ----------------------------------------------------------------------
-    def __process(self, event):
-        """处理事件"""
-        # 检查是否存在对该事件进行监听的处理函数
-        if event.type_ in self.__handlers:
-            # 若存在，则按顺序将事件传递给处理函数执行
-            #             if event.type_ == EVENT_TIMER:
-            #                 print(self.__handlers[event.type_])
-            [handler(event) for handler in self.__handlers[event.type_]]
-
-            # 以上语句为Python列表解析方式的写法，对应的常规循环写法为：
-            # for handler in self.__handlers[event.type_]:
-            # handler(event)
-
-        # 调用通用处理函数进行处理
-        if self.__generalHandlers:
-            [handler(event) for handler in self.__generalHandlers]
-
-    # ----------------------------------------------------------------------
-    def __onTimer(self):
-        """向事件队列中存入计时器事件"""
-        while self.__active:
-            # 创建计时器事件
-            sleep(self.__timeout)
-            event = Event(type_=EVENT_TIMER)
-
-        # 向队列中存入计时器事件
-            self.put(event)
-
-        # ----------------------------------------------------------------------
-
-    def start(self, timer=True):
-        """
-        引擎启动
-        timer：是否要启动计时器
-        """
-        # 将引擎设为启动
-        self.__active = True
-
-        # 启动事件处理线程
-        self.__thread.start()
-
-        # 启动计时器，计时器事件间隔默认设定为1秒
-        if timer:
-            self.__timer.start()
-            # self.__timer.start(1000)
-
-    # ----------------------------------------------------------------------
-    def stop(self):
-        """停止引擎"""
-        # 将引擎设为停止
-        self.__active = False
-
-        # 停止计时器
-        # self.__timer.stop()
-        self.__timer.join()
-
-        # 等待事件处理线程退出
-        self.__thread.join()
-
-    # ----------------------------------------------------------------------
-    def register(self, type_, handler):
-        """注册事件处理函数监听"""
-        # 尝试获取该事件类型对应的处理函数列表，若无defaultDict会自动创建新的list
-        handler_list = self.__handlers[type_]
-
-        # 若要注册的处理器不在该事件的处理器列表中，则注册该事件
-        if handler not in handler_list:
-            handler_list.append(handler)
-
-    # ----------------------------------------------------------------------
-    def unregister(self, type_, handler):
-        """注销事件处理函数监听"""
-        # 尝试获取该事件类型对应的处理函数列表，若无则忽略该次注销请求
-        handler_list = self.__handlers[type_]
-
-        # 如果该函数存在于列表中，则移除
-        if handler in handler_list:
-            handler_list.remove(handler)
-
-        # 如果函数列表为空，则从引擎中移除该事件类型
-        if not handler_list:
-            del self.__handlers[type_]
-
-    # ----------------------------------------------------------------------
-    def put(self, event):
-        """向事件队列中存入事件"""
-        self.__queue.put(event)
-
-    # ----------------------------------------------------------------------
-    def registerGeneralHandler(self, handler):
-        """注册通用事件处理函数监听"""
-        if handler not in self.__generalHandlers:
-            self.__generalHandlers.append(handler)
-
-    # ----------------------------------------------------------------------
-    def unregisterGeneralHandler(self, handler):
-        """注销通用事件处理函数监听"""
-        if handler in self.__generalHandlers:
-            self.__generalHandlers.remove(handler)
-
-
-########################################################################
-class Event:
-    """事件对象"""
-
-    # ----------------------------------------------------------------------
-    def __init__(self, type_=None):
-        """Constructor"""
-        self.type_ = type_  # 事件类型
-        self.dict_ = {}  # 字典用于保存具体的事件数据
+# 事件通道：委托、成交优先处理，行情最后处理
+EVENT_LANES = {EVENT_ORDER: LANE_HIGH, EVENT_TRADE: LANE_HIGH,
+               EVENT_TICK: LANE_LOW, EVENT_MKT_SNAPSHOT: LANE_LOW}
 
 
 class CastMid(object):  # 资产订单处理类
@@ -225,21 +54,32 @@ class CastMid(object):  # 资产订单处理类
                        'wt': r'd:\cast\instructions.dbf',
                        'hb': r'd:\cast\order_updates.dbf',
                        'zh': r'd:\cast\asset.dbf'}
-        self._wt_list = OrderedDict()
+        # 委托列表：client_id -> [委托, 申报编号, 成交数量, 成交均价, 冻结金额, 是否可撤]
+        self._wt_list = OrderBook(ord_no=lambda wt: wt[1], acct=lambda wt: wt[0].acct,
+                                  symbol=lambda wt: wt[0].symbol, is_open=lambda wt: wt[5])
         self._cj_num = 0
         self._client_id = 1000
         self._zh_list = {}
         self._hq_db = None
         self._ord_db = None
-        self._hb_db = None
+        self._ord_writer = None  # 委托库批量写入
+        self._hb_reader = None  # 回报库尾部读取
+        self._checkpoint = None  # 回报处理进度存档
         self._zh_db = None
         self._ee = engine
         self._time_tick = 0
         self.mkt_time = 0
         self._isClose = False
         self.hq_list = {}
-        self._dataMap = {}
+        self._jyDate = ''
+        self._parser = MktParser()
+        self._mkt = MktSnapshot()  # 最新的行情快照
+        self._book = QuoteBook()  # 列式行情表
+        self._history = TickHistory()  # 需要历史行情的证券
+        self._bars = BarGenerator(self._on_bar, minutes=(1, 5))  # 这些证券的K线
+        self._shared = None  # 共享内存行情表，供其他进程读取
         self.mtk_file = r'y:\remote\dbf\mktdt00.txt'
+        self._watcher = None
         self._active = False
         self._codepage = 'cp936'
         self.__thread = Thread(target=self.__run)
@@ -250,7 +90,8 @@ class CastMid(object):  # 资产订单处理类
     def start(self):
         self._hq_db = dbf.Table(self.tables['hq'], codepage=self._codepage)
         self._ord_db = dbf.Table(self.tables['wt'], codepage=self._codepage)
-        self._hb_db = dbf.Table(self.tables['hb'], codepage=self._codepage)
+        self._hb_reader = DbfTailReader(self.tables['hb'], self._codepage)
+        self._checkpoint = Checkpoint(self.tables['hb'] + '.ckpt')
         self._zh_db = dbf.Table(self.tables['zh'], codepage=self._codepage)
         self._zh_db.open()
         for rec in self._zh_db:
@@ -265,7 +106,11 @@ class CastMid(object):  # 资产订单处理类
             self._zh_list[rec.acct.strip()] = asset
         self._zh_db.close()
         self._client_id += self._get_wt()
+        self._ord_writer = OrderWriter(DbfAppender(self.tables['wt'], self._codepage))
+        self._ord_writer.start()
+        self._load_checkpoint()
         self._get_cj(False)
+        self._watcher = MktWatcher(self.mtk_file)
         self._active = True
         self.__thread.start()
         print(self._zh_list)
@@ -273,35 +118,44 @@ class CastMid(object):  # 资产订单处理类
     def stop(self):
         self._active = False
         self.__thread.join()
+        if self._watcher:
+            self._watcher.close()
+        if self._ord_writer:
+            self._ord_writer.stop()
+        if self._shared is not None:
+            self._shared.close()
+            self._shared = None
+
+    def share_quotes(self, name=SHM_NAME, capacity=16384):
+        """创建共享内存行情表，之后每次解析的快照同时写入，其他进程用SharedQuoteTable.attach读取"""
+        self._shared = SharedQuoteTable.create(name, capacity)
+        return self._shared
 
     def __run(self):
         while self._active:
-            #             self._hq_db.open()
-            #             for rec in self._hq_db:
-            #                 if dbf.is_deleted(rec):
-            #                     continue
-            #                 self.hq_list[rec.s1.strip()] = rec
-            #             self._hq_db.close()
-            self.write_mkt_to_show()
+            # 文件没有更新时不重新解析
+            if not self._watcher.wait(1.0):
+                self._bars.check()
+                continue
+            if not self.write_mkt_to_show():
+                continue
+            self._watcher.mark_done()
+            if self._ee:
+                event = Event(EVENT_MKT_SNAPSHOT)
+                event.dict_['data'] = self._mkt
+                self._ee.put(event)
             # print(self.mkt_time)
 
-    def record_strip(self, recodes):
-        for recode in recodes:
-            re = [value.strip() for value in recode]
-            yield re
-
     def write_mkt_to_show(self):
         """
-        mkt转show2003
+        读取mktdt00.txt，生成列式行情快照
         :return: True or False
         """
         start = clock()
-        first_line = second_line = third_line = ""
         i = 0
         while True:
             try:
-                with open(self.mtk_file) as f:
-                    lines = [x.replace('\n', '').split('|') for x in f]
+                snap = self._parser.read(self.mtk_file)
                 break
             except IOError as e:
                 print(e.strerror)
@@ -309,125 +163,56 @@ class CastMid(object):  # 资产订单处理类
                 sleep(randint(1, 100) / 100.00)
                 if i > 3:
                     return False
-        lines = [x for x in self.record_strip(lines)]
-        for i, line in enumerate(lines):
-            if i == 0:
-                first_line = line
-            elif i == 1:
-                second_line = line
-            elif i == 2:
-                third_line = line
-            else:
-                if i == 3:
-                    self._dataMap['000000'] = self.set_first_recode(
-                        first_line, second_line[9], third_line[9], line[9])
-                    self.mkt_to_map(second_line)
-                    self.mkt_to_map(third_line)
-                self.mkt_to_map(line)
+        if not len(snap):
+            # 文件正在改写，保留上一次的快照
+            return False
+        self._jyDate = snap.date
+        self._isClose = snap.is_close
+        self._mkt = snap
+        self._book.update(snap)
+        if self._shared is not None:
+            self._shared.update_snapshot(snap)
+        self._history.update_from_book(self._book, time())
+        symbols = self._history.symbols
+        if symbols:
+            now = datetime.now()
+            prices = self._book.field('last', symbols).tolist()
+            volumes = self._book.field('volume', symbols).tolist()
+            for symbol, price, volume in zip(symbols, prices, volumes):
+                self._bars.update(symbol, now, price, volume, symbol, 'SH')
         self.mkt_time = clock() - start
         return True
 
-    def set_first_recode(self, line, zs_price, ag_price, bg_price):
-        objs = [""] * 30
-        objs[0] = "000000"
-        objs[1] = line[6][9:17].replace(":", "") + "  "
-        objs[2] = float(ag_price)
-        objs[3] = float(bg_price)
-        objs[4] = 0
-        self._jyDate = line[6][0:8]
-        objs[5] = self._jyDate
-        if line[8][0] == "E":
-            objs[10] = 1111111111
-            self._isClose = True
-        else:
-            objs[10] = 0
-            self._isClose = False
-        objs[11] = float(zs_price)
-        objs[12] = int(line[8][2])
-        objs[14] = int(line[8][1])
-        objs.insert(0, True)
-        return objs
-
-    def mkt_to_map(self, records):
-        if len(records) == 0 or records[0] == "TRAILER":
-            return
-        objs = [''] * 30
-        if records[0] == "MD001":
-            objs[0] = records[1]
-            objs[1] = records[2]
-            objs[2] = float(records[5])
-            objs[3] = float(records[6])
-            objs[4] = int(999999999999 if len(str(Decimal(records[4]).quantize(Decimal('1')))) > 12
-                          else Decimal(records[4]).quantize(Decimal('1')))
-            objs[5] = float(records[7])
-            objs[6] = float(records[8])
-            objs[7] = float(records[10] if self._isClose else records[9])
-            objs[10] = int(records[3])
-            objs[11] = True
-        else:
-            objs[0] = records[1]
-            objs[1] = records[2]
-            objs[2] = float(records[5])
-            objs[3] = float(records[6])
-            objs[4] = int(999999999999 if len(str(Decimal(records[4]).quantize(Decimal('1')))) > 12
-                          else Decimal(records[4]).quantize(Decimal('1')))
-            objs[5] = float(records[7])
-            objs[6] = float(records[8])
-            objs[7] = float(records[10] if self._isClose else records[9])
-            objs[8] = float(records[11])
-            objs[9] = float(records[13])
-            objs[10] = int(records[3])
-            st_tmp = records[33] if records[0] == "MD004" else records[31]
-            objs[11] = True if len(st_tmp) < 3 else (
-                not (st_tmp[0] != 'P' and st_tmp[2] == '1'))
-            objs[12] = int(records[12])
-            objs[13] = float(records[15])
-            objs[14] = int(records[16])
-            objs[15] = float(records[19])
-            objs[16] = int(records[20])
-            objs[17] = int(records[14])
-            objs[18] = float(records[17])
-            objs[19] = int(records[18])
-            objs[20] = float(records[21])
-            objs[21] = int(records[22])
-            objs[22] = float(records[23])
-            objs[23] = int(records[24])
-            objs[24] = float(records[27])
-            objs[25] = int(records[28])
-            objs[26] = float(records[25])
-            objs[27] = int(records[26])
-            objs[28] = float(records[29])
-            objs[29] = int(records[30])
-        if objs[11]:
-            objs.insert(0, True)
-        else:
-            objs.insert(0, False)
-        objs[12] = ""
-        self._dataMap[records[1]] = objs
+    @property
+    def quote_book(self):
+        return self._book
 
-    def get_price(self, stocks):
+    @property
+    def history(self):
+        return self._history
 
-        sell = {}
-        buy = {}
-        for stock in stocks:
-            if stock not in self._dataMap:
-                continue
-            recodes = self._dataMap[stock]
+    @property
+    def bars(self):
+        return self._bars
 
-            sell[stock] = (recodes[10], recodes[18], recodes[19],
-                           recodes[20], recodes[21], recodes[22])
-            buy[stock] = (recodes[9], recodes[13], recodes[14],
-                          recodes[15], recodes[16], recodes[17])
+    def _on_bar(self, bar, minutes):
+        if self._ee:
+            event = Event(EVENT_BAR)
+            event.dict_['data'] = bar
+            event.dict_['minutes'] = minutes
+            self._ee.put(event)
 
+    def get_price(self, stocks):
+        """返回买卖三档价格和数量：(买一价, 买一量, 买二价, 买二量, 买三价, 买三量)"""
+        stocks = [stock for stock in stocks if stock in self._book]
+        bid, ask = self._book.get_price(stocks)
+        buy = dict(zip(stocks, map(tuple, bid.tolist())))
+        sell = dict(zip(stocks, map(tuple, ask.tolist())))
         return buy, sell
 
     def get_can_cancel(self):
-        keys = tuple(self._wt_list.keys())
-        can_cancel = {}
-        for key in keys:
-            if self._wt_list[key][5]:
-                can_cancel[key] = self._wt_list[key]
-        return can_cancel
+        # 可撤委托由委托表增量维护，这里只复制可撤的部分
+        return self._wt_list.open_orders()
 
     def get_zc(self, exchangeid):
         return self._zh_list[exchangeid]
@@ -450,9 +235,7 @@ class CastMid(object):  # 资产订单处理类
             self._zh_list[exchangeid][stock][0] -= volume
             je = 0.0
         self._wt_list[str(self._client_id)] = [rec, '', 0, 0.0, je, True]
-        self._ord_db.open()
-        self._ord_db.append(rec)
-        self._ord_db.close()
+        self._ord_writer.submit(rec)
         self._client_id += 1
         return self._client_id - 1
 
@@ -460,19 +243,17 @@ class CastMid(object):  # 资产订单处理类
         rec = Order_rec('C', self._client_id, 'S0', exchangeid,
                         orderid, '', '', 0, 0.0, '')
         self._wt_list[str(self._client_id)] = [rec, '', 0, 0.0, 0.0, False]
-        self._ord_db.open()
-        self._ord_db.append(rec)
-        self._ord_db.close()
+        self._ord_writer.submit(rec)
         self._client_id += 1
-        for cl_id in self._wt_list.keys():
+        for cl_id in self._wt_list.open_by_ord_no(rec.ord_no.strip()):
             rec1 = self._wt_list[cl_id][0]
-            if self._wt_list[cl_id][5] and self._wt_list[cl_id][1] == rec.ord_no.strip():
-                self._wt_list[cl_id][5] = False
-                if rec1.tradeside == '1':
-                    self._zh_list[rec1.acct]['zjky'] += self._wt_list[cl_id][4]
-                if rec1.tradeside == '2':
-                    self._zh_list[rec1.acct][rec1.symbol][0] += (
-                        rec1.ord_qty - self._wt_list[cl_id][2])
+            self._wt_list[cl_id][5] = False
+            self._wt_list.refresh(cl_id)
+            if rec1.tradeside == '1':
+                self._zh_list[rec1.acct]['zjky'] += self._wt_list[cl_id][4]
+            if rec1.tradeside == '2':
+                self._zh_list[rec1.acct][rec1.symbol][0] += (
+                    rec1.ord_qty - self._wt_list[cl_id][2])
         event = Event(EVENT_TRADE)
         self._ee.put(event)
 
@@ -483,20 +264,41 @@ class CastMid(object):  # 资产订单处理类
             self._time_tick = 0
             self._get_cj()
 
+    def _load_checkpoint(self):
+        """读取当天的回报处理进度，恢复委托状态"""
+        state = self._checkpoint.load()
+        if not state or state.get('date') != datetime.now().strftime('%Y%m%d'):
+            return
+        if state['cursor'] > self._hb_reader.header.record_count:
+            return
+        for client_id, wt in state['wt_list'].items():
+            if client_id in self._wt_list:
+                self._wt_list[client_id] = wt
+        self._cj_num = state['cursor']
+
+    def _save_checkpoint(self):
+        state = {'date': datetime.now().strftime('%Y%m%d'),
+                 'cursor': self._cj_num,
+                 'wt_list': self._wt_list.to_dict()}
+        try:
+            self._checkpoint.save(state)
+        except Exception as e:
+            print(e)
+
     def _get_cj(self, normal=True):
-        self._hb_db.open()
-        cj_list = [rec for rec in self._hb_db]
-        self._hb_db.close()
-        if self._cj_num == len(cj_list):
+        # 从上次处理到的记录开始，只读取新增的回报
+        self._hb_reader.seek(self._cj_num)
+        cj_list = self._hb_reader.read()
+        if not cj_list:
             return
-        for i in range(self._cj_num, len(cj_list)):
-            rec = cj_list[i]
+        for rec in cj_list:
             if len(rec.client_id.strip()):
                 if len(rec.err_msg.strip()):
                     self._wt_err(rec, normal)
                 else:
                     client_id = rec.client_id.strip()
                     self._wt_list[client_id][1] = rec.ord_no.strip()
+                    self._wt_list.refresh(client_id)
                     if self._wt_list[client_id][0].inst_type == 'C':
                         self._wt_cancel(rec, normal)
                     else:
@@ -505,6 +307,7 @@ class CastMid(object):  # 资产订单处理类
                         if rec.tradeside.strip() == '2':
                             self._wt_sell(rec, normal)
             self._cj_num += 1
+        self._save_checkpoint()
         if normal:
             event = Event(EVENT_TRADE)
             self._ee.put(event)
@@ -512,10 +315,9 @@ class CastMid(object):  # 资产订单处理类
     def _wt_cancel(self, rec, normal=True):
         cl_id = rec.client_id.strip()
         ord_no = self._wt_list[cl_id][0].ord_no
-        for cl_id in self._wt_list.keys():
-            # print(self._wt_list[cl_id],ord_no)
-            if self._wt_list[cl_id][5] and self._wt_list[cl_id][1] == ord_no:
-                self._wt_list[cl_id][5] = False
+        for cl_id in self._wt_list.open_by_ord_no(ord_no):
+            self._wt_list[cl_id][5] = False
+            self._wt_list.refresh(cl_id)
 
     def _wt_buy(self, rec, normal=True):
         cl_id = rec.client_id.strip()
@@ -538,6 +340,7 @@ class CastMid(object):  # 资产订单处理类
             self._wt_list[cl_id][4] -= je
             if self._wt_list[cl_id][0].ord_qty <= self._wt_list[cl_id][2]:
                 self._wt_list[cl_id][5] = False
+                self._wt_list.refresh(cl_id)
                 if self._wt_list[cl_id][4] > 0 and normal:
                     self._zh_list[rec.acct.strip(
                     )]['zjky'] += self._wt_list[cl_id][4]
@@ -553,10 +356,12 @@ class CastMid(object):  # 资产订单处理类
             self._wt_list[cl_id][4] = (int(rec.filled_qty) * float(rec.avg_px))
             if self._wt_list[cl_id][0].ord_qty <= self._wt_list[cl_id][2]:
                 self._wt_list[cl_id][5] = False
+                self._wt_list.refresh(cl_id)
 
     def _wt_err(self, rec, normal=True):
         cl_id = rec.client_id.strip()
         self._wt_list[cl_id][5] = False
+        self._wt_list.refresh(cl_id)
         ord_rec = self._wt_list[cl_id][0]
         if normal:
             if ord_rec.tradeside == '1':
@@ -586,9 +391,9 @@ class CastMid(object):  # 资产订单处理类
                 self._wt_list[str(rec.client_id)] = [
                     record, '', 0, 0.0, 0.0, False]
             if rec.inst_type.strip() == 'C':
-                for cl_id in self._wt_list.keys():
-                    if self._wt_list[cl_id][5] and self._wt_list[cl_id][1] == rec.ord_no.strip():
-                        self._wt_list[cl_id][5] = False
+                for cl_id in self._wt_list.open_by_ord_no(rec.ord_no.strip()):
+                    self._wt_list[cl_id][5] = False
+                    self._wt_list.refresh(cl_id)
 
             rec_no += 1
         self._ord_db.close()
@@ -606,54 +411,58 @@ class Trading(object):  # 策略主体
         self._wt_list = OrderedDict()
         self._is_chk = False
         self._active = False
-        self._pr_204001 = [0, 0, 0]
+        self._pr_time = None  # 上次判断204001走势的时间
+        self._mdi.history.track('204001')
+        self._symbols = tuple(stocks)  # 扫描的证券代码
         self._is_down = False
 
-    def _onChoice(self, ev):  # 价格判断
+    def _onChoice(self, ev):  # 价格判断，每次行情快照更新时调用
         self._tick += 1
-        if self._tick % 60 == 0:
-            start_t = clock()
-            pr, _ = self._mdi.get_price(['204001'])
-            self._pr_204001[0] = self._pr_204001[1]
-            self._pr_204001[1] = self._pr_204001[2]
-            self._pr_204001[2] = pr['204001'][0]
-            print(self._pr_204001, clock() - start_t)
-            if self._pr_204001[2] < self._pr_204001[1] < self._pr_204001[0]:
+        start_t = clock()
+        if self._pr_time is None or start_t - self._pr_time >= 60:
+            self._pr_time = start_t
+            # 204001最近三分钟每分钟的买一价
+            now = time()
+            pr = self._mdi.history['204001'].asof('bid1', [now - 120, now - 60, now])
+            print(pr, clock() - start_t)
+            if pr[2] < pr[1] < pr[0]:
                 self._is_down = True
-            elif self._pr_204001[2] > self._pr_204001[1] > self._pr_204001[0]:
+            elif pr[2] > pr[1] > pr[0]:
                 self._is_down = False
 
-        if self._tick % 3 == 0:
-            #    event = Event(self.EVENT_CHK)  #发送查成交请求
-            # print('check')
-            buy, sell = self._mdi.get_price(self._stocks.keys())
-            for stock in sell.keys():
-                if sell[stock][0] < 99.95:
-                    zh = self._mdi.get_zh_list
-                    if len(zh) == 0:
-                        return
-                    bv_max = int(sell[stock][1] / len(zh))
-                    if bv_max < 100:
-                        bv_max = 100
-                    for key in zh:
-                        zc = self._mdi.get_zc(key)
-                        zjky = zc['zjky']
-                        if zjky > 0:
-                            amon = int((zjky / sell[stock][0] / 100) * 100)
-                            if amon < 100:
-                                continue
-                            if amon > bv_max:
-                                amon = bv_max
-                            event = Event(EVENT_ORDER)
-                            event.dict_['account'] = key
-                            event.dict_['stock'] = '{0}.SH'.format(stock)
-                            event.dict_['price'] = sell[stock][0]
-                            event.dict_['vol'] = amon
-                            event.dict_['direct'] = '1'
-                            print(stock, sell[stock])
-                            self._ee.put(event)
+        #    event = Event(self.EVENT_CHK)  #发送查成交请求
+        # print('check')
+        _, ask = self._mdi.quote_book.get_price(self._symbols)
+        # 卖一价低于99.95的第一只证券
+        hit = np.flatnonzero((ask[:, 0] > 0) & (ask[:, 0] < 99.95))
+        if hit.size:
+            stock = self._symbols[hit[0]]
+            sell = {stock: tuple(ask[hit[0]].tolist())}
+            zh = self._mdi.get_zh_list
+            if len(zh) == 0:
+                return
+            bv_max = int(sell[stock][1] / len(zh))
+            if bv_max < 100:
+                bv_max = 100
+            for key in zh:
+                zc = self._mdi.get_zc(key)
+                zjky = zc['zjky']
+                if zjky > 0:
+                    amon = int((zjky / sell[stock][0] / 100) * 100)
+                    if amon < 100:
+                        continue
+                    if amon > bv_max:
+                        amon = bv_max
+                    event = Event(EVENT_ORDER)
+                    event.dict_['account'] = key
+                    event.dict_['stock'] = '{0}.SH'.format(stock)
+                    event.dict_['price'] = sell[stock][0]
+                    event.dict_['vol'] = amon
+                    event.dict_['direct'] = '1'
                     print(stock, sell[stock])
-                    return
+                    self._ee.put(event)
+            print(stock, sell[stock])
+            return
 
         is_up = False
         if is_up:
@@ -675,13 +484,12 @@ class Trading(object):  # 策略主体
                         self._ee.put(event)
 
         if self._is_down:
-            if self._tick % 3 == 0:
-                set_ord = False
-                # print('choice')
-                buy, sell = self._mdi.get_price(['511990'])
-                stock = '511990'
-                if not sell:
-                    return
+            set_ord = False
+            # print('choice')
+            buy, sell = self._mdi.get_price(['511990'])
+            stock = '511990'
+            if not sell:
+                return
 #                 for key in self._stocks.keys():
 #                     rate = (self._stocks[key] + (100 - sell[key][0]) * 365) / 2
 #                     if rate > self._rate:
@@ -690,40 +498,40 @@ class Trading(object):  # 策略主体
 #                         set_ord = True
 #                         print(
 # stock, self._stocks[key], (100 - sell[key][0]) * 365, self._rate)
-                set_ord = True
-                if set_ord:
-                    bv = buy[stock][1] + buy[stock][3] + buy[stock][4]
-                    sv = sell[stock][1] * 1.5
-                    # print(stock, self._rate, bv, sv)
-                    # if self._rate > pr['204001'][0] and
-                    if sell[stock][0] < 110:  # bv > sv and 符合规则，发送委托消息
-                        zh = self._mdi.get_zh_list
-                        if len(zh) == 0:
-                            return
-                        bv_max = int(sell[stock][1] / len(zh))
-                        if bv_max < 100:
-                            bv_max = 100
-                        for key in zh:
-                            zc = self._mdi.get_zc(key)
-                            zjky = zc['zjky']
-                            if zjky > 0:
-                                amon = int((zjky / sell[stock][0] / 100) * 100)
-                                if amon < 100:
-                                    continue
-                                if amon > bv_max:
-                                    amon = bv_max
-                                event = Event(EVENT_ORDER)
-                                event.dict_['account'] = key
-                                event.dict_['stock'] = '{0}.SH'.format(stock)
-                                event.dict_['price'] = sell[stock][0]
-                                event.dict_['vol'] = amon
-                                event.dict_['direct'] = '1'
-                                print(stock, sell[stock])
-                                self._ee.put(event)
-                                print(stock, self._rate, bv, sv)
-                    else:
-                        print(self._rate)
-                        self._rate = 0.0
+            set_ord = True
+            if set_ord:
+                bv = buy[stock][1] + buy[stock][3] + buy[stock][4]
+                sv = sell[stock][1] * 1.5
+                # print(stock, self._rate, bv, sv)
+                # if self._rate > pr['204001'][0] and
+                if sell[stock][0] < 110:  # bv > sv and 符合规则，发送委托消息
+                    zh = self._mdi.get_zh_list
+                    if len(zh) == 0:
+                        return
+                    bv_max = int(sell[stock][1] / len(zh))
+                    if bv_max < 100:
+                        bv_max = 100
+                    for key in zh:
+                        zc = self._mdi.get_zc(key)
+                        zjky = zc['zjky']
+                        if zjky > 0:
+                            amon = int((zjky / sell[stock][0] / 100) * 100)
+                            if amon < 100:
+                                continue
+                            if amon > bv_max:
+                                amon = bv_max
+                            event = Event(EVENT_ORDER)
+                            event.dict_['account'] = key
+                            event.dict_['stock'] = '{0}.SH'.format(stock)
+                            event.dict_['price'] = sell[stock][0]
+                            event.dict_['vol'] = amon
+                            event.dict_['direct'] = '1'
+                            print(stock, sell[stock])
+                            self._ee.put(event)
+                            print(stock, self._rate, bv, sv)
+                else:
+                    print(self._rate)
+                    self._rate = 0.0
 
     def _on_ord(self, ev):  # 委托买入卖出事件
         ord_id = 0
@@ -797,12 +605,12 @@ class Trading(object):  # 策略主体
                             event.dict_['vol'] = zc[stock][0]
                             event.dict_['direct'] = '2'
                             self._ee.put(event)
-                self._ee.register(EVENT_TIMER, self._onChoice)
+                self._ee.register(EVENT_MKT_SNAPSHOT, self._onChoice)
                 is_not_reg[0] = False
                 print('set_ord_cho')
             # 处理函数解除注册并撤销所有可撤委托
             if not is_not_reg[0] and '14:50:00' < now_time < '14:52:00':
-                self._ee.unregister(EVENT_TIMER, self._onChoice)
+                self._ee.unregister(EVENT_MKT_SNAPSHOT, self._onChoice)
                 self._ee.unregister(EVENT_ORDER, self._on_ord)
                 print('un_set_ord_cho')
                 cancel = self._mdi.get_can_cancel()
@@ -863,7 +671,7 @@ class Trading(object):  # 策略主体
 
 stocks = {'511990': 0, '511810': 0, '511660': 0, '511990': 0, '511650': 0, '511690': 0, '511820': 0, '511760': 0, '511830': 0, '511850': 0, '511600': 0, '511970': 0,
           '511700': 0, '511800': 0, '511860': 0, '511680': 0, '511930': 0, '511980': 0, '511770': 0, '511920': 0, '511620': 0, '511960': 0, '511950': 0, '511910': 0, '511890': 0}
-ee = EventEngine()
+ee = EventEngine(lanes=EVENT_LANES, clock='thread')  # 无界面运行，不导入Qt
 mdi = CastMid(ee)
 trade = Trading(stocks, ee, mdi)
 mdi.start()
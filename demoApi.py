@@ -126,21 +126,17 @@ class DemoMdApi(MdApi):
     # ----------------------------------------------------------------------
     def on_send_mkt_data(self, req, reqID):
         """行情推送"""
-        # 行情推送收到后，同时触发常规行情事件，以及特定合约行情事件，用于满足不同类型的监听
+        # 行情事件以合约代码为主题，同时交给常规行情和特定合约行情的监听函数
         data = req['data']
-        # 常规行情事件
         if not data:
             return
-        tick = VtTickData()
-        tick.set_data(data)
-        event1 = Event(type_=EVENT_MARKETDATA)
-        event1.dict_['data'] = tick
-        self.__eventEngine.put(event1)
-
-        # 特定合约行情事件
-        event2 = Event(type_=(EVENT_MARKETDATA_CONTRACT + data['vtSymbol']))
-        event2.dict_['data'] = data
-        self.__eventEngine.put(event2)
+        vtSymbol = data['vtSymbol']
+        # 没有监听时不创建行情对象
+        if not self.__eventEngine.hasSubscribers(EVENT_MARKETDATA, vtSymbol):
+            return
+        event = Event(type_=EVENT_MARKETDATA, topic=vtSymbol)
+        event.dict_['data'] = VtTickData.from_data(data)
+        self.__eventEngine.put(event)
 
     # ----------------------------------------------------------------------
     def login(self, db_path):
@@ -223,7 +219,7 @@ class DemoTdApi(TdApi):
         for key in self._wt_list.keys():
             rec = self._wt_list[key]
             event = Event(type_=EVENT_ORDER)
-            event.dict_['data'] = rec
+            event.dict_['data'] = rec.snapshot()
             event.dict_['start'] = True
             self.__eventEngine.put(event)
 
@@ -272,7 +268,7 @@ class DemoTdApi(TdApi):
     def push_zh(self):
         """更新账户"""
         event = Event(type_=(EVENT_ACCOUNT + 'data'))
-        event.dict_['data'] = self._zh_list
+        event.dict_['data'] = self.account_snapshots()
         self.__eventEngine.put(event)
 
     # ----------------------------------------------------------------------
@@ -373,16 +369,11 @@ class DemoTdApi(TdApi):
         rec = req['data']
         self.__query_tick = 0
 
-        # 常规报单事件
-        event1 = Event(type_=EVENT_ORDER)
-        event1.dict_['data'] = rec
-        event1.dict_['func'] = req.get('func', '')
-        self.__eventEngine.put(event1)
-
-        # 特定合约行情事件
-        event2 = Event(type_=(EVENT_ORDER_ORDERREF + str(rec.client_id)))
-        event2.dict_['data'] = rec
-        self.__eventEngine.put(event2)
+        # 报单事件以报单号为主题，同时交给常规报单和特定报单的监听函数
+        event = Event(type_=EVENT_ORDER, topic=str(rec.client_id))
+        event.dict_['data'] = rec
+        event.dict_['func'] = req.get('func', '')
+        self.__eventEngine.put(event)
 
     def on_cj_update(self):
         self.__query_tick = 0
@@ -390,8 +381,8 @@ class DemoTdApi(TdApi):
     # ----------------------------------------------------------------------
     def on_trade(self, req, reqID):
         """成交回报"""
-        # 常规成交事件
-        event1 = Event(type_=EVENT_TRADE)
+        # 成交事件以报单号为主题，同时交给常规成交和特定成交的监听函数
+        event1 = Event(type_=EVENT_TRADE, topic=str(req['data']['OrderRef']))
         event1.dict_['data'] = req['data']
         self.__eventEngine.put(event1)
 
@@ -399,12 +390,6 @@ class DemoTdApi(TdApi):
         event.dict_['data'] = req['data']
         self.__eventEngine.put(event)
 
-        # 特定合约成交事件
-        event2 = Event(type_=(EVENT_TRADE_CONTRACT +
-                              str(req['data']['OrderRef'])))
-        event2.dict_['data'] = req['data']
-        self.__eventEngine.put(event2)
-
     # ----------------------------------------------------------------------
     def onErrRtnOrderInsert(self, data, error):
         """发单错误回报（交易所）"""
@@ -479,6 +464,27 @@ class DemoTdApi(TdApi):
         # 返回订单号，便于某些算法进行动态管理
         return self.__orderref
 
+    # ----------------------------------------------------------------------
+    def send_orders(self, orders):
+        """
+        批量发单
+        orders为(instrumentid, exchangeid, price, pricetype, volume, direction)的列表，
+        返回订单号列表
+        """
+        self.__reqid = self.__reqid + 1
+        reqs = []
+        for instrumentid, exchangeid, price, pricetype, volume, direction in orders:
+            req = {}
+            req['stock'] = instrumentid
+            req['exchangeid'] = exchangeid
+            req['pricetype'] = pricetype
+            req['price'] = price
+            req['volume'] = volume
+            req['direction'] = direction
+            req['MinVolume'] = 1  # 最小成交量为1
+            reqs.append(req)
+        return TdApi.send_orders(self, reqs, self.__reqid)
+
     # ----------------------------------------------------------------------
     def cancelOrder(self, orderref):
         """撤单"""
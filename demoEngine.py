@@ -10,13 +10,14 @@
 
 import sys
 from datetime import date
-import copy
 import shelve
 
 from collections import OrderedDict
 from vtobject import *
 from demoApi import *
-from eventEngine import EventEngine
+from eventEngine import EventEngine, tickKey
+from vnbar import BarEngine
+from vnpubsub import Publisher, PUBSUB_ADDRESS
 
 
 ########################################################################
@@ -26,7 +27,7 @@ class MainEngine:
     # ----------------------------------------------------------------------
     def __init__(self):
         """Constructor"""
-        self.eventEngine = EventEngine()  # 创建事件驱动引擎
+        self.eventEngine = EventEngine(conflate=tickKey)  # 创建事件驱动引擎，积压的行情只保留最新的
 
         self.md = DemoMdApi(self.eventEngine)  # 创建API接口
         # self.md = DemoL2Api(self.ee)   # 如果使用L2行情就改为这行
@@ -34,6 +35,7 @@ class MainEngine:
 
         self.eventEngine.start()  # 启动事件驱动引擎
         self.dataEngine = DataEngine(self, self.eventEngine)
+        self.barEngine = BarEngine(self.eventEngine)  # 由行情合成1分钟、5分钟K线
 
         # 循环查询持仓和账户相关
         self.countGet = 0  # 查询延时计数
@@ -54,6 +56,9 @@ class MainEngine:
         # 风控引擎实例（特殊独立对象）
         self.rmEngine = None
 
+        # 行情、委托事件发布（服务器-客户机模式）
+        self.publisher = None
+
     # ----------------------------------------------------------------------
     def addGateway(self, gatewayModule):
         """添加底层接口"""
@@ -165,6 +170,11 @@ class MainEngine:
         self.td.sendOrder(instrumentid, exchangeid, price,
                           pricetype, volume, direction)
 
+    # ----------------------------------------------------------------------
+    def send_orders(self, orders):
+        """批量发单，orders为(instrumentid, exchangeid, price, pricetype, volume, direction)的列表"""
+        return self.td.send_orders(orders)
+
     # ----------------------------------------------------------------------
     def cancelOrder(self, orderref):
         """撤单"""
@@ -202,9 +212,21 @@ class MainEngine:
         """获取合约信息对象"""
         return self.dataEngine.getContract(instrumentid)
 
+    # ----------------------------------------------------------------------
+    def startPublisher(self, address=PUBSUB_ADDRESS):
+        """向本机其他进程（界面、策略）发布行情和委托事件，客户端用vnpubsub.Subscriber连接"""
+        if self.publisher is None:
+            self.publisher = Publisher(self.eventEngine, address)
+            self.publisher.start()
+
     # ----------------------------------------------------------------------
     def exit(self):
         """退出"""
+        # 停止事件发布
+        if self.publisher is not None:
+            self.publisher.stop()
+            self.publisher = None
+
         # 销毁API对象
         self.td.exit()
         self.md.exit()
@@ -267,6 +289,7 @@ class DataEngine(object):
         # 保存账户持仓字典
         self.accountDict = {}
         self.stockDict = {}
+        self.accountVersion = {}  # 账户 -> 已复制的账户快照版本号
         self.Portfolio = {}
 
         # 保存活动委托数据的字典（即可撤销）
@@ -304,13 +327,16 @@ class DataEngine(object):
         data = event.dict_['data']
         sub_stocks = set()
         print(data)
-        for acc in data.keys():
-            self.accountDict[acc] = copy.deepcopy(data[acc]['acct'])
-            self.stockDict[acc] = copy.deepcopy(data[acc]['stocks'])
+        for acc, snap in data.items():
+            # 账户快照没有变化时不需要重新复制
+            if self.accountVersion.get(acc) != snap.version:
+                self.accountVersion[acc] = snap.version
+                self.accountDict[acc] = dict(snap.acct)
+                self.stockDict[acc] = dict((code, list(pos)) for code, pos in snap.stocks.items())
 
             if acc not in self.Portfolio:
                 self.Portfolio[acc] = Portfolio(acc)
-            self.Portfolio[acc].update_account(data[acc])
+            self.Portfolio[acc].update_account(snap)
             for stock in self.Portfolio[acc].long_positions.keys():
                 sub_stocks.add(stock)
 
@@ -395,6 +421,11 @@ class DataEngine(object):
     def updateOrder(self, event):
         """更新委托数据"""
         order = event.dict_['data']
+        if order.acct.strip() in self.Portfolio:
+            # 先补上证券名称和T+0标志再保存，getOrder等查询和组合看到同一份委托快照
+            stock = self.getContract(order.symbol)
+            if stock:
+                order = order._replace(name=stock.name, is_t0=stock.is_t0)
         self.orderDict[order.vtOrderID] = order
         start = event.dict_.get('start', False)
 
@@ -412,10 +443,6 @@ class DataEngine(object):
                 self.stockDict[order.acct][order.symbol][0] -= order.ord_qty
 
         if order.acct.strip() in self.Portfolio:
-            stock = self.getContract(order.symbol)
-            if stock:
-                order.name = stock.name
-                order.is_t0 = stock.is_t0
             self.Portfolio[order.acct.strip()].update_order(order, start)
         if order.acct.strip() in self.Portfolio:
             print(self.Portfolio[order.acct.strip()])
@@ -14,6 +14,7 @@ import time
 import sys
 import shelve
 from collections import OrderedDict
+from threading import Lock
 
 import sip
 from qtpy import QtCore, QtGui, QtWidgets
@@ -334,9 +335,138 @@ class PositionMonitor(QtWidgets.QTableWidget):
 
 
 ########################################################################
-class OrderMonitor(QtWidgets.QTableWidget):
+class BufferedTableModel(QtCore.QAbstractTableModel):
+    """
+    带合并缓冲的只读表格模型
+
+    事件线程调用push只把数据按键存入缓冲（同一键只保留最新的数据），
+    GUI线程的定时器按固定频率取出缓冲更新模型：新的键一次性插入，
+    已有的行逐个比较显示文本，只对变化的单元格范围发出dataChanged。
+
+    labels：列名字典（键 -> 表头文字）
+    keyFunc：数据 -> 行的键
+    rowFunc：数据 -> 各列显示文本
+    colorFunc：数据 -> 该行的文字颜色，None为默认颜色
+    interval：刷新间隔（毫秒），默认200即每秒5帧
+    newOnTop：新的行插入到表格顶部
+    """
+
+    # ----------------------------------------------------------------------
+    def __init__(self, labels, keyFunc, rowFunc, colorFunc=None, interval=200,
+                 newOnTop=False, parent=None):
+        """Constructor"""
+        super(BufferedTableModel, self).__init__(parent)
+        self.__headers = list(labels.values())
+        self.__keyFunc = keyFunc
+        self.__rowFunc = rowFunc
+        self.__colorFunc = colorFunc
+        self.__newOnTop = newOnTop
+
+        self.__keys = []  # 按到达顺序排列的键
+        self.__index = {}  # 键 -> 在__keys中的位置
+        self.__rows = []  # 各行的显示文本
+        self.__colors = []  # 各行的文字颜色
+        self.dictData = {}  # 键 -> 最新数据
+
+        self.__lock = Lock()
+        self.__pending = OrderedDict()  # 尚未显示的数据
+
+        self.__timer = QtCore.QTimer(self)
+        self.__timer.timeout.connect(self.flush)
+        self.__timer.start(interval)
+
+    # ----------------------------------------------------------------------
+    def push(self, data):
+        """存入数据，可以在任意线程中调用"""
+        key = self.__keyFunc(data)
+        with self.__lock:
+            self.__pending[key] = data
+
+    # ----------------------------------------------------------------------
+    def __position(self, row):
+        """表格中的行号和存储位置互相转换"""
+        if self.__newOnTop:
+            return len(self.__rows) - 1 - row
+        return row
+
+    # ----------------------------------------------------------------------
+    def flush(self):
+        """把缓冲中的数据更新到模型，由定时器在GUI线程中调用"""
+        with self.__lock:
+            if not self.__pending:
+                return
+            pending = self.__pending
+            self.__pending = OrderedDict()
+
+        colorFunc = self.__colorFunc
+        new = []
+        for key, data in pending.items():
+            self.dictData[key] = data
+            values = tuple(self.__rowFunc(data))
+            pos = self.__index.get(key)
+            if pos is None:
+                new.append((key, values, colorFunc(data) if colorFunc else None))
+                continue
+
+            old = self.__rows[pos]
+            if old == values:
+                continue
+            changed = [col for col, (a, b) in enumerate(zip(old, values)) if a != b]
+            self.__rows[pos] = values
+            if colorFunc:
+                self.__colors[pos] = colorFunc(data)
+            row = self.__position(pos)
+            self.dataChanged.emit(self.index(row, changed[0]), self.index(row, changed[-1]))
+
+        # 新的行一次性插入，避免逐行移动
+        if new:
+            count = len(self.__rows)
+            first = 0 if self.__newOnTop else count
+            self.beginInsertRows(QtCore.QModelIndex(), first, first + len(new) - 1)
+            for key, values, color in new:
+                self.__index[key] = len(self.__keys)
+                self.__keys.append(key)
+                self.__rows.append(values)
+                self.__colors.append(color)
+            self.endInsertRows()
+
+    # ----------------------------------------------------------------------
+    def dataAt(self, row):
+        """表格第row行对应的数据"""
+        return self.dictData[self.__keys[self.__position(row)]]
+
+    # ----------------------------------------------------------------------
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.__rows)
+
+    # ----------------------------------------------------------------------
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.__headers)
+
+    # ----------------------------------------------------------------------
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == QtCore.Qt.DisplayRole:
+            return self.__rows[self.__position(index.row())][index.column()]
+        if role == QtCore.Qt.ForegroundRole:
+            return self.__colors[self.__position(index.row())]
+        return None
+
+    # ----------------------------------------------------------------------
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and orientation == QtCore.Qt.Horizontal:
+            return self.__headers[section]
+        return None
+
+
+########################################################################
+class OrderMonitor(QtWidgets.QTableView):
     """用于显示所有报单"""
-    signal = QtCore.Signal(type(Event()))
 
     dictLabels = OrderedDict()
     dictLabels['acct'] = u'资金账号'
@@ -346,8 +476,8 @@ class OrderMonitor(QtWidgets.QTableWidget):
     dictLabels['tradeside'] = u'方向'
     dictLabels['ord_price'] = u'价格'
     dictLabels['ord_qty'] = u'委托数量'
-    dictLabels['_filled_qty'] = u'成交数量'
-    dictLabels['_avg_px'] = u'成交均价'
+    dictLabels['filled_qty'] = u'成交数量'
+    dictLabels['avg_px'] = u'成交均价'
     dictLabels['ord_time'] = u'委托时间'
     dictLabels['can_cancel'] = u'状态信息'
 
@@ -388,8 +518,10 @@ class OrderMonitor(QtWidgets.QTableWidget):
         self.__eventEngine = eventEngine
         self.__mainEngine = mainEngine
 
-        self.dictOrder = {}  # 用来保存报单号对应的单元格对象
-        self.dictOrderData = {}  # 用来保存报单数据
+        # 报单较少但需要及时显示，每秒刷新10次；新的报单显示在顶部
+        self.model = BufferedTableModel(self.dictLabels, self.orderKey, self.formatRow,
+                                        self.rowColor, interval=100, newOnTop=True, parent=self)
+        self.dictOrderData = self.model.dictData  # 用来保存报单数据
 
         self.initUi()
         self.registerEvent()
@@ -398,92 +530,65 @@ class OrderMonitor(QtWidgets.QTableWidget):
     def initUi(self):
         """"""
         self.setWindowTitle(u'报单')
-
-        self.setColumnCount(len(self.dictLabels))
-        self.setHorizontalHeaderLabels(self.dictLabels.values())
+        self.setModel(self.model)
 
         self.verticalHeader().setVisible(False)  # 关闭左边的垂直表头
-        self.setEditTriggers(QtWidgets.QTableWidget.NoEditTriggers)  # 设为不可编辑状态
+        self.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)  # 设为不可编辑状态
 
     # ----------------------------------------------------------------------
     def registerEvent(self):
         """"""
-        self.signal.connect(self.updateOrder)
-        self.__eventEngine.register(EVENT_ORDER, self.signal.emit)
+        # 直接在事件引擎线程中存入缓冲，不再每个事件发一次信号
+        self.__eventEngine.register(EVENT_ORDER, self.updateOrder)
 
-        self.itemDoubleClicked.connect(self.cancelOrder)
+        self.doubleClicked.connect(self.cancelOrder)
 
     # ----------------------------------------------------------------------
     def updateOrder(self, event):
         """"""
-        data = event.dict_['data']
-        orderref = str(data.client_id)
-
-        self.dictOrderData[orderref] = data
-        # print(data,data.__dict__['client_id'])
+        self.model.push(event.dict_['data'])
 
-        # 如果之前已经收到过这个订单的数据, 则直接更新
-        if orderref in self.dictOrder:
-            d = self.dictOrder[orderref]
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def orderKey(data):
+        return str(data.client_id)
 
-            for label, cell in d.items():
-                if label == 'tradeside':
-                    try:
-                        value = self.dictDirection[data.__dict__[label]]
-                    except KeyError:
-                        if data.inst_type == 'C':
-                            value = u'撤单'
-                        else:
-                            value = u'未知类型'
-                elif label == 'can_cancel':
-                    if data.__dict__[label]:
-                        value = u'可撤'
+    # ----------------------------------------------------------------------
+    def formatRow(self, data):
+        """报单各列的显示文本"""
+        values = []
+        for label in self.dictLabels:
+            if label == 'tradeside':
+                try:
+                    value = self.dictDirection[data.tradeside]
+                except KeyError:
+                    if data.inst_type == 'C':
+                        value = u'撤单'
                     else:
-                        value = u'不可撤'
-                else:
-                    value = str(data.__dict__[label])
-
-                cell.setText(value)
-                # print('更新完毕')
-        # 否则插入新的一行，并更新
-        else:
-            self.insertRow(0)
-            d = {}
-
-            for col, label in enumerate(self.dictLabels.keys()):
-                if label == 'tradeside':
-                    try:
-                        value = self.dictDirection[data.__dict__[label]]
-                    except KeyError:
                         value = u'未知类型'
-                elif label == 'can_cancel':
-                    if data.__dict__[label]:
-                        value = u'可撤'
-                    else:
-                        value = u'不可撤'
-                else:
-                    value = str(data.__dict__[label])
-                # print(label,value)
-
-                cell = QtWidgets.QTableWidgetItem(value)
-                if data.tradeside == '1':
-                    cell.setForeground(QtGui.QColor(150, 0, 0))
+            elif label == 'can_cancel':
+                if data.can_cancel:
+                    value = u'可撤'
                 else:
-                    cell.setForeground(QtGui.QColor(0, 150, 0))
-                self.setItem(0, col, cell)
-                d[label] = cell
-
-                cell.orderref = orderref  # 动态绑定报单号到单元格上
+                    value = u'不可撤'
+            else:
+                value = str(getattr(data, label))
+            values.append(value)
+        return values
 
-            self.dictOrder[orderref] = d
-            # print('插入完毕')
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def rowColor(data):
+        if data.tradeside == '1':
+            return QtGui.QColor(150, 0, 0)
+        return QtGui.QColor(0, 150, 0)
 
     # ----------------------------------------------------------------------
-    def cancelOrder(self, cell):
+    def cancelOrder(self, index):
         """双击撤单"""
         print(u'撤单指令')
-        orderref = cell.orderref
-        order = self.dictOrderData[orderref]
+        order = self.model.dataAt(index.row())
+        orderref = self.orderKey(order)
 
         # 撤单前检查报单是否已经撤销或者全部成交
         if order.can_cancel:
@@ -505,9 +610,8 @@ class OrderMonitor(QtWidgets.QTableWidget):
 
 
 ########################################################################
-class MarketDataMonitor(QtWidgets.QTableWidget):
+class MarketDataMonitor(QtWidgets.QTableView):
     """用于显示行情"""
-    signal = QtCore.Signal(type(Event()))
 
     dictLabels = OrderedDict()
     dictLabels['Name'] = u'合约名称'
@@ -524,6 +628,9 @@ class MarketDataMonitor(QtWidgets.QTableWidget):
 
     dictLabels['UpdateTime'] = u'更新时间'
 
+    # 列名 -> VtTickData的字段名
+    dictFields = {'UpdateTime': 'time'}
+
     # ----------------------------------------------------------------------
     def __init__(self, eventEngine, mainEngine, parent=None):
         """Constructor"""
@@ -531,7 +638,13 @@ class MarketDataMonitor(QtWidgets.QTableWidget):
         self.__eventEngine = eventEngine
         self.__mainEngine = mainEngine
 
-        self.dictData = {}
+        self.dictName = {}  # 合约代码 -> 名称
+        self.fields = [self.dictFields.get(label, label) for label in self.dictLabels
+                       if label != 'Name']
+        # 行情刷新频率高，同一合约在一帧内只显示最新的一笔，每秒刷新5次
+        self.model = BufferedTableModel(self.dictLabels, self.tickKey, self.formatRow,
+                                        interval=200, parent=self)
+        self.dictData = self.model.dictData
 
         self.initUi()
         self.registerEvent()
@@ -540,61 +653,41 @@ class MarketDataMonitor(QtWidgets.QTableWidget):
     def initUi(self):
         """"""
         self.setWindowTitle(u'行情')
-
-        self.setColumnCount(len(self.dictLabels))
-        self.setHorizontalHeaderLabels(self.dictLabels.values())
+        self.setModel(self.model)
 
         self.verticalHeader().setVisible(False)  # 关闭左边的垂直表头
-        self.setEditTriggers(QtWidgets.QTableWidget.NoEditTriggers)  # 设为不可编辑状态
+        self.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)  # 设为不可编辑状态
 
     # ----------------------------------------------------------------------
     def registerEvent(self):
         """"""
-        self.signal.connect(self.updateData)
-        self.__eventEngine.register(EVENT_MARKETDATA, self.signal.emit)
+        self.__eventEngine.register(EVENT_MARKETDATA, self.updateData)
 
     # ----------------------------------------------------------------------
     def updateData(self, event):
         """"""
-        data = event.dict_['data'].read_data()
-        instrumentid = data['vtSymbol']
-
-        # 如果之前已经收到过这个账户的数据, 则直接更新
-        if instrumentid in self.dictData:
-            d = self.dictData[instrumentid]
-
-            for label, cell in d.items():
-                if label != 'Name':
-                    value = str(data[label])
-                else:
-                    value = self.getName(instrumentid)
-                cell.setText(value)
-        # 否则插入新的一行，并更新
-        else:
-            row = self.rowCount()
-            self.insertRow(row)
-            d = {}
+        self.model.push(event.dict_['data'])
 
-            for col, label in enumerate(self.dictLabels.keys()):
-                if label != 'Name':
-                    value = str(data[label])
-                    cell = QtWidgets.QTableWidgetItem(value)
-                    self.setItem(row, col, cell)
-                    d[label] = cell
-                else:
-                    name = self.getName(instrumentid)
-                    cell = QtWidgets.QTableWidgetItem(name)
-                    self.setItem(row, col, cell)
-                    d[label] = cell
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def tickKey(tick):
+        return tick.vtSymbol
 
-            self.dictData[instrumentid] = d
+    # ----------------------------------------------------------------------
+    def formatRow(self, tick):
+        """行情各列的显示文本，直接读取字段，不再生成整个行情字典"""
+        return [self.getName(tick.vtSymbol)] + [str(getattr(tick, field)) for field in self.fields]
 
     # ----------------------------------------------------------------------
     def getName(self, instrumentid):
-        """获取名称"""
+        """获取名称，查到后缓存"""
+        name = self.dictName.get(instrumentid)
+        if name:
+            return name
         instrument = self.__mainEngine.selectInstrument(instrumentid)
         if instrument:
-            return instrument.name
+            name = self.dictName[instrumentid] = instrument.name
+            return name
         else:
             return ''
 
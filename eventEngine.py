@@ -1,14 +1,182 @@
 # encoding: UTF-8
 
 # 系统模块
-from queue import Queue, Empty
-from threading import Thread
-
-# 第三方模块
-from PyQt5.QtCore import QTimer
+import sys
+from functools import partial
+from threading import Thread, Lock, Event as _Flag
+from time import perf_counter, monotonic
 
 # 自己开发的模块
 from eventType import *
+from eventQueue import LaneQueue, ShardPool, LANE_HIGH, LANE_LOW
+from vnstat import EventProfiler
+
+
+# 默认的事件通道：委托、成交优先处理，行情最后处理
+DEFAULT_LANES = {
+    EVENT_ORDER: LANE_HIGH,
+    EVENT_ORDER_ORDERREF: LANE_HIGH,
+    EVENT_TRADE: LANE_HIGH,
+    EVENT_TRADE_CONTRACT: LANE_HIGH,
+    EVENT_MARKETDATA: LANE_LOW,
+    EVENT_MARKETDATA_CONTRACT: LANE_LOW,
+}
+
+
+#----------------------------------------------------------------------
+def tickKey(event):
+    """行情事件的合并键：同一合约尚未处理的行情只保留最新的一个"""
+    if event.type_ == EVENT_MARKETDATA:
+        return event.dict_['data'].vtSymbol
+    if event.type_.startswith(EVENT_MARKETDATA_CONTRACT):
+        # 特定合约行情事件的类型中已包含合约代码
+        return True
+    return None
+
+
+#----------------------------------------------------------------------
+def topicType(type_, topic):
+    """主题事件类型：通用事件类型加'.'加主题，例如'eMarketData.600000'"""
+    return '%s.%s' % (type_, topic)
+
+
+#----------------------------------------------------------------------
+def shardKey(event):
+    """多线程模式下的分片键：有合约代码时按合约，有账户时按账户，否则按事件类型"""
+    data = event.dict_.get('data')
+    if isinstance(data, dict):
+        key = data.get('vtSymbol') or data.get('acct')
+    else:
+        key = getattr(data, 'vtSymbol', None) or getattr(data, 'acct', None)
+    return key or event.type_
+
+
+########################################################################
+class ThreadTimer(object):
+    """
+    不依赖Qt的计时器，用于无界面运行的后台进程
+
+    在单独的线程中按单调时钟定时回调，下一次触发时间按计划时间累加，
+    不受回调本身耗时的影响（不漂移）；落后超过一个间隔时跳过错过的触发。
+    """
+
+    #----------------------------------------------------------------------
+    def __init__(self, interval=1.0):
+        """interval：触发间隔（秒），可以小于1秒"""
+        self.interval = interval
+        self.__stopFlag = _Flag()
+        self.__thread = None
+
+    #----------------------------------------------------------------------
+    def start(self, callback):
+        self.__stopFlag.clear()
+        self.__thread = Thread(target=self.__run, args=(callback,), name='EventTimer')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    #----------------------------------------------------------------------
+    def __run(self, callback):
+        interval = self.interval
+        due = monotonic() + interval
+        while not self.__stopFlag.wait(max(due - monotonic(), 0)):
+            callback()
+            due += interval
+            now = monotonic()
+            if due < now:
+                due += ((now - due) // interval + 1) * interval
+
+    #----------------------------------------------------------------------
+    def stop(self):
+        self.__stopFlag.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+
+########################################################################
+class QtTimer(object):
+    """基于QTimer的计时器，用于图形界面（需要运行Qt事件循环），Qt在创建时才导入"""
+
+    #----------------------------------------------------------------------
+    def __init__(self, interval=1.0):
+        """interval：触发间隔（秒）"""
+        from PyQt5.QtCore import QTimer, Qt
+        self.interval = interval
+        self.__timer = QTimer()
+        self.__timer.setTimerType(Qt.PreciseTimer)
+
+    #----------------------------------------------------------------------
+    def start(self, callback):
+        self.__timer.timeout.connect(callback)
+        self.__timer.start(max(int(round(self.interval * 1000)), 1))
+
+    #----------------------------------------------------------------------
+    def stop(self):
+        self.__timer.stop()
+
+
+########################################################################
+class AsyncTimer(object):
+    """
+    在asyncio事件循环中定时回调的计时器，按loop.time()计划触发时间，不漂移
+    start、stop可以在任意线程中调用
+    """
+
+    #----------------------------------------------------------------------
+    def __init__(self, loop, interval=1.0):
+        self.interval = interval
+        self.__loop = loop
+        self.__handle = None
+        self.__active = False
+
+    #----------------------------------------------------------------------
+    def start(self, callback):
+        self.__active = True
+        self.__loop.call_soon_threadsafe(self.__schedule, callback, None)
+
+    #----------------------------------------------------------------------
+    def __schedule(self, callback, due):
+        if not self.__active:
+            return
+        now = self.__loop.time()
+        if due is None:
+            due = now + self.interval
+        elif due < now:
+            due += ((now - due) // self.interval + 1) * self.interval
+        self.__handle = self.__loop.call_at(due, self.__fire, callback, due)
+
+    #----------------------------------------------------------------------
+    def __fire(self, callback, due):
+        if not self.__active:
+            return
+        callback()
+        self.__schedule(callback, due + self.interval)
+
+    #----------------------------------------------------------------------
+    def stop(self):
+        self.__active = False
+        if self.__handle is not None:
+            self.__loop.call_soon_threadsafe(self.__handle.cancel)
+
+
+#----------------------------------------------------------------------
+def makeTimer(clock='auto', interval=1.0):
+    """
+    创建计时器
+    clock：'qt'、'thread'，或已创建的计时器对象（有start(callback)和stop()方法）；
+    'auto'时已经创建了Qt程序对象则用Qt计时器，否则用线程计时器（不导入Qt）
+    """
+    if clock == 'auto':
+        qtCore = sys.modules.get('PyQt5.QtCore')
+        if qtCore is not None and qtCore.QCoreApplication.instance() is not None:
+            clock = 'qt'
+        else:
+            clock = 'thread'
+    if clock == 'qt':
+        return QtTimer(interval)
+    if clock == 'thread':
+        return ThreadTimer(interval)
+    return clock
 
 
 ########################################################################
@@ -20,11 +188,17 @@ class EventEngine:
     从外部修改了这些变量的值或状态，导致bug。
     
     变量说明
-    __queue：私有变量，事件队列
+    __queue：私有变量，事件队列（按优先级分通道）
+    __batch：私有变量，每次从队列中最多取出的事件数
     __active：私有变量，事件引擎开关
     __thread：私有变量，事件处理线程
-    __timer：私有变量，计时器
+    __timer：私有变量，计时器（启动时按clock创建）
     __handlers：私有变量，事件处理函数字典
+    __generalHandlers：私有变量，通用处理函数列表（所有事件均调用）
+    __topicTypes：私有变量，有主题处理函数的事件类型 -> 主题处理函数的注册数
+    __threadSafe：私有变量，声明为线程安全的(事件类型, 处理函数)
+    __pool：私有变量，工作线程池（workers为0时不使用）
+    __profiler：私有变量，耗时统计（profile为False时不使用）
     
     
     方法说明
@@ -33,9 +207,17 @@ class EventEngine:
     __onTimer：私有方法，计时器固定事件间隔触发后，向事件队列中存入计时器事件
     start: 公共方法，启动引擎
     stop：公共方法，停止引擎
-    register：公共方法，向引擎中注册监听函数
+    register：公共方法，向引擎中注册监听函数，可声明处理函数是否线程安全
     unregister：公共方法，向引擎中注销监听函数
+    registerGeneralHandler：公共方法，注册通用处理函数
+    unregisterGeneralHandler：公共方法，注销通用处理函数
     put：公共方法，向事件队列中存入新的事件
+    hasSubscribers：公共方法，查看事件类型（及主题）是否有处理函数监听
+    queueDepth：公共方法，查看各通道的积压情况
+    droppedCount：公共方法，因合并而未处理的事件数
+    unroutedCount：公共方法，因没有处理函数监听而丢弃的事件数
+    queueSize：公共方法，队列中的事件总数
+    profileStats：公共方法，排队等待和处理函数耗时统计
     
     事件监听函数必须定义为输入参数仅为一个event对象，即：
     
@@ -46,14 +228,39 @@ class EventEngine:
     对象方法
     def method(self, event)
         ...
-        
+
+    多线程模式（workers > 0）：注册时声明为线程安全的处理函数交给工作线程池，
+    按shardKey分片，同一合约（账户）的事件按顺序处理，不同合约并行处理；
+    其余处理函数仍在事件处理线程中按顺序执行。
+
+    统计模式（profile=True）：记录每个事件类型的排队等待时间、每个处理函数的
+    执行时间（p50/p99/最大值），stop时可写入profileFile。
+
+    主题路由：事件可以带有主题（合约代码、报单号等），带主题的事件只存入一次，
+    同时交给注册在事件类型（如EVENT_MARKETDATA）和主题事件类型
+    （如EVENT_MARKETDATA_CONTRACT + vtSymbol，见topicType）上的处理函数。
+    没有任何处理函数监听的事件在put时直接丢弃，不进入队列；发送方可以先用
+    hasSubscribers检查，没有监听时连事件对象也不必创建。
+
+    计时器：图形界面中默认使用QTimer，没有Qt程序对象时使用单独的计时器线程，
+    不需要导入Qt；间隔由timer指定，可以小于1秒。
     """
 
     #----------------------------------------------------------------------
-    def __init__(self):
-        """初始化事件引擎"""
+    def __init__(self, lanes=DEFAULT_LANES, batch=100, conflate=None,
+                 workers=0, key=shardKey, profile=False, profileFile=None,
+                 timer=1.0, clock='auto'):
+        """
+        初始化事件引擎
+        lanes：事件类型 -> 通道（见eventQueue），batch：每次最多处理的事件数
+        conflate：事件合并键函数（如tickKey），None为不合并
+        workers：工作线程数，key：分片键函数
+        profile：是否统计耗时，profileFile：停止时写入统计结果的文件
+        timer：计时器事件的间隔（秒），clock：计时器类型（见makeTimer）
+        """
         # 事件队列
-        self.__queue = Queue()
+        self.__queue = LaneQueue(lanes, conflate=conflate)
+        self.__batch = batch
         
         # 事件引擎开关
         self.__active = False
@@ -61,37 +268,109 @@ class EventEngine:
         # 事件处理线程
         self.__thread = Thread(target = self.__run)
         
-        # 计时器，用于触发计时器事件
-        self.__timer = QTimer()
-        self.__timer.timeout.connect(self.__onTimer)
+        # 计时器，用于触发计时器事件，启动时再创建（此时Qt程序对象已经存在）
+        self.__timer = None
+        self.__timerInterval = timer
+        self.__clock = clock
         
         # 这里的__handlers是一个字典，用来保存对应的事件调用关系
         # 其中每个键对应的值是一个列表，列表中保存了对该事件进行监听的函数功能
+        # 注册、注销时替换整个列表而不原地修改，其他线程注册时事件线程正在遍历的列表不受影响
         self.__handlers = {}
+        self.__registerLock = Lock()
+        
+        # 通用处理函数列表，所有事件均调用
+        self.__generalHandlers = []
+        
+        # 有主题处理函数的事件类型，没有主题处理函数时分发不必拼接主题事件类型
+        self.__topicTypes = {}
+        self.__unrouted = 0
+        
+        # 线程安全的处理函数及工作线程池
+        self.__threadSafe = set()
+        self.__pool = ShardPool(workers) if workers > 0 else None
+        self.__key = key
+        
+        # 耗时统计
+        self.__profiler = EventProfiler() if profile else None
+        self.__profileFile = profileFile
         
     #----------------------------------------------------------------------
     def __run(self):
         """引擎运行"""
         while self.__active == True:
-            try:
-                event = self.__queue.get(block = True, timeout = 1)  # 获取事件的阻塞时间设为1秒
+            # 一次取出多个事件，高优先级通道的事件排在前面，没有事件时最多等待1秒
+            events = self.__queue.drain(self.__batch, 1)
+            if self.__profiler:
+                depth = self.__queue.qsize()
+                for event in events:
+                    self.__profiler.on_get(event, depth)
+                    self.__processProfiled(event)
+                continue
+            for event in events:
                 #print(event.type_)
                 self.__process(event)
-            except Empty:
-                pass
             
+    #----------------------------------------------------------------------
+    def __route(self, event):
+        """
+        事件的处理函数：返回[(注册的事件类型, 处理函数列表)]，
+        包括事件类型本身的处理函数，以及事件带主题时该主题的处理函数
+        """
+        type_ = event.type_
+        handlers = self.__handlers.get(type_)
+        routes = [(type_, handlers)] if handlers else []
+        topic = event.topic
+        if topic is not None and type_ in self.__topicTypes:
+            key = topicType(type_, topic)
+            handlers = self.__handlers.get(key)
+            if handlers:
+                routes.append((key, handlers))
+        return routes
+
     #----------------------------------------------------------------------
     def __process(self, event):
         """处理事件"""
         # 检查是否存在对该事件进行监听的处理函数
-        if event.type_ in self.__handlers:
-            #print(self.__handlers[event.type_])
-            #若存在，则按顺序将事件传递给处理函数执行
-            [handler(event) for handler in self.__handlers[event.type_]]
-            
-            #以上语句为Python列表解析方式的写法，对应的常规循环写法为：
-            #for handler in self.__handlers[event.type_]:
-                #handler(event)    
+        for type_, handlers in self.__route(event):
+            #print(handlers)
+            if self.__pool is None or not self.__threadSafe:
+                #若存在，则按顺序将事件传递给处理函数执行
+                [handler(event) for handler in handlers]
+                
+                #以上语句为Python列表解析方式的写法，对应的常规循环写法为：
+                #for handler in handlers:
+                    #handler(event)    
+            else:
+                # 线程安全的处理函数交给工作线程，其余的在本线程处理
+                parallel = []
+                for handler in handlers:
+                    if (type_, handler) in self.__threadSafe:
+                        parallel.append(handler)
+                    else:
+                        handler(event)
+                if parallel:
+                    self.__pool.submit(self.__key(event), parallel, event)
+
+        # 调用通用处理函数进行处理
+        if self.__generalHandlers:
+            [handler(event) for handler in self.__generalHandlers]
+
+    #----------------------------------------------------------------------
+    def __processProfiled(self, event):
+        """处理事件并记录每个处理函数的执行时间，处理顺序与__process相同（通用处理函数最后）"""
+        profiler = self.__profiler
+        parallel = []
+        for type_, handlers in self.__route(event):
+            for handler in handlers:
+                if self.__pool is not None and (type_, handler) in self.__threadSafe:
+                    parallel.append(partial(profiler.call, type_, handler))
+                else:
+                    profiler.call(type_, handler, event)
+        if parallel:
+            self.__pool.submit(self.__key(event), parallel, event)
+        for handler in self.__generalHandlers:
+            profiler.call(event.type_, handler, event)
                
     #----------------------------------------------------------------------
     def __onTimer(self):
@@ -103,16 +382,23 @@ class EventEngine:
         self.put(event)    
 
     #----------------------------------------------------------------------
-    def start(self):
-        """引擎启动"""
+    def start(self, timer=True):
+        """
+        引擎启动
+        timer：是否要启动计时器
+        """
         # 将引擎设为启动
         self.__active = True
         
-        # 启动事件处理线程
+        # 启动工作线程池和事件处理线程
+        if self.__pool:
+            self.__pool.start()
         self.__thread.start()
         
         # 启动计时器，计时器事件间隔默认设定为1秒
-        self.__timer.start(1000)
+        if timer and self.__timerInterval:
+            self.__timer = makeTimer(self.__clock, self.__timerInterval)
+            self.__timer.start(self.__onTimer)
     
     #----------------------------------------------------------------------
     def stop(self):
@@ -121,56 +407,144 @@ class EventEngine:
         self.__active = False
         
         # 停止计时器
-        self.__timer.stop()
+        if self.__timer is not None:
+            self.__timer.stop()
+            self.__timer = None
         
         # 等待事件处理线程退出
         self.__thread.join()
+        
+        # 工作线程处理完已分配的事件后退出
+        if self.__pool:
+            self.__pool.stop()
+        
+        # 保存耗时统计
+        if self.__profiler and self.__profileFile:
+            self.__profiler.dump(self.__profileFile)
             
     #----------------------------------------------------------------------
-    def register(self, type_, handler):
-        """注册事件处理函数监听"""
-        # 尝试获取该事件类型对应的处理函数列表，若无则创建
-        try:
-            handlerList = self.__handlers[type_]
-        except KeyError:
-            handlerList = []
-            self.__handlers[type_] = handlerList
-        
-        # 若要注册的处理器不在该事件的处理器列表中，则注册该事件
-        if handler not in handlerList:
-            handlerList.append(handler)
+    def register(self, type_, handler, threadSafe=False):
+        """
+        注册事件处理函数监听
+        threadSafe：处理函数可以和其他处理函数并行执行（只在多线程模式下有效）
+        可以在任意线程中调用
+        """
+        with self.__registerLock:
+            # 尝试获取该事件类型对应的处理函数列表，若无则创建
+            handlerList = self.__handlers.get(type_)
+            if handlerList is None:
+                handlerList = []
+
+                # 主题事件类型，记录其通用事件类型
+                if '.' in type_:
+                    base = type_.split('.', 1)[0]
+                    self.__topicTypes[base] = self.__topicTypes.get(base, 0) + 1
+
+            # 若要注册的处理器不在该事件的处理器列表中，则注册该事件
+            if handler not in handlerList:
+                self.__handlers[type_] = handlerList + [handler]
+
+            if threadSafe:
+                self.__threadSafe.add((type_, handler))
+            else:
+                self.__threadSafe.discard((type_, handler))
             
     #----------------------------------------------------------------------
     def unregister(self, type_, handler):
-        """注销事件处理函数监听"""
-        # 尝试获取该事件类型对应的处理函数列表，若无则忽略该次注销请求
-        try:
-            handlerList = self.__handlers[type_]
-            
+        """注销事件处理函数监听，可以在任意线程中调用"""
+        with self.__registerLock:
+            # 尝试获取该事件类型对应的处理函数列表，若无则忽略该次注销请求
+            handlerList = self.__handlers.get(type_)
+            if handlerList is None:
+                return
+            self.__threadSafe.discard((type_, handler))
+
             # 如果该函数存在于列表中，则移除
-            if handler in handlerList:
-                handlerList.remove(handler)
+            handlerList = [h for h in handlerList if h != handler]
+            if handlerList:
+                self.__handlers[type_] = handlerList
+                return
 
             # 如果函数列表为空，则从引擎中移除该事件类型
-            if not handlerList:
-                del self.__handlers[type_]
-        except KeyError:
-            pass     
+            del self.__handlers[type_]
+            if '.' in type_:
+                base = type_.split('.', 1)[0]
+                count = self.__topicTypes.pop(base) - 1
+                if count:
+                    self.__topicTypes[base] = count
         
+    #----------------------------------------------------------------------
+    def registerGeneralHandler(self, handler):
+        """注册通用事件处理函数监听"""
+        with self.__registerLock:
+            if handler not in self.__generalHandlers:
+                self.__generalHandlers = self.__generalHandlers + [handler]
+
+    #----------------------------------------------------------------------
+    def unregisterGeneralHandler(self, handler):
+        """注销通用事件处理函数监听"""
+        with self.__registerLock:
+            if handler in self.__generalHandlers:
+                self.__generalHandlers = [h for h in self.__generalHandlers if h != handler]
+
+    #----------------------------------------------------------------------
+    def hasSubscribers(self, type_, topic=None):
+        """
+        是否有处理函数监听该事件类型（或该事件类型的topic主题）
+        有通用处理函数时总是返回True
+        """
+        if type_ in self.__handlers or self.__generalHandlers:
+            return True
+        return (topic is not None and type_ in self.__topicTypes and
+                topicType(type_, topic) in self.__handlers)
+
     #----------------------------------------------------------------------
     def put(self, event):
-        """向事件队列中存入事件"""
+        """向事件队列中存入事件，没有处理函数监听的事件直接丢弃"""
+        if not self.hasSubscribers(event.type_, event.topic):
+            self.__unrouted += 1
+            return
+        if self.__profiler:
+            event.putTime = perf_counter()
         self.__queue.put(event)
 
+    #----------------------------------------------------------------------
+    def queueDepth(self):
+        """各通道的积压情况：{通道: (当前积压数, 最大积压数, 累计存入数)}"""
+        return self.__queue.depth()
+
+    #----------------------------------------------------------------------
+    def droppedCount(self):
+        """因合并而未处理的事件数"""
+        return self.__queue.dropped()
+
+    #----------------------------------------------------------------------
+    def unroutedCount(self):
+        """因没有处理函数监听而丢弃的事件数"""
+        return self.__unrouted
+
+    #----------------------------------------------------------------------
+    def queueSize(self):
+        """队列中的事件总数"""
+        return self.__queue.qsize()
+
+    #----------------------------------------------------------------------
+    def profileStats(self):
+        """耗时统计（见vnstat.EventProfiler.stats），未开启统计时返回None"""
+        if self.__profiler:
+            return self.__profiler.stats()
+        return None
+
 
 ########################################################################
 class Event:
     """事件对象"""
 
     #----------------------------------------------------------------------
-    def __init__(self, type_=None):
+    def __init__(self, type_=None, topic=None):
         """Constructor"""
         self.type_ = type_      # 事件类型
+        self.topic = topic      # 主题（合约代码、报单号等），None为没有主题
         self.dict_ = {}         # 字典用于保存具体的事件数据
 
 
@@ -191,8 +565,30 @@ def test():
     ee.start()
     
     app.exec_()
+
+
+#----------------------------------------------------------------------
+def testHeadless(interval=0.1, seconds=3):
+    """测试无界面模式：不导入Qt，计时器线程按interval秒触发"""
+    from time import sleep
+
+    stamps = []
+    ee = EventEngine(timer=interval)
+    ee.register(EVENT_TIMER, lambda event: stamps.append(monotonic()))
+    ee.start()
+    sleep(seconds)
+    ee.stop()
+
+    gaps = [b - a for a, b in zip(stamps, stamps[1:])]
+    print(u'已导入Qt：%s' % ('PyQt5.QtCore' in sys.modules))
+    print(u'计时器事件%d次，间隔平均%.1fms，最小%.1fms，最大%.1fms' % (
+        len(stamps), sum(gaps) / len(gaps) * 1000, min(gaps) * 1000, max(gaps) * 1000))
+    print(u'总漂移：%.1fms' % ((stamps[-1] - stamps[0] - interval * len(gaps)) * 1000))
     
     
 # 直接运行脚本可以进行测试
 if __name__ == '__main__':
-    test()
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == 'headless':
+        testHeadless()
+    else:
+        test()
\ No newline at end of file
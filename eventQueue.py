@@ -0,0 +1,283 @@
+# encoding: UTF-8
+
+'''
+事件引擎使用的事件队列，不依赖Qt，eventEngine和cast.py中的引擎共用。
+
+LaneQueue按事件类型把事件分到不同优先级的通道（lane），取事件时总是先取
+优先级高的通道，这样行情事件积压时委托、成交事件也不会被延误。
+drain一次取出多个事件，减少每个事件一次加锁、唤醒的开销。
+可选的合并（conflate）功能：同一合约尚未处理的行情只保留最新的一个。
+
+ShardPool是多线程的事件处理池：按键（合约、账户等）把事件分配到固定的
+工作线程，同一个键的事件按顺序处理，不同键的事件并行处理。
+'''
+
+# 系统模块
+from collections import deque
+from queue import Queue, Empty
+from threading import Condition, Thread
+from time import time
+
+# 通道优先级，数字越小越先处理
+LANE_HIGH = 0       # 委托、成交
+LANE_NORMAL = 1     # 默认
+LANE_LOW = 2        # 行情
+
+
+########################################################################
+class _Slot(object):
+    """可合并事件在队列中的占位，新事件到达时直接替换其中的事件"""
+
+    __slots__ = ('key', 'event')
+
+    #----------------------------------------------------------------------
+    def __init__(self, key, event):
+        self.key = key
+        self.event = event
+
+
+########################################################################
+class LaneQueue(object):
+    """
+    多通道优先级事件队列
+
+    lanes：事件类型 -> 通道的字典。键以'.'结尾时为前缀匹配，
+    例如'eMarketData.'可以匹配'eMarketData.600000'；
+    没有匹配的事件放入default通道。
+    同一通道内保持先进先出。
+
+    conflate：合并键函数，输入事件，返回合并键或None（不合并）。
+    队列中已有同一事件类型、同一合并键的事件时，新事件替换旧事件，
+    位置不变，被替换的事件计入dropped。
+    """
+
+    #----------------------------------------------------------------------
+    def __init__(self, lanes=None, default=LANE_NORMAL, conflate=None):
+        """Constructor"""
+        self.__lanes = dict(lanes or {})
+        self.__default = default
+        count = max(list(self.__lanes.values()) + [default]) + 1
+        self.__queues = [deque() for _ in range(count)]
+        self.__peak = [0] * count           # 各通道的最大积压数
+        self.__total = [0] * count          # 各通道累计存入数
+        self.__laneCache = {}               # 事件类型 -> 通道
+        self.__size = 0
+        self.__cond = Condition()
+        self.__conflate = conflate
+        self.__pending = {}                 # (事件类型, 合并键) -> 队列中的_Slot
+        self.__dropped = 0                  # 被合并掉的事件数
+
+    #----------------------------------------------------------------------
+    def laneOf(self, type_):
+        """事件类型对应的通道"""
+        try:
+            return self.__laneCache[type_]
+        except KeyError:
+            pass
+        lane = self.__lanes.get(type_)
+        if lane is None:
+            # 前缀匹配，取最长的前缀
+            prefixes = [key for key in self.__lanes
+                        if key.endswith('.') and type_.startswith(key)]
+            if prefixes:
+                lane = self.__lanes[max(prefixes, key=len)]
+            else:
+                lane = self.__default
+        self.__laneCache[type_] = lane
+        return lane
+
+    #----------------------------------------------------------------------
+    def put(self, event):
+        """存入事件"""
+        lane = self.laneOf(event.type_)
+        key = self.__conflate(event) if self.__conflate else None
+        with self.__cond:
+            if key is not None:
+                key = (event.type_, key)
+                slot = self.__pending.get(key)
+                if slot is not None:
+                    # 尚未处理的旧事件直接替换为新事件
+                    slot.event = event
+                    self.__dropped += 1
+                    return
+                slot = self.__pending[key] = _Slot(key, event)
+                event = slot
+            queue = self.__queues[lane]
+            queue.append(event)
+            self.__size += 1
+            self.__total[lane] += 1
+            if len(queue) > self.__peak[lane]:
+                self.__peak[lane] = len(queue)
+            self.__cond.notify()
+
+    #----------------------------------------------------------------------
+    def get(self, block=True, timeout=None):
+        """取出一个事件，没有事件时抛出Empty"""
+        events = self.drain(1, timeout if block else 0)
+        if not events:
+            raise Empty
+        return events[0]
+
+    #----------------------------------------------------------------------
+    def drain(self, n, timeout=None):
+        """
+        取出最多n个事件，按通道优先级排列
+        队列为空时最多等待timeout秒，超时返回空列表
+        """
+        with self.__cond:
+            if not self.__size:
+                if timeout is None:
+                    while not self.__size:
+                        self.__cond.wait()
+                elif timeout > 0:
+                    end = time() + timeout
+                    while not self.__size:
+                        remain = end - time()
+                        if remain <= 0:
+                            break
+                        self.__cond.wait(remain)
+                if not self.__size:
+                    return []
+
+            events = []
+            pending = self.__pending
+            for queue in self.__queues:
+                while queue and len(events) < n:
+                    event = queue.popleft()
+                    if event.__class__ is _Slot:
+                        del pending[event.key]
+                        event = event.event
+                    events.append(event)
+                if len(events) >= n:
+                    break
+            self.__size -= len(events)
+            return events
+
+    #----------------------------------------------------------------------
+    def qsize(self):
+        """队列中的事件总数"""
+        return self.__size
+
+    #----------------------------------------------------------------------
+    def empty(self):
+        return not self.__size
+
+    #----------------------------------------------------------------------
+    def dropped(self):
+        """被合并掉（未处理即被新事件替换）的事件数"""
+        return self.__dropped
+
+    #----------------------------------------------------------------------
+    def depth(self):
+        """
+        各通道的积压情况
+        返回{通道: (当前积压数, 最大积压数, 累计存入数)}
+        """
+        with self.__cond:
+            return dict((lane, (len(queue), self.__peak[lane], self.__total[lane]))
+                        for lane, queue in enumerate(self.__queues))
+
+
+########################################################################
+class ShardPool(object):
+    """
+    按键分片的工作线程池
+
+    每个工作线程有自己的先进先出队列，事件按hash(键) % 线程数分配，
+    所以同一个键的事件总是在同一个线程中按存入顺序处理。
+    """
+
+    #----------------------------------------------------------------------
+    def __init__(self, workers, name='EventWorker'):
+        """Constructor"""
+        self.__queues = [Queue() for _ in range(workers)]
+        self.__threads = [Thread(target=self.__run, args=(queue,), name='%s-%d' % (name, i))
+                          for i, queue in enumerate(self.__queues)]
+        for thread in self.__threads:
+            thread.daemon = True
+
+    #----------------------------------------------------------------------
+    def __run(self, queue):
+        """工作线程：依次调用处理函数，收到None时退出"""
+        while True:
+            task = queue.get()
+            if task is None:
+                break
+            handlers, event = task
+            for handler in handlers:
+                try:
+                    handler(event)
+                except Exception:
+                    # 单个处理函数出错不影响工作线程
+                    import traceback
+                    traceback.print_exc()
+
+    #----------------------------------------------------------------------
+    def start(self):
+        for thread in self.__threads:
+            thread.start()
+
+    #----------------------------------------------------------------------
+    def stop(self):
+        """处理完已分配的事件后停止"""
+        for queue in self.__queues:
+            queue.put(None)
+        for thread in self.__threads:
+            thread.join()
+
+    #----------------------------------------------------------------------
+    def submit(self, key, handlers, event):
+        """把事件交给键对应的工作线程，由handlers依次处理"""
+        self.__queues[hash(key) % len(self.__queues)].put((handlers, event))
+
+    #----------------------------------------------------------------------
+    def depth(self):
+        """各工作线程的积压事件数"""
+        return [queue.qsize() for queue in self.__queues]
+
+
+#----------------------------------------------------------------------
+def test():
+    """测试函数：行情事件积压时委托事件仍然优先取出"""
+    from threading import Thread
+    from time import sleep
+
+    class Event:
+        def __init__(self, type_, data=None):
+            self.type_ = type_
+            self.data = data
+
+    q = LaneQueue({'eOrder': LANE_HIGH, 'eMarketData.': LANE_LOW})
+    for i in range(1000):
+        q.put(Event('eMarketData.%06d' % i))
+    q.put(Event('eOrder'))
+    print(u'第一个取出的事件：%s' % q.get().type_)
+    print(u'各通道积压：%s' % q.depth())
+
+    # 批量取出
+    start = time()
+    count = 0
+    while True:
+        events = q.drain(100, 0)
+        if not events:
+            break
+        count += len(events)
+    print(u'批量取出%d个事件，耗时%.2fms' % (count, (time() - start) * 1000))
+
+    # 空队列等待
+    def producer():
+        sleep(0.2)
+        q.put(Event('eTimer'))
+    Thread(target=producer).start()
+    print(u'等待取出：%s' % [e.type_ for e in q.drain(10, 1)])
+
+    # 行情合并：同一合约只保留最新的行情
+    q = LaneQueue({'eMarketData': LANE_LOW}, conflate=lambda e: e.data[0])
+    for i in range(100):
+        q.put(Event('eMarketData', ('%06d' % (i % 5), i)))
+    print(u'合并后：%s，合并掉%d个' % ([e.data for e in q.drain(100, 0)], q.dropped()))
+
+
+# 直接运行脚本可以进行测试
+if __name__ == '__main__':
+    test()
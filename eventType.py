@@ -19,6 +19,7 @@ EVENT_TDLOGIN = 'eTdLogin'                  # 交易服务器登录成功事件
 
 EVENT_MARKETDATA = 'eMarketData'            # 行情推送事件
 EVENT_MARKETDATA_CONTRACT = 'eMarketData.'  # 特定合约的行情事件
+EVENT_BAR = 'eBar'                          # K线完成事件
 
 EVENT_TRADE = 'eTrade'                      # 成交推送事件
 EVENT_TRADE_CONTRACT = 'eTrade.'            # 特定合约的成交事件
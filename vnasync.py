@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+@version: v1.0
+@author: sunlei
+@license: Apache Licence
+@contact: 12166056@qq.com
+@site: http://blog.csdn.net/sunlei213
+@software: PyCharm Community Edition
+@file: vnasync.py
+@time: 2017/10/28 16:20
+
+MdApi/TdApi的asyncio版本，配合asyncEngine.AsyncEventEngine使用。
+
+请求队列不再由单独的线程轮询，放入请求时直接安排在事件循环中处理；
+行情库、回报库的定时读取作为引擎的定时任务运行，读取间隔由各自的poller决定，
+读取dbf会阻塞，在线程池中执行，读到的行情、回报再交给事件循环线程；
+poller.wake()（如下单、撤单后）提前结束定时任务的等待，立即读取回报。
+exit时取消任务即可，不需要等待线程超时退出。
+"""
+from asyncEngine import Waker
+from vncast import MdApi, TdApi
+
+
+class _LoopQueue(object):
+    """替代请求队列：put时把请求交给事件循环线程处理"""
+
+    def __init__(self, engine, handler):
+        self._engine = engine
+        self._handler = handler
+
+    def put(self, req):
+        self._engine.call(self._handler, req)
+
+
+class AsyncMdApi(MdApi):
+    """行情处理类（asyncio版本）"""
+
+    def __init__(self, engine):
+        super(AsyncMdApi, self).__init__()
+        self._engine = engine
+        self._tasks = []
+        self.reqQueue = _LoopQueue(engine, self.handle_req)
+        self._req_thread = None
+        self._hq_prices_thread = None
+        self._waker = Waker(engine)
+        self.poller.waker = self._waker.wake
+
+    def _start_workers(self):
+        """定时读取行情库"""
+        self._engine.call(self._schedule)
+
+    def _schedule(self):
+        self._tasks.append(self._engine.repeat(self.poll_cycle, executor=True, waker=self._waker))
+
+    def _stop_workers(self):
+        self._engine.call(self._cancel)
+
+    def _cancel(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+
+class AsyncTdApi(TdApi):
+    """交易处理类（asyncio版本）"""
+
+    def __init__(self, engine):
+        super(AsyncTdApi, self).__init__()
+        self._engine = engine
+        self._tasks = []
+        self.reqQueue = _LoopQueue(engine, self.handle_req)
+        self._req_thread = None
+        self._events_thread = None
+        self._waker = Waker(engine)
+        self.poller.waker = self._waker.wake
+
+    def _start_workers(self):
+        # 请求直接在事件循环中处理，不需要处理线程
+        pass
+
+    def _start_events(self):
+        """定时读取回报库"""
+        self._engine.call(self._schedule)
+
+    def _schedule(self):
+        self._tasks.append(self._engine.repeat(self.poll_cycle, executor=True, waker=self._waker))
+
+    def _stop_workers(self):
+        self._engine.call(self._cancel)
+
+    def _cancel(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
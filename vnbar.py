@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+@version: v1.0
+@author: sunlei
+@license: Apache Licence
+@contact: 12166056@qq.com
+@site: http://blog.csdn.net/sunlei213
+@software: PyCharm Community Edition
+@file: vnbar.py
+@time: 2017/11/02 21:10
+
+由tick行情合成K线（VtBarData）。
+
+每只证券保存当前的1分钟K线，每笔tick只更新开高低收和成交量；
+1分钟K线结束时再合成N分钟K线，N分钟K线不跨越午休。
+行情中的volume（s11）是当天累计成交量，K线成交量取相邻两笔之差。
+"""
+from collections import deque
+from datetime import datetime, timedelta
+
+from eventEngine import Event
+from eventType import EVENT_MARKETDATA, EVENT_TIMER, EVENT_BAR
+from vtobject import VtBarData
+
+# 交易时段（当天的分钟数）
+_OPEN = 9 * 60 + 30  # 9:30
+_PRE_OPEN = 9 * 60 + 15  # 9:15集合竞价，成交计入9:30的K线
+_NOON = 11 * 60 + 30  # 11:30
+_AFTERNOON = 13 * 60  # 13:00
+_CLOSE = 15 * 60  # 15:00
+
+
+def bar_minute(dt):
+    """
+    tick所属的1分钟K线（当天的分钟数），不在交易时段内返回None
+    集合竞价计入9:30，11:30和15:00收盘时刻的行情计入前一分钟
+    """
+    minute = dt.hour * 60 + dt.minute
+    if _OPEN <= minute < _NOON or _AFTERNOON <= minute < _CLOSE:
+        return minute
+    if _PRE_OPEN <= minute < _OPEN:
+        return _OPEN
+    if minute == _NOON or minute == _CLOSE:
+        return minute - 1
+    return None
+
+
+def _session_start(minute):
+    return _OPEN if minute < _NOON else _AFTERNOON
+
+
+def _is_session_end(minute):
+    """是否为上午或下午的最后一分钟"""
+    return minute == _NOON - 1 or minute == _CLOSE - 1
+
+
+class _BarState(object):
+    """一只证券正在合成的K线"""
+
+    __slots__ = ('last_volume', 'carry', 'minute', 'bar', 'bars')
+
+    def __init__(self):
+        self.last_volume = None  # 上一笔tick的累计成交量
+        self.carry = 0  # K线完成后才到的成交量，计入下一根K线
+        self.minute = None  # 当前1分钟K线（日期, 分钟数）
+        self.bar = None
+        self.bars = {}  # 周期 -> 正在合成的N分钟K线
+
+
+class BarGenerator(object):
+    """
+    K线合成器
+
+    on_bar：K线完成时的回调on_bar(bar, minutes)
+    minutes：合成的周期（分钟），1分钟总是合成
+    history：每只证券每个周期在内存中保留的K线数
+    grace：1分钟结束后再等待的秒数，等收盘时刻的最后一笔行情
+    """
+
+    def __init__(self, on_bar=None, minutes=(1,), history=240, grace=3):
+        self.on_bar = on_bar
+        self.minutes = tuple(sorted(set(minutes) | {1}))
+        self.history = history
+        self.grace = grace
+        self._states = {}  # vtSymbol -> _BarState
+        self._bars = {}  # (vtSymbol, 周期) -> deque
+
+    def bars(self, vtSymbol, minutes=1):
+        """已完成的K线，按时间先后排列"""
+        return list(self._bars.get((vtSymbol, minutes), ()))
+
+    def update_tick(self, tick):
+        """输入VtTickData"""
+        self.update(tick.vtSymbol, tick.datetime, tick.lastPrice, tick.volume,
+                    tick.symbol, tick.exchange)
+
+    def update(self, vtSymbol, dt, price, volume, symbol='', exchange=''):
+        """输入一笔行情：时间、最新价、当天累计成交量"""
+        state = self._states.get(vtSymbol)
+        if state is None:
+            state = self._states[vtSymbol] = _BarState()
+        minute = bar_minute(dt)
+        last_volume = state.last_volume
+        if state.minute is not None and state.minute[0] != dt.date():
+            # 新的交易日，累计成交量重新开始
+            last_volume = None
+            state.carry = 0
+        state.last_volume = volume
+        if minute is None or price <= 0:
+            return
+        if last_volume is None:
+            # 当天第一笔：开盘K线计入集合竞价的成交，盘中启动时无法得知之前的成交
+            delta = volume if minute == _OPEN else 0
+        else:
+            delta = max(volume - last_volume, 0)
+
+        key = (dt.date(), minute)
+        if state.minute is not None and key < state.minute:
+            # 迟到的行情，所属的K线已经完成，成交量计入正在合成的K线
+            if state.bar is not None:
+                state.bar.volume += delta
+            else:
+                state.carry += delta
+            return
+        if key != state.minute:
+            if state.bar is not None:
+                self._finish(vtSymbol, state)
+            bar = VtBarData()
+            bar.vtSymbol = vtSymbol
+            bar.symbol = symbol
+            bar.exchange = exchange
+            bar.open = bar.high = bar.low = bar.close = price
+            bar.datetime = dt.replace(hour=minute // 60, minute=minute % 60, second=0, microsecond=0)
+            bar.date = bar.datetime.strftime('%Y%m%d')
+            bar.time = bar.datetime.strftime('%H:%M:%S')
+            bar.volume = delta + state.carry
+            state.carry = 0
+            state.minute = key
+            state.bar = bar
+            return
+
+        bar = state.bar
+        if bar is None:
+            # 本分钟的K线已由计时器完成（如11:30、15:00收盘时刻的行情），成交量计入下一根K线
+            state.carry += delta
+            return
+        if price > bar.high:
+            bar.high = price
+        elif price < bar.low:
+            bar.low = price
+        bar.close = price
+        bar.volume += delta
+
+    def check(self, now=None):
+        """完成已经结束的1分钟K线（由计时器调用，没有新行情时K线也能按时完成）"""
+        now = now or datetime.now()
+        for vtSymbol, state in list(self._states.items()):
+            bar = state.bar
+            if bar is not None and now >= bar.datetime + timedelta(minutes=1, seconds=self.grace):
+                self._finish(vtSymbol, state)
+
+    def _finish(self, vtSymbol, state):
+        bar = state.bar
+        minute = state.minute[1]
+        state.bar = None
+        self._emit(vtSymbol, bar, 1)
+        for n in self.minutes[1:]:
+            nbar = state.bars.get(n)
+            if nbar is None:
+                nbar = state.bars[n] = _copy_bar(bar)
+            else:
+                if bar.high > nbar.high:
+                    nbar.high = bar.high
+                if bar.low < nbar.low:
+                    nbar.low = bar.low
+                nbar.close = bar.close
+                nbar.volume += bar.volume
+            # 到周期末或上午、下午的最后一分钟时完成，不跨越午休
+            if (minute - _session_start(minute) + 1) % n == 0 or _is_session_end(minute):
+                del state.bars[n]
+                self._emit(vtSymbol, nbar, n)
+
+    def _emit(self, vtSymbol, bar, minutes):
+        key = (vtSymbol, minutes)
+        history = self._bars.get(key)
+        if history is None:
+            history = self._bars[key] = deque(maxlen=self.history)
+        history.append(bar)
+        if self.on_bar is not None:
+            self.on_bar(bar, minutes)
+
+
+def _copy_bar(bar):
+    nbar = VtBarData()
+    nbar.__dict__.update(bar.__dict__)
+    return nbar
+
+
+########################################################################
+class BarEngine(object):
+    """
+    在事件引擎上合成K线：监听行情事件，K线完成时发出EVENT_BAR事件
+    事件的dict_['data']为VtBarData，dict_['minutes']为周期
+    """
+
+    #----------------------------------------------------------------------
+    def __init__(self, eventEngine, minutes=(1, 5), history=240):
+        self.eventEngine = eventEngine
+        self.generator = BarGenerator(self.onBar, minutes, history)
+        eventEngine.register(EVENT_MARKETDATA, self.onTick)
+        eventEngine.register(EVENT_TIMER, self.onTimer)
+
+    #----------------------------------------------------------------------
+    def onTick(self, event):
+        self.generator.update_tick(event.dict_['data'])
+
+    #----------------------------------------------------------------------
+    def onTimer(self, event):
+        self.generator.check()
+
+    #----------------------------------------------------------------------
+    def onBar(self, bar, minutes):
+        event = Event(type_=EVENT_BAR)
+        event.dict_['data'] = bar
+        event.dict_['minutes'] = minutes
+        self.eventEngine.put(event)
+
+    #----------------------------------------------------------------------
+    def bars(self, vtSymbol, minutes=1):
+        return self.generator.bars(vtSymbol, minutes)
+
+
+# ----------------------------------------------------------------------
+def test():
+    """用模拟行情测试：跨越午休的5分钟K线、累计成交量差分"""
+    def on_bar(bar, minutes):
+        if minutes == 5:
+            print(u'{0}分钟 {1} {2} 开{3} 高{4} 低{5} 收{6} 量{7}'.format(
+                minutes, bar.vtSymbol, bar.time, bar.open, bar.high, bar.low, bar.close, bar.volume))
+
+    gen = BarGenerator(on_bar, minutes=(5,))
+    start = datetime(2017, 11, 2, 11, 20)
+    volume = 0
+    for i in range(0, 11 * 60 + 10, 3):
+        dt = start + timedelta(seconds=i)
+        volume += 100
+        gen.update('600000.SH', dt, 10.0 + (i % 60) / 100.0, volume)
+    start = datetime(2017, 11, 2, 13, 0)
+    for i in range(0, 10 * 60, 3):
+        volume += 100
+        gen.update('600000.SH', start + timedelta(seconds=i), 10.5, volume)
+    gen.check(start + timedelta(minutes=11))
+    print(u'1分钟K线数：{0}'.format(len(gen.bars('600000.SH'))))
+
+    # 计时器完成K线后才到的行情，成交量不丢失
+    gen = BarGenerator()
+    close = datetime(2017, 11, 2, 11, 29, 50)
+    gen.update('600000.SH', close, 10.0, 1000)
+    gen.check(close + timedelta(seconds=20))
+    gen.update('600000.SH', close + timedelta(seconds=15), 10.0, 1500)
+    gen.update('600000.SH', datetime(2017, 11, 2, 13, 0, 3), 10.0, 1600)
+    gen.check(datetime(2017, 11, 2, 13, 2))
+    bars = gen.bars('600000.SH')
+    print(u'收盘后到的成交量计入下一根K线：{0}'.format([(bar.time, bar.volume) for bar in bars]))
+
+
+# 直接运行脚本可以进行测试
+if __name__ == '__main__':
+    test()
@@ -18,12 +18,41 @@ from queue import Queue, Empty
 from threading import Thread
 from time import sleep
 from datetime import datetime
-from collections import defaultdict, OrderedDict
+from collections import defaultdict
 import dbf
+import numpy as np
+from vndbf import DbfChangeReader, DbfTailReader, DbfAppender, Checkpoint, open_columns
+from vnmkt import MktParser, MktSnapshot
+from vnquote import TickHistory, BID_FIELDS, ASK_FIELDS
+from vnshm import SharedQuoteTable, SHM_NAME, SHM_FIELDS
+from vnorder import OrderBook, OrderWriter
+from vnstat import OrderLatencyLedger
+from vnsession import AdaptivePoller, TradingCalendar
 from vtobject import *
-import copy
 from random import randint
-from decimal import Decimal
+
+# show2003.dbf字段与tick字段的对应关系
+SH_TICK_FIELDS = (
+    ('lastPrice', 's8'), ('volume', 's11'), ('openPrice', 's4'),
+    ('highPrice', 's6'), ('lowPrice', 's7'), ('preClosePrice', 's3'),
+    # LTS有5档行情
+    ('buyPrice1', 's9'), ('buyVolume1', 's15'), ('sellPrice1', 's10'), ('sellVolume1', 's21'),
+    ('buyPrice2', 's16'), ('buyVolume2', 's17'), ('sellPrice2', 's22'), ('sellVolume2', 's23'),
+    ('buyPrice3', 's18'), ('buyVolume3', 's19'), ('sellPrice3', 's24'), ('sellVolume3', 's25'),
+    ('buyPrice4', 's26'), ('buyVolume4', 's27'), ('sellPrice4', 's30'), ('sellVolume4', 's31'),
+    ('buyPrice5', 's28'), ('buyVolume5', 's29'), ('sellPrice5', 's32'), ('sellVolume5', 's33'),
+)
+
+# 写入行情历史的tick字段，顺序与vnquote.TICK_FIELDS（时间之后）一致
+HISTORY_KEYS = (('lastPrice', 'volume') +
+                tuple('buy{0}{1}'.format(kind, i) for i in range(1, 6) for kind in ('Price', 'Volume')) +
+                tuple('sell{0}{1}'.format(kind, i) for i in range(1, 6) for kind in ('Price', 'Volume')))
+
+# 写入共享行情表的tick字段，顺序与vnshm.SHM_FIELDS一致，None为行情库中没有的字段
+_SHM_NAMES = dict(zip(BID_FIELDS + ASK_FIELDS, HISTORY_KEYS[2:]))
+_SHM_NAMES.update({'preClose': 'preClosePrice', 'open': 'openPrice', 'high': 'highPrice',
+                   'low': 'lowPrice', 'last': 'lastPrice', 'volume': 'volume'})
+SHM_TICK_KEYS = tuple(_SHM_NAMES.get(name) for name in SHM_FIELDS)
 
 
 class MdApi(object):  # 行情处理类
@@ -31,24 +60,30 @@ class MdApi(object):  # 行情处理类
     DEBUG = True
 
     def __init__(self):
-        self._sh_db = None
         self._sz_db = None
-        self.interval = 1  # 每次请求的间隔等待
+        self._sh_reader = None  # 上海行情库增量读取
+        self._sh_today = ''  # 行情日期
+        self._sh_time = ''  # 行情时间
+        self.poller = AdaptivePoller(fast=0.1, slow=2.0, calendar=TradingCalendar())  # 行情库读取间隔
         self.active = False  # API工作状态
         self._is_reqhq = False  # 是否开始发送行情
         self.reqID = 0  # 请求编号
         self._hq_dict = dict()
-        self.interval = 2  # 每次请求的间隔等待
+        self.history = TickHistory()  # 订阅证券的最近行情（vtSymbol -> TickBuffer）
+        self.shared = None  # 共享内存行情表，供其他进程读取
         self.subSymbols = defaultdict(set)  # 订阅代码表
         self.reqQueue = Queue()  # 请求队列
         self._req_thread = Thread(target=self.process_queue)  # 请求处理线程
         self._hq_prices_thread = Thread(target=self.process_prices)  # 实时行情线程
         # 合约字典（保存合约查询数据）
         self._codepage = 'cp936'
+        self.mtk_file = ''  # 上交所mktdt00.txt路径
+        self._mkt_parser = MktParser()
+        self._mkt = MktSnapshot()  # mktdt00.txt行情快照
 
     def init(self, db_path):
         try:
-            self._sh_db = dbf.Table(db_path['SH'], codepage=self._codepage)
+            self._sh_reader = DbfChangeReader(db_path['SH'], self._codepage)
             # self._sz_db = dbf.Table(db_path['SZ'])
         except KeyError:
             log = VtLogData()
@@ -57,15 +92,26 @@ class MdApi(object):  # 行情处理类
             self.onLog(log)
             return
         self.active = True
+        self._start_workers()
+        self.on_inited()
+
+    def _start_workers(self):
+        """启动请求处理和行情线程"""
         self._req_thread.start()
         self._hq_prices_thread.start()
-        self.on_inited()
+
+    def _stop_workers(self):
+        self._req_thread.join()
 
     def exit(self):
         if self.active:
             self.active = False
             self._is_reqhq = False
-            self._req_thread.join()
+            self.poller.wake()
+            self._stop_workers()
+            if self.shared is not None:
+                self.shared.close()
+                self.shared = None
             log = VtLogData()
             log.gatewayName = 'CastMdApi'
             log.logContent = u'Api结束'
@@ -76,125 +122,124 @@ class MdApi(object):  # 行情处理类
         while self.active:
             try:
                 req = self.reqQueue.get(block=True, timeout=1)  # 获取请求的阻塞为一秒
-                callback = req['callback']
-                reqID = req['reqID']
+            except Empty:
+                continue
+            self.handle_req(req)
 
-                error = req.get('error', {})
+    def handle_req(self, req):
+        """处理一个请求"""
+        callback = req['callback']
+        reqID = req['reqID']
 
-                # 请求失败
+        error = req.get('error', {})
 
-                if 'error_code' in error:
-                    error1 = u'请求出错，错误代码：%s' % error['error_code']
-                    self.onError(error1, 0, True)
-                # 请求成功
-                else:
-                    if self.DEBUG:
-                        print(callback.__name__)
-                    callback(req, reqID)
+        # 请求失败
 
-                    # 流控等待
-                    # sleep(self.interval)
+        if 'error_code' in error:
+            error1 = u'请求出错，错误代码：%s' % error['error_code']
+            self.onError(error1, 0, True)
+        # 请求成功
+        else:
+            if self.DEBUG:
+                print(callback.__name__)
+            callback(req, reqID)
 
-            except Empty:
-                pass
+            # 流控等待
+            # sleep(self.interval)
 
     def process_prices(self):
         """获取价格推送"""
 
         while self.active:
-            # 首先获取上海市场的行情
-            if self._is_reqhq:
+            # 有变化时马上再读，空闲时逐渐放慢
+            self.poller.wait(self.poll_prices())
+
+    def poll_cycle(self):
+        """读取一次行情库，返回下次读取前的等待时间"""
+        return self.poller.next_interval(self.poll_prices())
+
+    def poll_prices(self):
+        """读取一次行情库并推送变化的行情，返回是否有变化"""
+        # 首先获取上海市场的行情
+        if self._is_reqhq:
+            try:
+                # 只取与上次相比发生变化的记录号
+                changed = self._sh_reader.poll()
+            except Exception as e:
+                self.onError('打开上海行情库失败,错误信息：{0}'.format(str(e)), 0, True)
+                changed = []
+            if changed:
                 try:
-                    self._sh_db.open()
-                    hq_list = [rec for rec in self._sh_db]
-                    self._sh_db.close()
+                    self.update_prices(self._sh_reader.columns(), changed)
                 except Exception as e:
-                    self.onError('打开上海行情库失败,错误信息：{0}'.format(str(e)), 0, True)
-                    hq_list = []
-                sh_time = ''
-                today = ''
-                now_time = datetime.now()
-                for n, record in enumerate(hq_list):
-                    tick = dict()
-                    if len(record):
-                        if n == 0:
-                            today = str(int(record.s6))
-                            time1 = record.s2.strip()
-                            sh_time = '{0}:{1}:{2}'.format(
-                                time1[:2], time1[2:4], time1[-2:])
-                            continue
-                        if dbf.is_deleted(record):
-                            continue
-                        tick['TradingDay'] = today
-                        tick['UpdateTime'] = sh_time
-                        tick['datetime'] = now_time
-                        tick['symbol'] = record.s1.strip()
-                        tick['exchange'] = 'SH'
-                        tick['vtSymbol'] = '.'.join([tick['symbol'], 'SH'])
-
-                        tick['lastPrice'] = record.s8
-                        tick['volume'] = record.s11
-                        tick['openPrice'] = record.s4
-                        tick['highPrice'] = record.s6
-                        tick['lowPrice'] = record.s7
-                        tick['preClosePrice'] = record.s3
-
-                        # LTS有5档行情
-                        tick['buyPrice1'] = record.s9
-                        tick['buyVolume1'] = record.s15
-                        tick['sellPrice1'] = record.s10
-                        tick['sellVolume1'] = record.s21
-
-                        tick['buyPrice2'] = record.s16
-                        tick['buyVolume2'] = record.s17
-                        tick['sellPrice2'] = record.s22
-                        tick['sellVolume2'] = record.s23
-
-                        tick['buyPrice3'] = record.s18
-                        tick['buyVolume3'] = record.s19
-                        tick['sellPrice3'] = record.s24
-                        tick['sellVolume3'] = record.s25
-
-                        tick['buyPrice4'] = record.s26
-                        tick['buyVolume4'] = record.s27
-                        tick['sellPrice4'] = record.s30
-                        tick['sellVolume4'] = record.s31
-
-                        tick['buyPrice5'] = record.s28
-                        tick['buyVolume5'] = record.s29
-                        tick['sellPrice5'] = record.s32
-                        tick['sellVolume5'] = record.s33
-                        if record.s1.strip() in self.subSymbols['SH']:
-                            req = dict()
-                            req['callback'] = self.on_send_mkt_data
-                            req['reqID'] = 0
-                            req['data'] = tick
-                            self.reqQueue.put(req)
-                        self._hq_dict[tick['vtSymbol']] = tick
-                    if not self.active:
-                        break
-            # 获取深圳行情
-
-            # 流量控制
-            sleep(self.interval)
-            pass
-
-    def record_strip(self, recodes):
-        for recode in recodes:
-            re = [value.strip() for value in recode]
-            yield re
+                    self.onError('解析上海行情库失败,错误信息：{0}'.format(str(e)), 0, True)
+            return bool(changed)
+        # 获取深圳行情
+        return False
+
+    def update_prices(self, cols, changed):
+        """按列解码变化的记录并推送行情"""
+        if changed[0] == 0:
+            # 首条记录保存行情日期和时间，每次快照都会变化
+            self._sh_today = str(int(cols.number('s6', [0])[0]))
+            time1 = cols.text('s2', [0])[0]
+            self._sh_time = '{0}:{1}:{2}'.format(
+                time1[:2], time1[2:4], time1[-2:])
+            changed = changed[1:]
+        rows = np.asarray(changed, dtype=np.int64)
+        rows = rows[~cols.deleted[rows]]
+        symbols = cols.text('s1', rows)
+        values = [(key, cols.number(name, rows).tolist()) for key, name in SH_TICK_FIELDS]
+        now_time = datetime.now()
+        stamp = now_time.timestamp()
+        history = self.history
+        for i, symbol in enumerate(symbols):
+            tick = dict()
+            tick['TradingDay'] = self._sh_today
+            tick['UpdateTime'] = self._sh_time
+            tick['datetime'] = now_time
+            tick['symbol'] = symbol
+            tick['exchange'] = 'SH'
+            tick['vtSymbol'] = '.'.join([symbol, 'SH'])
+            for key, col in values:
+                tick[key] = col[i]
+            if symbol in self.subSymbols['SH']:
+                req = dict()
+                req['callback'] = self.on_send_mkt_data
+                req['reqID'] = 0
+                req['data'] = tick
+                self.reqQueue.put(req)
+            self._hq_dict[tick['vtSymbol']] = tick
+            if tick['vtSymbol'] in history:
+                history.append(tick['vtSymbol'], [stamp] + [tick[key] for key in HISTORY_KEYS])
+            if not self.active:
+                break
+        if self.shared is not None:
+            self.publish_shared(symbols, dict(values), stamp)
+
+    def share_quotes(self, name=SHM_NAME, capacity=16384):
+        """创建共享内存行情表，之后读到的行情同时写入，其他进程用SharedQuoteTable.attach读取"""
+        self.shared = SharedQuoteTable.create(name, capacity)
+        return self.shared
+
+    def publish_shared(self, symbols, cols, stamp):
+        """把变化的记录整列写入共享行情表"""
+        table = np.zeros((len(symbols), len(SHM_TICK_KEYS)))
+        for i, key in enumerate(SHM_TICK_KEYS):
+            if key is not None:
+                table[:, i] = cols[key]
+        self.shared.set_time(self._sh_today, self._sh_time)
+        self.shared.update(['.'.join([symbol, 'SH']) for symbol in symbols], table, stamp)
 
     def write_mkt_to_show(self):
         """
-        mkt转show2003
+        读取mktdt00.txt，生成列式行情快照
         :return: True or False
         """
-        first_line = second_line = third_line = ""
         i = 0
         while True:
             try:
-                with open(self.mtk_file) as f:
-                    lines = [x.replace('\n', '').split('|') for x in f]
+                snap = self._mkt_parser.read(self.mtk_file)
                 break
             except IOError as e:
                 print(e.strerror)
@@ -202,101 +247,9 @@ class MdApi(object):  # 行情处理类
                 sleep(randint(1, 100) / 100.00)
                 if i > 3:
                     return False
-        lines = [x for x in self.record_strip(lines)]
-        for i, line in enumerate(lines):
-            if i == 0:
-                first_line = line
-            elif i == 1:
-                second_line = line
-            elif i == 2:
-                third_line = line
-            else:
-                if i == 3:
-                    self._dataMap['000000'] = self.set_first_recode(
-                        first_line, second_line[9], third_line[9], line[9])
-                    self.mkt_to_map(second_line)
-                    self.mkt_to_map(third_line)
-                self.mkt_to_map(line)
+        self._mkt = snap
         return True
 
-    def set_first_recode(self, line, zs_price, ag_price, bg_price):
-        objs = [""] * 30
-        objs[0] = "000000"
-        objs[1] = line[6][9:17].replace(":", "") + "  "
-        objs[2] = float(ag_price)
-        objs[3] = float(bg_price)
-        objs[4] = 0
-        self._jyDate = line[6][0:8]
-        objs[5] = self._jyDate
-        if line[8][0] == "E":
-            objs[10] = 1111111111
-            self._isClose = True
-        else:
-            objs[10] = 0
-            self._isClose = False
-        objs[11] = float(zs_price)
-        objs[12] = int(line[8][2])
-        objs[14] = int(line[8][1])
-        objs.insert(0, True)
-        return objs
-
-    def mkt_to_map(self, records):
-        if len(records) == 0 or records[0] == "TRAILER":
-            return
-        objs = [''] * 30
-        if records[0] == "MD001":
-            objs[0] = records[1]
-            objs[1] = records[2]
-            objs[2] = float(records[5])
-            objs[3] = float(records[6])
-            objs[4] = int(999999999999 if len(str(Decimal(records[4]).quantize(Decimal('1')))) > 12
-                          else Decimal(records[4]).quantize(Decimal('1')))
-            objs[5] = float(records[7])
-            objs[6] = float(records[8])
-            objs[7] = float(records[10] if self._isClose else records[9])
-            objs[10] = int(records[3])
-            objs[11] = True
-        else:
-            objs[0] = records[1]
-            objs[1] = records[2]
-            objs[2] = float(records[5])
-            objs[3] = float(records[6])
-            objs[4] = int(999999999999 if len(str(Decimal(records[4]).quantize(Decimal('1')))) > 12
-                          else Decimal(records[4]).quantize(Decimal('1')))
-            objs[5] = float(records[7])
-            objs[6] = float(records[8])
-            objs[7] = float(records[10] if self._isClose else records[9])
-            objs[8] = float(records[11])
-            objs[9] = float(records[13])
-            objs[10] = int(records[3])
-            st_tmp = records[33] if records[0] == "MD004" else records[31]
-            objs[11] = True if len(st_tmp) < 3 else (
-                not (st_tmp[0] != 'P' and st_tmp[2] == '1'))
-            objs[12] = int(records[12])
-            objs[13] = float(records[15])
-            objs[14] = int(records[16])
-            objs[15] = float(records[19])
-            objs[16] = int(records[20])
-            objs[17] = int(records[14])
-            objs[18] = float(records[17])
-            objs[19] = int(records[18])
-            objs[20] = float(records[21])
-            objs[21] = int(records[22])
-            objs[22] = float(records[23])
-            objs[23] = int(records[24])
-            objs[24] = float(records[27])
-            objs[25] = int(records[28])
-            objs[26] = float(records[25])
-            objs[27] = int(records[26])
-            objs[28] = float(records[29])
-            objs[29] = int(records[30])
-        if objs[11]:
-            objs.insert(0, True)
-        else:
-            objs.insert(0, False)
-        objs[12] = ""
-        self._dataMap[records[1]] = objs
-
     def start(self):
         self._is_reqhq = True
 
@@ -307,6 +260,7 @@ class MdApi(object):  # 行情处理类
         self.subSymbols[rq['exchange']].add(rq['symbol'])
         vsymbol = '.'.join([rq['symbol'], rq['exchange']])
         print(vsymbol)
+        self.history.track(vsymbol)
 
         req = dict()
         req['callback'] = self.on_send_mkt_data
@@ -318,6 +272,7 @@ class MdApi(object):  # 行情处理类
         req = dict()
         if symbol in self.subSymbols[exchange]:
             self.subSymbols[exchange].remove(symbol)
+            self.history.untrack('.'.join([symbol, exchange]))
             req['callback'] = self.on_unsub_symbol
             req['reqID'] = 0
         else:
@@ -332,28 +287,29 @@ class MdApi(object):  # 行情处理类
         hq_stat = self._is_reqhq  # 保存行情更新状态
         self._is_reqhq = False  # 停止行情更新
         try:
-            self._sh_db.open()
-            hq_list = [rec for rec in self._sh_db]
-            self._sh_db.close()
+            cols, mm = open_columns(self._sh_reader.path, self._codepage)
+            symbols = cols.text('s1')
+            names = cols.text('s2')
+            del cols
+            mm.close()
         except Exception as e:
             self.onError('打开上海行情库失败,错误信息：{0}'.format(str(e)), 0, True)
-            hq_list = []
-        for record in hq_list:
+            symbols = names = []
+        for symbol, name in zip(symbols, names):
             tick = VtContractData()
-            if len(record):
-                tick.symbol = record.s1.strip()
-                tick.exchange = 'SH'
-                tick.vtSymbol = '.'.join([tick.symbol, 'SH'])
-                tick.name = record.s2.strip()
-                if tick.symbol[:3] in ['511']:
-                    tick.is_t0 = True
-                req = dict()
-                req['callback'] = self.on_get_instrument
-                req['reqID'] = 0
-                req['data'] = tick
-                req['last'] = False
-                req['ErrorID'] = 0
-                self.reqQueue.put(req)
+            tick.symbol = symbol
+            tick.exchange = 'SH'
+            tick.vtSymbol = '.'.join([tick.symbol, 'SH'])
+            tick.name = name
+            if tick.symbol[:3] in ['511']:
+                tick.is_t0 = True
+            req = dict()
+            req['callback'] = self.on_get_instrument
+            req['reqID'] = 0
+            req['data'] = tick
+            req['last'] = False
+            req['ErrorID'] = 0
+            self.reqQueue.put(req)
         req = dict()
         req['reqID'] = 0
         req['callback'] = self.on_get_instrument
@@ -397,15 +353,19 @@ class TdApi(object):
 
     def __init__(self):
         self._ord_db = None
-        self._hb_db = None
+        self._ord_writer = None  # 委托库批量写入
+        self._hb_reader = None  # 回报库尾部读取
+        self._checkpoint = None  # 回报处理进度存档
         self._zh_db = None
         self._zh_list = dict()
-        self._wt_list = OrderedDict()  # 委托列表
+        self._zh_snaps = dict()  # 账户 -> 最近一次推送的AccountSnapshot
+        self._wt_list = OrderBook()  # 委托列表（按申报编号、账户、证券、可撤状态索引）
         self._cj_list = dict()  # 委托的最后一笔成交
+        self.latency = OrderLatencyLedger()  # 委托延迟台账
         self._client_id = 1000  # 委托起始编号
         self._wt_num = 0  # 委托库起始记录号
         self._cj_num = 0  # 回报库起始记录号
-        self.interval = 1  # 每次请求的间隔等待
+        self.poller = AdaptivePoller(fast=0.05, slow=1.0, calendar=TradingCalendar())  # 回报库读取间隔
         self.active = False  # API工作状态
         self.reqID = 0  # 请求编号
         self.reqQueue = Queue()  # 请求队列
@@ -430,7 +390,8 @@ class TdApi(object):
     def init(self, db_path):
         try:
             self._ord_db = dbf.Table(db_path['Order'], codepage=self._codepage)
-            self._hb_db = dbf.Table(db_path['HB'], codepage=self._codepage)
+            self._hb_reader = DbfTailReader(db_path['HB'], self._codepage)
+            self._checkpoint = Checkpoint(db_path['HB'] + '.ckpt')
             self._zh_db = dbf.Table(db_path['Acct'], codepage=self._codepage)
         except Exception as e:
             log = VtLogData()
@@ -439,16 +400,29 @@ class TdApi(object):
             self.onLog(log)
             return
         self.active = True
-        self._req_thread.start()
+        self._start_workers()
         self.query_acc('', False)
         print(self._zh_list)
         self._client_id += self._get_wt()
+        self._ord_writer = OrderWriter(DbfAppender(db_path['Order'], self._codepage))
+        self._ord_writer.start()
         print(self._zh_list)
         self._get_cj()
         print(self._zh_list)
-        self._events_thread.start()
+        self._start_events()
         self.on_inited()
 
+    def _start_workers(self):
+        """启动请求处理线程"""
+        self._req_thread.start()
+
+    def _start_events(self):
+        """启动回报查询线程"""
+        self._events_thread.start()
+
+    def _stop_workers(self):
+        self._req_thread.join()
+
     def query_acc(self, data, reqID):
         self._zh_db.open()
 
@@ -475,10 +449,22 @@ class TdApi(object):
     def push_zh(self):
         pass
 
+    def account_snapshots(self):
+        """各账户的只读快照，内容没有变化的账户沿用上一次的快照（版本号不变）"""
+        snaps = dict()
+        for acc, zh in list(self._zh_list.items()):
+            snaps[acc] = AccountSnapshot.build(acc, zh, self._zh_snaps.get(acc))
+        self._zh_snaps = snaps
+        return snaps
+
     def exit(self):
         if self.active:
             self.active = False
-            self._req_thread.join()
+            self.poller.wake()
+            self._stop_workers()
+            self._ord_writer.stop()
+            if self.latency.stats()['ack']['count']:
+                print(self.latency.report())
             log = VtLogData()
             log.gatewayName = 'CastTdApi'
             log.logContent = u'Api结束'
@@ -489,24 +475,27 @@ class TdApi(object):
         while self.active:
             try:
                 req = self.reqQueue.get(block=True, timeout=1)  # 获取请求的阻塞为一秒
-                callback = req['callback']
-                reqID = req['reqID']
+            except Empty:
+                continue
+            self.handle_req(req)
 
-                error = req.get('error', {})
+    def handle_req(self, req):
+        """处理一个请求"""
+        callback = req['callback']
+        reqID = req['reqID']
 
-                # 请求失败
+        error = req.get('error', {})
 
-                if 'error_code' in error:
-                    error1 = u'请求出错，错误代码：%s' % error['error_code']
-                    self.onError(error1, req, reqID)
-                # 请求成功
-                else:
-                    if self.DEBUG:
-                        print(callback.__name__, req.get('func', ''))
-                    callback(req, reqID)
+        # 请求失败
 
-            except Empty:
-                pass
+        if 'error_code' in error:
+            error1 = u'请求出错，错误代码：%s' % error['error_code']
+            self.onError(error1, req, reqID)
+        # 请求成功
+        else:
+            if self.DEBUG:
+                print(callback.__name__, req.get('func', ''))
+            callback(req, reqID)
 
     def onError(self, error, n, reqID):
         """错误推送"""
@@ -535,41 +524,42 @@ class TdApi(object):
 
     def process_events(self):
         while self.active:
-            last = False
-            try:
-                self._hb_db.open()
-                rec_num = len(self._hb_db)
-                if self._cj_num < rec_num:
-                    hb_list = [self._hb_db[x]
-                               for x in range(self._cj_num, rec_num)]
-                    self._cj_num = rec_num
-                else:
-                    hb_list = []
-                self._hb_db.close()
+            # 有新回报或未完成的委托时马上再读，空闲时逐渐放慢
+            self.poller.wait(self.poll_events() or self._wt_list.open_count() > 0)
 
-            except Exception as e:
-                self.onError('打开回报库失败,错误信息：{0}'.format(str(e)), 0, 0)
-                hb_list = []
-            for rec in hb_list:
-                last = True
-                req = dict()
-                req['data'] = rec
-                req['last'] = False
-                req['reqID'] = 0
-                req['callback'] = self.on_event
-                self.reqQueue.put(req)
-                if not self.active:
-                    break
-            if last:
-                req = dict()
-                req['data'] = dict()
-                req['last'] = True
-                req['reqID'] = 0
-                req['callback'] = self.on_event
-                self.reqQueue.put(req)
+    def poll_cycle(self):
+        """读取一次回报库，返回下次读取前的等待时间"""
+        return self.poller.next_interval(self.poll_events() or self._wt_list.open_count() > 0)
 
-            # 流控等待
-            sleep(self.interval)
+    def poll_events(self):
+        """读取一次回报库，新的回报放入请求队列，返回是否有新回报"""
+        last = False
+        try:
+            # 只读取上次之后新增的记录
+            hb_list = self._hb_reader.read()
+            self._cj_num = self._hb_reader.cursor
+        except Exception as e:
+            self.onError('打开回报库失败,错误信息：{0}'.format(str(e)), 0, 0)
+            hb_list = []
+        for rec in hb_list:
+            last = True
+            req = dict()
+            req['data'] = rec
+            req['last'] = False
+            req['reqID'] = 0
+            req['callback'] = self.on_event
+            self.reqQueue.put(req)
+            if not self.active:
+                break
+        if last:
+            req = dict()
+            req['data'] = dict()
+            req['last'] = True
+            req['cursor'] = self._cj_num  # 本批回报处理完后的读取进度
+            req['reqID'] = 0
+            req['callback'] = self.on_event
+            self.reqQueue.put(req)
+        return last
 
     def reqQryTradingAccount(self):
         for acc in self._zh_list.keys():
@@ -628,18 +618,24 @@ class TdApi(object):
         elif rec.tradeside.strip() == '2':
             self._zh_list[rec.acct]['stocks'][rec.symbol][0] -= rec.ord_qty
         self._wt_list[str(self._client_id)] = rec
-        self._ord_db.open()
-        self._ord_db.append(rec.ord())
-        self._ord_db.close()
+        self.latency.submit(str(self._client_id), rec.acct, rec.symbol, rec.ord_qty)
+        self._ord_writer.submit(rec.ord())
         self._client_id += 1
+        self.poller.wake()
         rq = dict()
         rq['callback'] = self.on_order
-        rq['data'] = copy.deepcopy(rec)
+        rq['data'] = rec.snapshot()
         rq['reqID'] = 0
         rq['func'] = 'order'
         self.reqQueue.put(rq)
         return self._client_id - 1
 
+    def send_orders(self, reqs, req_id):
+        """批量下单，全部委托一次写入委托库，返回委托编号列表"""
+        ids = [self.order(req, req_id) for req in reqs]
+        self._ord_writer.flush()
+        return ids
+
     def cancel_order(self, req, req_id):
         rec = Order_rec()
         ord_cl = str(req['orderid'])
@@ -656,11 +652,12 @@ class TdApi(object):
         rec.acct = can_rec.acct
         rec.ord_no = can_rec.ord_no
         self._wt_list[str(self._client_id)] = rec
-        self._ord_db.open()
-        self._ord_db.append(rec.ord())
-        self._ord_db.close()
+        self.latency.cancel_submit(ord_cl)
+        self._ord_writer.submit(rec.ord())
         self._client_id += 1
+        self.poller.wake()
         can_rec.can_cancel = False
+        self._wt_list.refresh(ord_cl)
         if can_rec.tradeside == '1':
             self._zh_list[can_rec.acct]['acct']['zjky'] += can_rec.je
         if can_rec.tradeside == '2':
@@ -669,13 +666,15 @@ class TdApi(object):
                 can_rec.ord_qty - can_rec.filled_qty)
         rq = dict()
         rq['callback'] = self.on_order
-        rq['data'] = copy.deepcopy(can_rec)
+        rq['data'] = can_rec.snapshot()
         rq['reqID'] = 0
         rq['func'] = 'cancel_order'
         self.reqQueue.put(rq)
 
     def on_event(self, req, reqid):
         if req['last']:
+            # 一批回报处理完毕，在请求处理线程中保存进度
+            self.save_checkpoint(req.get('cursor', self._cj_num))
             self.on_cj_update()
         else:
             rec = req['data']
@@ -687,18 +686,38 @@ class TdApi(object):
     def on_trade(self, req, req_id):
         pass
 
-    def _get_cj(self):
+    def save_checkpoint(self, cursor):
+        """保存回报处理进度：已处理的回报记录数、委托状态和每笔委托的最后一笔成交"""
+        state = {'date': datetime.now().strftime('%Y%m%d'),
+                 'cursor': cursor,
+                 'wt_list': self._wt_list.to_dict(),
+                 'cj_list': self._cj_list}
         try:
-            self._hb_db.open()
-            rec_num = len(self._hb_db)
-            if self._cj_num < rec_num:
-                hb_list = [self._hb_db[x]
-                           for x in range(self._cj_num, rec_num)]
-                self._cj_num = rec_num
-            else:
-                hb_list = []
-            self._hb_db.close()
+            self._checkpoint.save(state)
+        except Exception as e:
+            self.onError('保存回报进度失败,错误信息：{0}'.format(str(e)), 0, 0)
+
+    def load_checkpoint(self):
+        """读取当天的回报处理进度，恢复委托状态，返回已处理的回报记录数"""
+        state = self._checkpoint.load()
+        if not state or state.get('date') != datetime.now().strftime('%Y%m%d'):
+            return 0
+        if state['cursor'] > self._hb_reader.header.record_count:
+            # 回报库已被重建，存档无效
+            return 0
+        for client_id, order in state['wt_list'].items():
+            # 存档之后才下的委托仍使用委托库中的数据
+            if client_id in self._wt_list:
+                self._wt_list[client_id] = order
+        self._cj_list.update(state['cj_list'])
+        return state['cursor']
 
+    def _get_cj(self):
+        self._cj_num = self.load_checkpoint()
+        self._hb_reader.seek(self._cj_num)
+        try:
+            hb_list = self._hb_reader.read()
+            self._cj_num = self._hb_reader.cursor
         except Exception as e:
             self.onError('打开回报库失败,错误信息：{0}'.format(str(e)), 0, 0)
             hb_list = []
@@ -724,11 +743,15 @@ class TdApi(object):
                     self._wt_cancel(rec)
                 else:
                     self._wt_list[client_id].ord_no = rec.ord_no.strip()
+                    self._wt_list.refresh(client_id)
+                    if rec.ord_no.strip():
+                        self.latency.ack(client_id)
                     if int(rec.filled_qty) > 0:
                         if rec.tradeside.strip() == '1':
                             self._wt_buy(rec, normal)
                         elif rec.tradeside.strip() == '2':
                             self._wt_sell(rec, normal)
+                        self.latency.fill(client_id, int(rec.filled_qty))
                         if normal and rec.tradeside.strip() in ['1', '2']:
                             d = self.get_trade(rec)
                             rq = dict()
@@ -739,8 +762,7 @@ class TdApi(object):
                             self.reqQueue.put(rq)
                             rq = dict()
                             rq['callback'] = self.on_order
-                            rq['data'] = copy.deepcopy(
-                                self._wt_list[client_id])
+                            rq['data'] = self._wt_list[client_id].snapshot()
                             rq['reqID'] = 0
                             rq['func'] = 'update_cj'
                             self.reqQueue.put(rq)
@@ -778,10 +800,12 @@ class TdApi(object):
     def _wt_cancel(self, rec):
         cl_id = rec.client_id.strip()
         ord_no = self._wt_list[cl_id].ord_no
-        for cl_id in self._wt_list.keys():
-            # print(self._wt_list[cl_id],ord_no)
-            if self._wt_list[cl_id].can_cancel and self._wt_list[cl_id].ord_no == ord_no:
-                self._wt_list[cl_id].can_cancel = False
+        for cl_id in self._wt_list.by_ord_no(ord_no):
+            self.latency.cancel(cl_id)
+        # 按申报编号索引查找被撤的委托
+        for cl_id in self._wt_list.open_by_ord_no(ord_no):
+            self._wt_list[cl_id].can_cancel = False
+            self._wt_list.refresh(cl_id)
 
     def _wt_buy(self, rec, normal):
         cl_id = rec.client_id.strip()
@@ -795,6 +819,7 @@ class TdApi(object):
                                                                                      float(rec.avg_px), '', 0.0]
             tmp = self._wt_list[cl_id].update_cj(
                 int(rec.filled_qty), float(rec.avg_px))
+            self._wt_list.refresh(cl_id)
 
             if tmp and self._wt_list[cl_id].je > 0 and normal:
                 self._zh_list[rec.acct.strip(
@@ -809,10 +834,12 @@ class TdApi(object):
                                                                     self._wt_list[cl_id].je)
             self._wt_list[cl_id].update_cj(
                 int(rec.filled_qty), float(rec.avg_px))
+            self._wt_list.refresh(cl_id)
 
     def _wt_err(self, rec, normal):
         cl_id = rec.client_id.strip()
         self._wt_list[cl_id].can_cancel = False
+        self._wt_list.refresh(cl_id)
         if normal:
             if rec.tradeside == '1':
                 self._zh_list[rec.acct.strip(
@@ -0,0 +1,599 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+@version: v1.0
+@author: sunlei
+@license: Apache Licence
+@contact: 12166056@qq.com
+@site: http://blog.csdn.net/sunlei213
+@software: PyCharm Community Edition
+@file: vndbf.py
+@time: 2017/10/20 20:15
+
+直接按字节读取CATS的dbf文件（show2003.dbf等），不经过dbf库逐字段转换。
+
+dbf文件结构：
+    32字节文件头 + 每个字段32字节的字段描述 + 0x0D
+    之后是定长记录，每条记录首字节为删除标志（'*'为已删除）
+    最后一条记录之后有一个0x1A文件结束标志
+
+DbfAppender直接按字节追加记录（委托库instructions.dbf），不经过dbf库。
+"""
+import mmap
+import os
+import pickle
+import struct
+import sys
+from datetime import date
+from time import perf_counter
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+class DbfField(object):
+    """dbf字段描述"""
+
+    def __init__(self, name, type_, offset, length, decimals):
+        self.name = name  # 字段名（小写）
+        self.type_ = type_  # 字段类型 C/N/F/L/D
+        self.offset = offset  # 字段在记录中的偏移（含删除标志字节）
+        self.length = length  # 字段长度
+        self.decimals = decimals  # 小数位数
+
+
+class DbfHeader(object):
+    """dbf文件头"""
+
+    def __init__(self, buf):
+        if len(buf) < 32:
+            raise ValueError(u'dbf文件头不完整')
+        self.version = buf[0]
+        self.record_count, self.header_length, self.record_length = struct.unpack(
+            '<IHH', buf[4:12])
+        self.fields = []
+        offset = 1  # 第一个字节为删除标志
+        pos = 32
+        while pos + 32 <= self.header_length and buf[pos] != 0x0D:
+            desc = buf[pos:pos + 32]
+            name = desc[:11].split(b'\x00')[0].decode('ascii').strip().lower()
+            field = DbfField(name, chr(desc[11]), offset, desc[16], desc[17])
+            self.fields.append(field)
+            offset += field.length
+            pos += 32
+        self.field_names = tuple(f.name for f in self.fields)
+
+    def layout(self):
+        """返回记录格式，用于判断文件结构是否发生变化"""
+        return (self.header_length, self.record_length,
+                tuple((f.name, f.type_, f.length, f.decimals) for f in self.fields))
+
+    def record_offset(self, recno):
+        """第recno条记录在文件中的位置"""
+        return self.header_length + recno * self.record_length
+
+    def dtype(self):
+        """按字段描述生成numpy结构化类型，每个字段保持原始字节（S类型）"""
+        names = ['_deleted'] + [f.name for f in self.fields]
+        formats = ['S1'] + ['S{0}'.format(f.length) for f in self.fields]
+        offsets = [0] + [f.offset for f in self.fields]
+        return np.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+                         'itemsize': self.record_length})
+
+    def decoder(self, codepage='cp936'):
+        """生成记录解码函数：输入一条记录的原始字节，返回字段值列表"""
+        converters = [(f.offset, f.offset + f.length, _converter(f, codepage))
+                      for f in self.fields]
+
+        def decode(raw):
+            return [conv(raw[start:end]) for start, end, conv in converters]
+        return decode
+
+
+def read_header(f):
+    """从文件对象（或mmap）的开头读取dbf文件头"""
+    f.seek(0)
+    head = f.read(32)
+    header_length = struct.unpack('<H', head[8:10])[0]
+    return DbfHeader(head + f.read(header_length - 32))
+
+
+def _converter(field, codepage):
+    """按字段类型生成转换函数，转换结果与dbf库保持一致"""
+    if field.type_ in 'NF':
+        if field.decimals == 0 and field.type_ == 'N':
+            def conv(b):
+                b = b.strip()
+                return int(b) if b and b[:1] != b'*' else 0
+        else:
+            def conv(b):
+                b = b.strip()
+                return float(b) if b and b[:1] != b'*' else 0.0
+    elif field.type_ == 'L':
+        def conv(b):
+            return b in (b'T', b't', b'Y', b'y')
+    else:
+        def conv(b):
+            return b.decode(codepage, 'replace')
+    return conv
+
+
+class DbfRecord(object):
+    """dbf记录，字段可按属性访问（rec.s1、rec.client_id等）"""
+
+    def __init__(self, names, values, deleted=False):
+        self.__dict__.update(zip(names, values))
+        self.deleted = deleted
+
+    def __len__(self):
+        return len(self.__dict__) - 1
+
+
+class DbfChangeReader(object):
+    """
+    增量读取dbf：每次读取时通过mmap映射文件，与上一次的快照逐条比较记录的原始字节，
+    只解码发生变化的记录。
+
+    比较时先按块（chunk条记录）比较，块内有变化时再逐条比较，
+    行情库每次只有少量记录变化，大部分块可以直接跳过。
+    """
+
+    def __init__(self, path, codepage='cp936', chunk=64):
+        self.path = path
+        self._codepage = codepage
+        self._chunk = chunk
+        self._layout = None
+        self._decode = None
+        self._names = ()
+        self._last = b''  # 上一次读取的记录区原始字节
+        self._columns = None
+        self.header = None
+
+    def reset(self):
+        """清除快照，下次读取时返回全部记录"""
+        self._last = b''
+
+    def _snapshot(self):
+        """映射文件并复制出当前的文件头和记录区"""
+        with open(self.path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                header = read_header(mm)
+                size = header.record_count * header.record_length
+                start = header.header_length
+                # 文件正在被改写时记录数可能大于实际长度，只取完整的记录
+                size = min(size, (len(mm) - start) // header.record_length * header.record_length)
+                data = mm[start:start + size]
+            finally:
+                mm.close()
+        return header, data
+
+    def poll(self):
+        """读取新快照，返回新增或内容变化的记录号列表"""
+        header, data = self._snapshot()
+        if header.layout() != self._layout:
+            # 文件结构变化（或首次读取），重新生成解码函数
+            self._layout = header.layout()
+            self._decode = header.decoder(self._codepage)
+            self._names = header.field_names
+            self._last = b''
+        self.header = header
+        rl = header.record_length
+        changed = []
+        last = self._last
+        common = min(len(data), len(last))
+        step = rl * self._chunk
+        for block in range(0, common, step):
+            end = min(block + step, common)
+            if data[block:end] == last[block:end]:
+                continue
+            for pos in range(block, end, rl):
+                if data[pos:pos + rl] != last[pos:pos + rl]:
+                    changed.append(pos // rl)
+        changed.extend(range(common // rl, len(data) // rl))
+        self._last = data
+        self._columns = None
+        return changed
+
+    def columns(self):
+        """当前快照的列视图（不复制数据）"""
+        if self._columns is None:
+            self._columns = DbfColumns(self.header, self._last, self._codepage)
+        return self._columns
+
+    def read(self):
+        """返回[(记录号, DbfRecord)]，只包含新增或内容变化的记录"""
+        records = []
+        changed = self.poll()
+        rl = self.header.record_length
+        for recno in changed:
+            raw = self._last[recno * rl:(recno + 1) * rl]
+            records.append((recno, DbfRecord(self._names, self._decode(raw), raw[:1] == b'*')))
+        return records
+
+
+class DbfTailReader(object):
+    """
+    追加型dbf（order_updates.dbf等）的尾部读取
+
+    只记住已读取的记录数（cursor），每次读取时解析文件头得到当前记录数，
+    按记录长度直接定位到第cursor条记录，只读取新增的记录。
+    """
+
+    def __init__(self, path, codepage='cp936', cursor=0):
+        self.path = path
+        self.cursor = cursor  # 已读取的记录数
+        self._codepage = codepage
+        self._layout = None
+        self._decode = None
+        self._names = ()
+        with open(path, 'rb') as f:
+            self._update_header(read_header(f))
+
+    def _update_header(self, header):
+        if header.layout() != self._layout:
+            self._layout = header.layout()
+            self._decode = header.decoder(self._codepage)
+            self._names = header.field_names
+        self.header = header
+
+    def seek(self, cursor):
+        """设置下次读取的起始记录号"""
+        self.cursor = cursor
+
+    def read(self):
+        """读取新增的记录，返回DbfRecord列表"""
+        with open(self.path, 'rb') as f:
+            header = read_header(f)
+            self._update_header(header)
+            count = header.record_count
+            if count < self.cursor:
+                # 文件被重建（如新的交易日），从头读取
+                self.cursor = 0
+            if count == self.cursor:
+                return []
+            rl = header.record_length
+            f.seek(header.record_offset(self.cursor))
+            data = f.read((count - self.cursor) * rl)
+        # 文件正在写入时只取完整的记录
+        count = len(data) // rl
+        records = []
+        for pos in range(0, count * rl, rl):
+            raw = data[pos:pos + rl]
+            records.append(DbfRecord(self._names, self._decode(raw), raw[:1] == b'*'))
+        self.cursor += count
+        return records
+
+
+class Checkpoint(object):
+    """
+    读取进度的存档文件（pickle），与dbf文件放在一起
+
+    写入时先写临时文件再改名，中途退出也不会留下不完整的存档。
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """读取存档，不存在或已损坏时返回None"""
+        try:
+            with open(self.path, 'rb') as f:
+                return pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            return None
+
+    def save(self, state):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+
+
+# 追加记录后的同步方式
+SYNC_NONE = 'none'  # 不同步，由操作系统决定何时写盘
+SYNC_BATCH = 'batch'  # 每批记录写入后fdatasync
+
+
+def _to_int(value):
+    """整数字段：'100'、'1.00'、100.0都可以"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return int(round(float(value)))
+
+
+def _to_flag(value):
+    if isinstance(value, bytes):
+        value = value.decode('ascii')
+    if isinstance(value, str):
+        return value.strip()[:1] in ('T', 't', 'Y', 'y')
+    return bool(value)
+
+
+def _to_date(value):
+    """日期字段：date/datetime，或'20171101'、'2017-11-01'"""
+    if isinstance(value, bytes):
+        value = value.decode('ascii')
+    if isinstance(value, str):
+        text = value.strip().replace('-', '')
+        if len(text) != 8 or not text.isdigit():
+            raise ValueError(u'日期格式不对：{0!r}'.format(value))
+        return text.encode('ascii')
+    return value.strftime('%Y%m%d').encode('ascii')
+
+
+def _encoder(field, codepage):
+    """按字段类型生成编码函数：输入字段值，返回定长的字节串"""
+    length = field.length
+    if field.type_ in 'NF':
+        if field.decimals == 0 and field.type_ == 'N':
+            fmt = '{0:>%dd}' % length
+
+            def enc(value):
+                return fmt.format(_to_int(value)).encode('ascii')
+        else:
+            fmt = '{0:>%d.%df}' % (length, field.decimals)
+
+            def enc(value):
+                return fmt.format(float(value)).encode('ascii')
+    elif field.type_ == 'L':
+        def enc(value):
+            return b'T' if _to_flag(value) else b'F'
+    elif field.type_ == 'D':
+        enc = _to_date
+    else:
+        def enc(value):
+            if not isinstance(value, bytes):
+                if not isinstance(value, str):
+                    value = str(value)
+                value = value.encode(codepage)
+            if len(value) > length:
+                # 截断时不能留下半个汉字
+                value = value[:length].decode(codepage, 'ignore').encode(codepage)
+            return value.ljust(length)
+    return enc
+
+
+class DbfAppender(object):
+    """
+    定长记录的dbf追加写入（委托库）
+
+    打开时读取文件头，为每个字段生成编码函数，记录模板为全空格；
+    每批记录编码后连同文件结束标志用一次os.write写到文件末尾，
+    再原地改写文件头中的更新日期和记录数。
+    接口与dbf.Table相同（open/close/append），另有append_many整批写入。
+    sync：SYNC_NONE不同步，SYNC_BATCH每批写入后fdatasync
+    """
+
+    def __init__(self, path, codepage='cp936', sync=SYNC_NONE):
+        if sync not in (SYNC_NONE, SYNC_BATCH):
+            raise ValueError(u'不支持的同步方式：{0}'.format(sync))
+        self.path = path
+        self.sync = sync
+        self._codepage = codepage
+        self._fd = None
+        self.header = None
+        self._count = 0
+        self._slots = []  # [(起始位置, 结束位置, 编码函数)]
+        self._template = b''
+
+    def open(self):
+        if self._fd is not None:
+            return
+        fd = os.open(self.path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+        try:
+            head = os.read(fd, 32)
+            header_length = struct.unpack('<H', head[8:10])[0]
+            self.header = DbfHeader(head + os.read(fd, header_length - 32))
+        except Exception:
+            os.close(fd)
+            raise
+        self._fd = fd
+        self._count = self.header.record_count
+        self._slots = [(f.offset, f.offset + f.length, _encoder(f, self._codepage))
+                       for f in self.header.fields]
+        self._template = b' ' * self.header.record_length
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __len__(self):
+        return self._count
+
+    def encode(self, values):
+        """把一条记录（按字段顺序的值，可少于字段数）编码为原始字节"""
+        raw = bytearray(self._template)
+        for (start, end, enc), value in zip(self._slots, values):
+            if value is None or value == '':
+                continue
+            b = enc(value)
+            if len(b) != end - start:
+                raise ValueError(u'字段值超出长度：{0!r}'.format(value))
+            raw[start:end] = b
+        return raw
+
+    def append(self, values):
+        self.append_many([values])
+
+    def append_many(self, records):
+        """
+        追加多条记录：一次写入记录区，再更新文件头的记录数
+        每次写入前重新读取文件头的记录数，不覆盖其他程序（或CATS重置委托库后）写入的记录；
+        有fcntl时写入期间对文件加排他锁，多个进程的DbfAppender依次写入。
+        """
+        if not records:
+            return
+        fd = self._fd
+        if fd is None:
+            raise IOError(u'dbf文件未打开：{0}'.format(self.path))
+        data = b''.join([self.encode(values) for values in records]) + b'\x1a'
+        if fcntl is not None:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+        try:
+            os.lseek(fd, 4, os.SEEK_SET)
+            count = struct.unpack('<I', os.read(fd, 4))[0]
+            os.lseek(fd, self.header.record_offset(count), os.SEEK_SET)
+            os.write(fd, data)
+            count += len(records)
+            today = date.today()
+            os.lseek(fd, 1, os.SEEK_SET)
+            os.write(fd, struct.pack('<BBBI', today.year - 1900, today.month, today.day, count))
+            if self.sync == SYNC_BATCH:
+                getattr(os, 'fdatasync', os.fsync)(fd)
+        finally:
+            if fcntl is not None:
+                fcntl.lockf(fd, fcntl.LOCK_UN)
+        self._count = count
+        self.header.record_count = count
+
+
+class DbfColumns(object):
+    """
+    dbf记录区的列视图
+
+    用numpy结构化类型直接映射记录区（bytes或mmap），各字段以原始字节列的形式访问，
+    数值列按需整列转换，避免逐个单元格生成python对象。
+    """
+
+    def __init__(self, header, buf, codepage='cp936', offset=0):
+        self.header = header
+        self._codepage = codepage
+        self._fields = dict((f.name, f) for f in header.fields)
+        count = min(header.record_count, (len(buf) - offset) // header.record_length)
+        self._table = np.frombuffer(buf, dtype=header.dtype(), count=count, offset=offset)
+
+    def __len__(self):
+        return len(self._table)
+
+    def raw(self, name, rows=None):
+        """原始字节列"""
+        col = self._table[name]
+        return col if rows is None else col[rows]
+
+    @property
+    def deleted(self):
+        """删除标志列"""
+        return self._table['_deleted'] == b'*'
+
+    def number(self, name, rows=None):
+        """数值列，整数字段返回int64，其余返回float64，空值和溢出值（'*****'）为0"""
+        field = self._fields[name]
+        col = self.raw(name, rows)
+        bad = (col == b' ' * field.length) | (col == b'') | (np.char.find(col, b'*') >= 0)
+        if bad.any():
+            col = np.where(bad, b'0', col)
+        if field.type_ == 'N' and field.decimals == 0:
+            try:
+                return col.astype(np.int64)
+            except ValueError:
+                # 整数字段里有'1.00'这样的值，按浮点数解析后取整
+                return np.rint(col.astype(np.float64)).astype(np.int64)
+        return col.astype(np.float64)
+
+    def text(self, name, rows=None):
+        """字符列，返回去掉首尾空格的字符串列表"""
+        codepage = self._codepage
+        return [b.decode(codepage, 'replace').strip() for b in self.raw(name, rows).tolist()]
+
+
+def open_columns(path, codepage='cp936'):
+    """
+    映射整个dbf文件并返回列视图，列数据直接引用mmap，不复制
+    返回(列视图, mmap)，使用完毕后需关闭mmap
+    """
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    header = read_header(mm)
+    return DbfColumns(header, mm, codepage, header.header_length), mm
+
+
+# ----------------------------------------------------------------------
+def benchmark(path, loops=10):
+    """对比dbf库逐条读取和列视图读取show2003.dbf的耗时"""
+    import dbf
+
+    fields = ['s3', 's4', 's6', 's7', 's8', 's9', 's10', 's11', 's15', 's21']
+
+    table = dbf.Table(path, codepage='cp936')
+    start = perf_counter()
+    for _ in range(loops):
+        table.open()
+        hq_list = [rec for rec in table]
+        table.close()
+        quotes = [(rec.s1.strip(), [rec[name] for name in fields])
+                  for rec in hq_list if not dbf.is_deleted(rec)]
+    t_dbf = (perf_counter() - start) / loops
+
+    start = perf_counter()
+    for _ in range(loops):
+        cols, mm = open_columns(path)
+        rows = np.flatnonzero(~cols.deleted)
+        columns = (cols.text('s1', rows), [cols.number(name, rows) for name in fields])
+        del cols
+        mm.close()
+    t_col = (perf_counter() - start) / loops
+
+    print(u'记录数：{0}，有效记录：{1}/{2}'.format(len(hq_list), len(quotes), len(columns[0])))
+    print(u'dbf库逐条读取：{0:.2f}ms'.format(t_dbf * 1000))
+    print(u'列视图读取：{0:.2f}ms'.format(t_col * 1000))
+
+
+# ----------------------------------------------------------------------
+def benchmark_append(path, record, loops=200):
+    """
+    对比dbf库和DbfAppender逐条追加委托记录的耗时
+    path为委托库文件，测试在其副本上进行；record为一条委托记录（Order_rec.ord()）
+    """
+    import shutil
+    import tempfile
+    import dbf
+
+    tmp = tempfile.mkdtemp()
+    try:
+        copy = os.path.join(tmp, os.path.basename(path))
+        shutil.copy(path, copy)
+        table = dbf.Table(copy, codepage='cp936')
+        start = perf_counter()
+        for _ in range(loops):
+            table.open()
+            table.append(record)
+            table.close()
+        t_dbf = (perf_counter() - start) / loops
+
+        for sync in (SYNC_NONE, SYNC_BATCH):
+            shutil.copy(path, copy)
+            writer = DbfAppender(copy, sync=sync)
+            writer.open()
+            start = perf_counter()
+            for _ in range(loops):
+                writer.append(record)
+            t_raw = (perf_counter() - start) / loops
+            writer.close()
+            print(u'DbfAppender（{0}）逐条追加：{1:.3f}ms'.format(sync, t_raw * 1000))
+
+        # 检查写入结果dbf库可以读取
+        table = dbf.Table(copy, codepage='cp936')
+        table.open()
+        count = len(table)
+        last = tuple(table[-1])
+        table.close()
+    finally:
+        shutil.rmtree(tmp)
+    print(u'dbf库逐条追加：{0:.3f}ms'.format(t_dbf * 1000))
+    print(u'追加后记录数：{0}，最后一条：{1}'.format(count, last))
+
+
+# 直接运行脚本可以进行性能测试
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[2] == 'append':
+        benchmark_append(sys.argv[1], ('O', 1000, 'S0', '', '', '600000', '1', 100, 10.0, '0'))
+    else:
+        benchmark(sys.argv[1])
@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+@version: v1.0
+@author: sunlei
+@license: Apache Licence
+@contact: 12166056@qq.com
+@site: http://blog.csdn.net/sunlei213
+@software: PyCharm Community Edition
+@file: vnmkt.py
+@time: 2017/10/22 10:40
+
+上交所行情文件mktdt00.txt的批量解析。
+
+文件格式：
+    首行HEADER，第7个字段为行情时间（YYYYMMDD-HH:MM:SS.sss），第9个字段为市场状态
+    之后每行一条记录，以'|'分隔，首字段为记录类型：
+        MD001 指数
+        MD002 股票
+        MD003 债券
+        MD004 基金（比MD002多两个IOPV字段）
+    末行TRAILER
+"""
+import os
+import select
+import sys
+import zlib
+from time import perf_counter, sleep
+
+import numpy as np
+
+# 成交金额上限（show2003中为12位整数）
+MAX_AMOUNT = 999999999999
+
+# 记录类型 -> 交易状态字段位置
+PHASE_FIELD = {'MD002': 31, 'MD003': 31, 'MD004': 33}
+
+# 各类记录共有的字段位置
+BASE_FIELDS = (('volume', 3, np.int64), ('amount', 4, np.float64), ('preClose', 5, np.float64),
+               ('open', 6, np.float64), ('high', 7, np.float64), ('low', 8, np.float64),
+               ('last', 9, np.float64), ('close', 10, np.float64))
+
+# 五档行情字段位置（MD001无）
+DEPTH_FIELDS = (('bid1', 11, np.float64), ('bidVol1', 12, np.int64),
+                ('ask1', 13, np.float64), ('askVol1', 14, np.int64),
+                ('bid2', 15, np.float64), ('bidVol2', 16, np.int64),
+                ('ask2', 17, np.float64), ('askVol2', 18, np.int64),
+                ('bid3', 19, np.float64), ('bidVol3', 20, np.int64),
+                ('ask3', 21, np.float64), ('askVol3', 22, np.int64),
+                ('bid4', 23, np.float64), ('bidVol4', 24, np.int64),
+                ('ask4', 25, np.float64), ('askVol4', 26, np.int64),
+                ('bid5', 27, np.float64), ('bidVol5', 28, np.int64),
+                ('ask5', 29, np.float64), ('askVol5', 30, np.int64))
+
+# 快照中的数值列
+COLUMNS = tuple((name, dtype) for name, _, dtype in BASE_FIELDS + DEPTH_FIELDS)
+
+
+# 10的整数次幂，用于定宽数值字段的整列转换
+POW10 = 10 ** np.arange(19, dtype=np.int64)
+
+
+def _fixed_number(mat, dtype):
+    """
+    定宽数值字段整列转换
+    mat为(行数, 字段宽度)的uint8矩阵。行情文件中数值右对齐、小数位固定，
+    各字节位的权只与列位置有关，整列用一次矩阵乘法得到整数尾数，
+    再除以10的小数位数次幂，结果与float(字符串)一致
+    """
+    mat = np.ascontiguousarray(mat)
+    width = mat.shape[1]
+    dots = mat == 46
+    ndots = np.count_nonzero(dots)
+    dot = int(np.argmax(dots.ravel())) % width if ndots else width
+    if ndots:
+        # 小数点必须都在同一列，没有小数点的行不能有数字
+        at_dot = dots[:, dot]
+        if np.count_nonzero(at_dot) != ndots or (
+                not at_dot.all() and (mat[~at_dot].max(axis=1) >= 48).any()):
+            return _fixed_number_rows(mat, dtype)
+    slots = mat.max(axis=0) >= 48
+    place = np.cumsum(slots[::-1])[::-1] - 1
+    weights = np.where(slots, POW10[np.maximum(place, 0)], 0).astype(np.float64)
+    value = mat.astype(np.float64)
+    value -= 48
+    np.maximum(value, 0, out=value)
+    mant = value.dot(weights)
+    if np.count_nonzero(mat == 45):
+        mant = np.where((mat == 45).any(axis=1), -mant, mant)
+    ndec = int(slots[dot + 1:].sum())
+    if dtype is np.int64:
+        return mant.astype(np.int64) // POW10[ndec]
+    return mant / float(POW10[ndec])
+
+
+def _fixed_number_rows(mat, dtype):
+    """定宽数值字段整列转换（各行小数点位置不同时使用）"""
+    digit = (mat >= 48) & (mat <= 57)
+    value = np.where(digit, mat.astype(np.int64) - 48, 0)
+    # 每个数字位之后（含自身）的数字个数，减1即该位的权
+    place = np.cumsum(digit[:, ::-1], axis=1)[:, ::-1] - 1
+    mant = (value * POW10[np.maximum(place, 0)]).sum(axis=1)
+    mant = np.where((mat == 45).any(axis=1), -mant, mant)
+    ndec = (digit & (np.cumsum(mat == 46, axis=1) > 0)).sum(axis=1)
+    if dtype is np.int64:
+        return mant // POW10[ndec]
+    return mant / POW10[ndec].astype(np.float64)
+
+
+class _FixedGroup(object):
+    """定宽记录：所有行长度和分隔符位置相同，直接按字节矩阵切列"""
+
+    def __init__(self, lines, encoding):
+        first = lines[0]
+        length = len(first)
+        if any(len(line) != length for line in lines):
+            raise ValueError(u'记录不定长')
+        self._mat = np.frombuffer(b''.join(lines), dtype=np.uint8).reshape(len(lines), length)
+        pipes = [i for i, c in enumerate(first) if c == 0x7C]
+        if pipes and not (self._mat[:, pipes] == 0x7C).all():
+            raise ValueError(u'分隔符位置不一致')
+        bounds = [-1] + pipes + [length]
+        self._spans = [(bounds[i] + 1, bounds[i + 1]) for i in range(len(bounds) - 1)]
+        self._encoding = encoding
+        self.width = len(self._spans)
+
+    def __len__(self):
+        return len(self._mat)
+
+    def raw(self, pos):
+        """原始字节列"""
+        start, end = self._spans[pos]
+        if end <= start:
+            return np.full(len(self._mat), b'', dtype='S1')
+        return np.ascontiguousarray(self._mat[:, start:end]).view('S{0}'.format(end - start)).ravel()
+
+    def text(self, pos):
+        return np.char.strip(self.raw(pos)).astype('U')
+
+    def encoded(self, pos):
+        """去掉空格的原始字节列（中文字段不解码）"""
+        return np.char.strip(self.raw(pos))
+
+    def number(self, pos, dtype):
+        start, end = self._spans[pos]
+        return _fixed_number(self._mat[:, start:end], dtype)
+
+
+class _SplitGroup(object):
+    """不定长记录：按'|'拆分后逐列转换"""
+
+    def __init__(self, lines, encoding):
+        rows = [line.decode(encoding, 'replace').split('|') for line in lines]
+        self._encoding = encoding
+        self.width = max(len(row) for row in rows)
+        self._rows = [row + [''] * (self.width - len(row)) for row in rows]
+
+    def __len__(self):
+        return len(self._rows)
+
+    def text(self, pos):
+        return np.array([row[pos].strip() for row in self._rows])
+
+    def encoded(self, pos):
+        return np.char.encode(self.text(pos), self._encoding)
+
+    def number(self, pos, dtype):
+        conv = int if dtype is np.int64 else float
+        return np.array([conv(row[pos]) if row[pos].strip() else 0 for row in self._rows], dtype=dtype)
+
+
+def _split_group(lines, encoding):
+    """同类记录按列访问，定长时用字节矩阵，否则逐行拆分"""
+    try:
+        return _FixedGroup(lines, encoding)
+    except ValueError:
+        return _SplitGroup(lines, encoding)
+
+
+class MktSnapshot(object):
+    """
+    一次mktdt00.txt快照的列式行情表
+
+    codes：证券代码数组，index：证券代码 -> 行号
+    每个数值字段一列（见COLUMNS），trading为是否可交易，
+    last已按收盘状态取当前价或收盘价。
+    """
+
+    def __init__(self):
+        self.date = ''  # 交易日期 YYYYMMDD
+        self.time = ''  # 行情时间 HHMMSS
+        self.is_close = False  # 是否已收盘
+        self.status = ''  # 市场状态
+        self.codes = np.array([], dtype='U6')
+        self.names = np.array([], dtype='S8')  # 证券名称（原始编码）
+        self.types = np.array([], dtype='U5')
+        self.trading = np.array([], dtype=bool)
+        self.columns = dict((name, np.zeros(0, dtype)) for name, dtype in COLUMNS)
+        self.index = {}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __contains__(self, code):
+        return code in self.index
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def name(self, code, encoding='gbk'):
+        """证券名称"""
+        return self.names[self.index[code]].decode(encoding, 'replace')
+
+    def rows(self, codes):
+        """证券代码对应的行号（不存在的代码跳过），返回(代码列表, 行号数组)"""
+        index = self.index
+        found = [code for code in codes if code in index]
+        return found, np.array([index[code] for code in found], dtype=np.int64)
+
+
+class MktParser(object):
+    """
+    mktdt00.txt批量解析
+
+    整个文件一次读入，按记录类型分组；定长记录直接按字节矩阵切列，
+    数值字段整列转换，不再逐行、逐字段生成python对象。
+    """
+
+    def __init__(self, encoding='gbk'):
+        self._encoding = encoding
+
+    def read(self, path):
+        """读取并解析行情文件"""
+        with open(path, 'rb') as f:
+            data = f.read()
+        return self.parse(data)
+
+    def parse(self, data):
+        """解析行情文件内容（bytes），返回MktSnapshot"""
+        lines = data.splitlines()
+        snap = MktSnapshot()
+        if not lines:
+            return snap
+        self._parse_header(snap, lines[0].decode(self._encoding, 'replace').split('|'))
+
+        groups = {}
+        for line in lines[1:]:
+            groups.setdefault(line[:5], []).append(line)
+        # 只处理MD开头的行情记录（跳过TRAILER等）
+        parts = [(type_.decode('ascii'), _split_group(groups[type_], self._encoding))
+                 for type_ in sorted(groups) if type_.startswith(b'MD')]
+        self._merge(snap, parts)
+        return snap
+
+    def _parse_header(self, snap, line):
+        """解析首行"""
+        line = [value.strip() for value in line]
+        stamp = line[6] if len(line) > 6 else ''
+        snap.date = stamp[0:8]
+        snap.time = stamp[9:17].replace(':', '')
+        snap.status = line[8] if len(line) > 8 else ''
+        snap.is_close = snap.status[:1] == 'E'
+
+    def _merge(self, snap, parts):
+        """把各类记录合并为一张列式表"""
+        if not parts:
+            return
+        total = sum(len(group) for _, group in parts)
+        columns = dict((name, np.zeros(total, dtype)) for name, dtype in COLUMNS)
+        codes = []
+        names = []
+        types = []
+        trading = np.ones(total, dtype=bool)
+        start = 0
+        for type_, group in parts:
+            end = start + len(group)
+            codes.append(group.text(1))
+            names.append(group.encoded(2))
+            types.append(np.full(len(group), type_, dtype='U5'))
+            fields = BASE_FIELDS if type_ == 'MD001' else BASE_FIELDS + DEPTH_FIELDS
+            for name, pos, dtype in fields:
+                if pos < group.width:
+                    columns[name][start:end] = group.number(pos, dtype)
+            if type_ in PHASE_FIELD and PHASE_FIELD[type_] < group.width:
+                # 交易状态：第一位不是'P'且第三位为'1'时停牌
+                phase = group.text(PHASE_FIELD[type_])
+                chars = phase.view('U1').reshape(len(phase), -1)
+                if chars.shape[1] >= 3:
+                    trading[start:end] = (chars[:, 0] == 'P') | (chars[:, 2] != '1')
+            start = end
+
+        # 金额四舍五入取整，超过12位按上限处理
+        columns['amount'] = np.minimum(np.rint(columns['amount']), MAX_AMOUNT)
+        if snap.is_close:
+            columns['last'] = columns['close'].copy()
+
+        snap.codes = np.concatenate(codes)
+        snap.names = np.concatenate(names)
+        snap.types = np.concatenate(types)
+        snap.trading = trading
+        snap.columns = columns
+        snap.index = dict(zip(snap.codes.tolist(), range(total)))
+
+
+class _Inotify(object):
+    """Linux inotify（ctypes调用），监视行情文件所在目录"""
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+
+    def __init__(self, path):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), u'inotify_init1失败')
+        # 监视目录而不是文件，文件被替换（先写临时文件再改名）时也能收到通知
+        folder = os.path.dirname(os.path.abspath(path))
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        if libc.inotify_add_watch(self.fd, folder.encode(), mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), u'inotify_add_watch失败')
+
+    def wait(self, timeout):
+        """等待目录内有文件变化，返回是否收到通知"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class MktWatcher(object):
+    """
+    行情文件变化检测
+
+    先比较文件的修改时间和大小，有变化时再读取首行（含行情时间）计算crc，
+    首行和文件大小都没变则认为内容未更新，不需要重新解析。
+    调用方解析成功后调用mark_done确认；未确认（文件写到一半、解析失败）时
+    同样的内容隔interval秒后会再次报告，不会漏掉这一次快照。
+    Linux下用inotify等待文件变化，其他系统（或网络盘不支持时）定时查询。
+    """
+
+    def __init__(self, path, interval=0.2, notify=True):
+        self.path = path
+        self.interval = interval  # 查询间隔（秒）
+        self._stat = None  # (修改时间, 大小)，已确认的
+        self._sign = None  # (首行crc, 大小)，已确认的
+        self._pending = None  # 已报告、等待mark_done确认的(stat, sign)
+        self._notify = None
+        if notify and sys.platform.startswith('linux'):
+            try:
+                self._notify = _Inotify(path)
+            except (OSError, AttributeError):
+                self._notify = None
+
+    def changed(self):
+        """文件内容是否更新（与上次mark_done时相比）"""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        stat = (st.st_mtime_ns, st.st_size)
+        if stat == self._stat or not st.st_size:
+            return False
+        try:
+            with open(self.path, 'rb') as f:
+                head = f.readline(256)
+        except IOError:
+            # 文件被独占写入，下次再检查
+            return False
+        # 文件写到一半时首行可能已更新但大小不同，因此大小也作为判断依据
+        sign = (zlib.crc32(head), st.st_size)
+        if sign == self._sign:
+            self._stat = stat
+            self._pending = None
+            return False
+        self._pending = (stat, sign)
+        return True
+
+    def mark_done(self):
+        """上次报告的更新已成功解析，之后同样的内容不再报告"""
+        if self._pending is not None:
+            self._stat, self._sign = self._pending
+            self._pending = None
+
+    def wait(self, timeout=1.0):
+        """等待文件更新，超时返回False"""
+        # 上次报告的更新没有确认时先等一会儿再重试，避免连续解析写到一半的文件
+        retry = self._pending is not None
+        if not retry and self.changed():
+            return True
+        end = perf_counter() + timeout
+        while True:
+            remain = end - perf_counter()
+            if remain <= 0:
+                return False
+            if self._notify is not None:
+                self._notify.wait(min(self.interval, remain) if retry else remain)
+            else:
+                sleep(min(self.interval, remain))
+            if self.changed():
+                return True
+
+    def close(self):
+        if self._notify is not None:
+            self._notify.close()
+            self._notify = None
+
+
+# ----------------------------------------------------------------------
+def benchmark(path, loops=10):
+    """测试解析mktdt00.txt的耗时"""
+    parser = MktParser()
+    snap = parser.read(path)
+    start = perf_counter()
+    for _ in range(loops):
+        parser.read(path)
+    cost = (perf_counter() - start) / loops
+    print(u'记录数：{0}'.format(len(snap)))
+    print(u'批量解析：{0:.2f}ms'.format(cost * 1000))
+
+
+# 直接运行脚本可以进行性能测试
+if __name__ == '__main__':
+    benchmark(sys.argv[1])
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+@version: v1.0
+@author: sunlei
+@license: Apache Licence
+@contact: 12166056@qq.com
+@site: http://blog.csdn.net/sunlei213
+@software: PyCharm Community Edition
+@file: vnorder.py
+@time: 2017/10/30 21:15
+
+带二级索引的委托表。
+
+委托按client_id保存（与原来的OrderedDict用法相同），另外按申报编号（ord_no）、
+账户、证券代码和是否可撤建立索引，按申报编号查找、取可撤委托都不需要遍历全部委托。
+委托对象的内容在表外修改后，调用refresh(client_id)更新索引。
+修改和按索引查询都在锁内进行，行情/回报线程和界面线程可以同时使用；
+遍历和查询返回的是副本。
+
+OrderWriter：委托库（instructions.dbf）的批量写入。
+"""
+from collections import OrderedDict
+from operator import attrgetter
+from threading import Condition, Lock, Thread
+from time import time
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+
+class OrderBook(MutableMapping):
+    """
+    委托表
+
+    ord_no、acct、symbol、is_open为取委托对应属性的函数，默认按Order_rec的属性名读取
+    """
+
+    def __init__(self, ord_no=attrgetter('ord_no'), acct=attrgetter('acct'),
+                 symbol=attrgetter('symbol'), is_open=attrgetter('can_cancel')):
+        self._get_ord_no = ord_no
+        self._get_acct = acct
+        self._get_symbol = symbol
+        self._get_open = is_open
+        self._orders = OrderedDict()  # client_id -> 委托
+        self._keys = {}  # client_id -> (ord_no, acct, symbol, 是否可撤)，建索引时的值
+        self._by_ord_no = {}  # ord_no -> client_id集合
+        self._by_acct = {}  # acct -> client_id集合
+        self._by_symbol = {}  # symbol -> client_id集合
+        self._open = OrderedDict()  # 可撤委托：client_id -> 委托
+        self._lock = Lock()  # 保护委托表和各索引
+
+    # ----------------------------------------------------------------------
+    def __getitem__(self, client_id):
+        return self._orders[client_id]
+
+    def __setitem__(self, client_id, order):
+        with self._lock:
+            if client_id in self._orders:
+                self._unindex(client_id)
+            self._orders[client_id] = order
+            self._index(client_id, order)
+
+    def __delitem__(self, client_id):
+        with self._lock:
+            self._unindex(client_id)
+            del self._orders[client_id]
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._orders))
+
+    def __len__(self):
+        return len(self._orders)
+
+    def __contains__(self, client_id):
+        return client_id in self._orders
+
+    def __repr__(self):
+        with self._lock:
+            items = list(self._orders.items())
+        return '{0}({1!r})'.format(type(self).__name__, items)
+
+    # ----------------------------------------------------------------------
+    def _index(self, client_id, order):
+        keys = (self._get_ord_no(order), self._get_acct(order), self._get_symbol(order),
+                bool(self._get_open(order)))
+        self._keys[client_id] = keys
+        ord_no, acct, symbol, is_open = keys
+        if ord_no:
+            self._by_ord_no.setdefault(ord_no, set()).add(client_id)
+        self._by_acct.setdefault(acct, set()).add(client_id)
+        self._by_symbol.setdefault(symbol, set()).add(client_id)
+        if is_open:
+            self._open[client_id] = order
+
+    def _unindex(self, client_id):
+        ord_no, acct, symbol, is_open = self._keys.pop(client_id)
+        if ord_no:
+            _discard(self._by_ord_no, ord_no, client_id)
+        _discard(self._by_acct, acct, client_id)
+        _discard(self._by_symbol, symbol, client_id)
+        if is_open:
+            del self._open[client_id]
+
+    def refresh(self, client_id):
+        """委托内容（申报编号、可撤状态等）修改后更新索引"""
+        with self._lock:
+            order = self._orders[client_id]
+            keys = (self._get_ord_no(order), self._get_acct(order), self._get_symbol(order),
+                    bool(self._get_open(order)))
+            if keys != self._keys[client_id]:
+                self._unindex(client_id)
+                self._index(client_id, order)
+
+    # ----------------------------------------------------------------------
+    def by_ord_no(self, ord_no):
+        """申报编号对应的client_id列表"""
+        with self._lock:
+            return list(self._by_ord_no.get(ord_no, ()))
+
+    def by_acct(self, acct):
+        """账户的全部委托的client_id列表"""
+        with self._lock:
+            return list(self._by_acct.get(acct, ()))
+
+    def by_symbol(self, symbol):
+        """证券的全部委托的client_id列表"""
+        with self._lock:
+            return list(self._by_symbol.get(symbol, ()))
+
+    def open_by_ord_no(self, ord_no):
+        """申报编号对应的可撤委托的client_id列表"""
+        with self._lock:
+            return [client_id for client_id in self._by_ord_no.get(ord_no, ())
+                    if client_id in self._open]
+
+    def is_open(self, client_id):
+        return client_id in self._open
+
+    def open_count(self):
+        """可撤委托数"""
+        return len(self._open)
+
+    def open_orders(self):
+        """可撤委托（client_id -> 委托）的副本，只复制可撤的委托"""
+        with self._lock:
+            return OrderedDict(list(self._open.items()))
+
+    def to_dict(self):
+        """全部委托（用于保存，不含索引）"""
+        with self._lock:
+            return OrderedDict(list(self._orders.items()))
+
+
+def _discard(index, key, client_id):
+    ids = index.get(key)
+    if ids is not None:
+        ids.discard(client_id)
+        if not ids:
+            del index[key]
+
+
+# 记录本身有问题（字段超长、类型不对等），重试也不会成功
+BAD_RECORD = (ValueError, TypeError)
+
+
+class OrderWriter(object):
+    """
+    委托库批量写入
+
+    交易时段内委托库保持打开，submit只把记录放入待写列表，
+    后台线程在待写记录达到batch条或最早的记录等待超过delay秒时一次写入；
+    flush可以立即写入（如批量下单后）。
+    table需要有open/close/append方法（vndbf.DbfAppender或dbf.Table），
+    有append_many方法时整批写入。
+    写入出错时只把未写入的记录放回待写列表；无法编码的记录（字段超长、类型不对）
+    重试也不会成功，记入rejected后丢弃，不阻塞后面的委托。
+    """
+
+    def __init__(self, table, delay=0.01, batch=20):
+        self._table = table
+        self.delay = delay  # 最长等待时间（秒）
+        self.batch = batch  # 达到该条数立即写入
+        self._pending = []
+        self._first = 0.0  # 最早一条待写记录的时间
+        self._cond = Condition()
+        self._write_lock = Lock()  # 保证各批记录按提交顺序写入
+        self._active = False
+        self._thread = Thread(target=self._run, name='OrderWriter')
+        self._thread.daemon = True
+        self.written = 0  # 已写入的记录数
+        self.batches = 0  # 写入次数
+        self.rejected = []  # 丢弃的无法编码的记录
+
+    def start(self):
+        self._table.open()
+        self._active = True
+        self._thread.start()
+
+    def stop(self):
+        """写入剩余的记录并关闭委托库"""
+        with self._cond:
+            self._active = False
+            self._cond.notify()
+        self._thread.join()
+        self.flush()
+        self._table.close()
+
+    def submit(self, record):
+        """提交一条委托记录（Order_rec.ord()的元组）"""
+        with self._cond:
+            if not self._pending:
+                self._first = time()
+            self._pending.append(record)
+            if len(self._pending) == 1 or len(self._pending) >= self.batch:
+                self._cond.notify()
+
+    def flush(self):
+        """立即写入全部待写记录，返回写入条数"""
+        with self._write_lock:
+            with self._cond:
+                records = self._pending
+                self._pending = []
+            if not records:
+                return 0
+            return self._write(records)
+
+    def _write(self, records):
+        append_many = getattr(self._table, 'append_many', None)
+        if append_many is not None:
+            try:
+                append_many(records)
+            except BAD_RECORD:
+                pass  # 整批先编码再写入，有坏记录时一条也没写，改为逐条写入
+            except Exception:
+                self._requeue(records)
+                raise
+            else:
+                self._count(len(records))
+                return len(records)
+        append = self._table.append
+        written = 0
+        for i, record in enumerate(records):
+            try:
+                append(record)
+            except BAD_RECORD as e:
+                self.rejected.append(record)
+                print(u'丢弃无法写入的委托记录：{0!r}（{1}）'.format(record, e))
+                continue
+            except Exception:
+                # 已写入的记录不再重写，只放回其余的记录
+                self._count(written)
+                self._requeue(records[i:])
+                raise
+            written += 1
+        self._count(written)
+        return written
+
+    def _requeue(self, records):
+        """写入失败的记录放回待写列表的最前面，下次重试"""
+        with self._cond:
+            self._pending[:0] = records
+            self._first = time()
+
+    def _count(self, written):
+        if written:
+            self.written += written
+            self.batches += 1
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._active and not self._pending:
+                    self._cond.wait()
+                if not self._active:
+                    return
+                # 等到凑够一批或超过最长等待时间
+                while self._active and len(self._pending) < self.batch:
+                    remain = self._first + self.delay - time()
+                    if remain <= 0:
+                        break
+                    self._cond.wait(remain)
+            try:
+                self.flush()
+            except Exception as e:
+                print(u'写入委托库失败：{0}'.format(e))
+
+
+# ----------------------------------------------------------------------
+class _FakeTable(object):
+    """测试用的委托库：第fail_at次append时抛出IOError（只抛一次），超过width的字段值无法编码"""
+
+    def __init__(self, fail_at=None, width=6):
+        self.rows = []
+        self.calls = 0
+        self.fail_at = fail_at
+        self.width = width
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def encode(self, values):
+        for value in values:
+            if len(str(value)) > self.width:
+                raise ValueError(u'字段值超出长度：{0!r}'.format(value))
+        return tuple(values)
+
+    def append(self, values):
+        self.calls += 1
+        if self.calls == self.fail_at:
+            raise IOError(u'磁盘错误')
+        self.rows.append(self.encode(values))
+
+
+class _FakeBatchTable(_FakeTable):
+    """有append_many的委托库：整批先编码，全部成功才写入"""
+
+    def append_many(self, records):
+        data = [self.encode(values) for values in records]
+        self.rows.extend(data)
+
+    def append(self, values):
+        self.append_many([values])
+
+
+def test():
+    """测试部分写入失败和无法编码的记录"""
+    records = [('B', '60000{0}'.format(i), 100) for i in range(5)]
+
+    # 第3条写入失败：前2条不重写，其余3条下次写入
+    table = _FakeTable(fail_at=3)
+    writer = OrderWriter(table)
+    for record in records:
+        writer.submit(record)
+    try:
+        writer.flush()
+    except IOError as e:
+        print(u'第一次写入失败：{0}，已写入{1}条'.format(e, len(table.rows)))
+    writer.flush()
+    print(u'部分失败后重试：写入{0}条，每条一次：{1}'.format(
+        len(table.rows), table.rows == records))
+    assert table.rows == records
+
+    # 坏记录丢弃，不阻塞后面的记录
+    for table in (_FakeTable(), _FakeBatchTable()):
+        writer = OrderWriter(table)
+        writer.submit(records[0])
+        writer.submit(('B', '6000001234', 100))
+        writer.submit(records[1])
+        writer.flush()
+        writer.submit(records[2])
+        writer.flush()
+        print(u'{0}：写入{1}条，丢弃{2}条'.format(
+            type(table).__name__, len(table.rows), len(writer.rejected)))
+        assert table.rows == records[:3] and len(writer.rejected) == 1
+
+
+# 直接运行脚本可以进行测试
+if __name__ == '__main__':
+    test()
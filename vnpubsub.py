@@ -0,0 +1,601 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+@version: v1.0
+@author: sunlei
+@license: Apache Licence
+@contact: 12166056@qq.com
+@site: http://blog.csdn.net/sunlei213
+@software: PyCharm Community Edition
+@file: vnpubsub.py
+@time: 2017/11/08 21:15
+
+行情和委托事件的发布/订阅：交易核心所在进程的Publisher挂在事件引擎上，
+把行情、委托、成交事件通过本机的TCP或Unix域套接字发给多个Subscriber（界面、策略），
+各客户端不必各自读取dbf行情库。
+
+帧格式：4字节长度 + 1字节消息类型 + 数据（长度不含帧头）
+    行情：struct定长打包（见TICK_STRUCT），约250字节
+    委托、成交：JSON数组/对象（数量少，字段类型不固定）
+    订阅、退订：逗号分隔的vtSymbol，'*'为全部
+
+每个客户端的行情按合约合并：客户端来不及接收时，同一合约尚未发出的行情只保留最新的一笔；
+委托、成交事件按顺序全部发出，积压超过maxBuffer的客户端断开。
+"""
+import json
+import os
+import selectors
+import socket
+import struct
+from collections import deque, OrderedDict
+from datetime import datetime
+from threading import Thread, Lock
+from time import perf_counter, sleep
+
+from eventType import EVENT_MARKETDATA, EVENT_ORDER, EVENT_TRADE
+from eventEngine import Event, topicType
+from vtobject import VtTickData, OrderSnapshot
+
+# 默认地址：本机TCP端口；字符串为Unix域套接字路径
+PUBSUB_ADDRESS = ('127.0.0.1', 26501)
+
+# 消息类型
+MSG_TICK = 1
+MSG_ORDER = 2
+MSG_TRADE = 3
+MSG_SUB = 4
+MSG_UNSUB = 5
+
+SUB_ALL = '*'
+
+_FRAME = struct.Struct('<IB')
+
+# 行情打包的数值字段，顺序与TICK_STRUCT一致
+TICK_PRICES = ('lastPrice', 'openPrice', 'highPrice', 'lowPrice', 'preClosePrice')
+TICK_LEVELS = tuple('{0}{1}{2}'.format(side, kind, i) for side in ('buy', 'sell')
+                    for kind in ('Price', 'Volume') for i in range(1, 6))
+# vtSymbol、日期、时间、datetime的时间戳、价格、成交量、五档价格和数量
+TICK_STRUCT = struct.Struct('<16s8s12sd5dq' + '5d5q5d5q')
+
+_LOW_WATER = 65536  # 发送缓冲低于此值时才取出新的行情
+_RECV_SIZE = 65536
+
+
+def _frame(msg_type, payload):
+    return _FRAME.pack(len(payload), msg_type) + payload
+
+
+def encode_tick(tick):
+    """VtTickData -> 行情帧"""
+    stamp = tick.datetime.timestamp() if tick.datetime else 0.0
+    return _frame(MSG_TICK, TICK_STRUCT.pack(
+        tick.vtSymbol.encode('ascii'), tick.date.encode('ascii'), tick.time.encode('ascii'), stamp,
+        *([getattr(tick, name) for name in TICK_PRICES] + [int(tick.volume)] +
+          [getattr(tick, name) if 'Price' in name else int(getattr(tick, name))
+           for name in TICK_LEVELS])))
+
+
+def decode_tick(payload):
+    """行情帧数据 -> VtTickData"""
+    values = TICK_STRUCT.unpack(payload)
+    vtSymbol = values[0].rstrip(b'\0').decode('ascii')
+    data = dict(zip(TICK_PRICES, values[4:9]))
+    data.update(zip(TICK_LEVELS, values[10:]))
+    symbol, _, exchange = vtSymbol.partition('.')
+    data['vtSymbol'] = vtSymbol
+    data['symbol'] = symbol
+    data['exchange'] = exchange
+    data['TradingDay'] = values[1].rstrip(b'\0').decode('ascii')
+    data['UpdateTime'] = values[2].rstrip(b'\0').decode('ascii')
+    data['datetime'] = datetime.fromtimestamp(values[3]) if values[3] else None
+    data['volume'] = values[9]
+    return VtTickData.from_data(data)
+
+
+def _encode_json(msg_type, data):
+    return _frame(msg_type, json.dumps(data, ensure_ascii=False, default=str,
+                                       separators=(',', ':')).encode('utf-8'))
+
+
+def _make_socket(address):
+    """地址为字符串时创建Unix域套接字，否则创建TCP套接字"""
+    if isinstance(address, str):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+class FrameReader(object):
+    """从字节流中切分出完整的帧"""
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def feed(self, data):
+        """加入收到的数据，返回完整的[(消息类型, 数据)]"""
+        buf = self._buf
+        buf += data
+        frames = []
+        pos = 0
+        size = _FRAME.size
+        while len(buf) - pos >= size:
+            length, msg_type = _FRAME.unpack_from(buf, pos)
+            end = pos + size + length
+            if end > len(buf):
+                break
+            frames.append((msg_type, bytes(buf[pos + size:end])))
+            pos = end
+        if pos:
+            del buf[:pos]
+        return frames
+
+
+class _Client(object):
+    """Publisher中的一个客户端连接"""
+
+    __slots__ = ('sock', 'symbols', 'all', 'ticks', 'events', 'pending', 'out', 'reader',
+                 'dropped', 'writing')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.symbols = set()  # 订阅的合约
+        self.all = False  # 是否订阅全部合约
+        self.ticks = OrderedDict()  # 尚未发出的行情：vtSymbol -> 帧，同一合约只保留最新的
+        self.events = deque()  # 尚未发出的委托、成交帧
+        self.pending = 0  # events中的字节数
+        self.out = bytearray()  # 发送缓冲
+        self.reader = FrameReader()
+        self.dropped = 0  # 被合并掉的行情数
+        self.writing = False  # 是否在等待可写
+
+
+class Publisher(object):
+    """
+    行情、委托事件发布
+
+    在事件引擎上监听行情、委托、成交事件，编码一次后放入各订阅客户端的发送队列，
+    由单独的网络线程用selectors发送。行情只在有客户端订阅该合约时才编码。
+    行情事件按订阅注册：有客户端订阅全部时监听EVENT_MARKETDATA，否则只监听被订阅合约的主题，
+    没有订阅时不监听，行情接口可以用hasSubscribers跳过没人要的行情。
+    """
+
+    def __init__(self, eventEngine, address=PUBSUB_ADDRESS, maxBuffer=8 * 1024 * 1024):
+        self._ee = eventEngine
+        self.address = address
+        self.maxBuffer = maxBuffer
+        self._lock = Lock()
+        self._clients = {}  # 套接字 -> _Client
+        self._sel = None
+        self._server = None
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._woken = False
+        self._active = False
+        self._thread = None
+        self._tickTypes = set()  # onTick已注册的事件类型
+
+    # ----------------------------------------------------------------------
+    def start(self):
+        address = self.address
+        if isinstance(address, str) and os.path.exists(address):
+            os.remove(address)
+        server = _make_socket(address)
+        if not isinstance(address, str):
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(address)
+        server.listen(16)
+        server.setblocking(False)
+        self._server = server
+        self._sel = selectors.DefaultSelector()
+        self._sel.register(server, selectors.EVENT_READ)
+        self._sel.register(self._wake_r, selectors.EVENT_READ)
+        self._active = True
+        self._thread = Thread(target=self.__run, name='Publisher')
+        self._thread.daemon = True
+        self._thread.start()
+        self._ee.register(EVENT_ORDER, self.onOrder)
+        self._ee.register(EVENT_TRADE, self.onTrade)
+
+    def stop(self):
+        self._ee.unregister(EVENT_ORDER, self.onOrder)
+        self._ee.unregister(EVENT_TRADE, self.onTrade)
+        if not self._active:
+            return
+        self._active = False
+        self._wake()
+        self._thread.join()
+        for client in list(self._clients.values()):
+            self.__close(client)
+        self._syncTicks()
+        self._sel.close()
+        self._server.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+    def clients(self):
+        """各客户端的状态：[(订阅合约数, 积压行情数, 发送缓冲字节数, 合并掉的行情数)]"""
+        with self._lock:
+            return [(SUB_ALL if c.all else len(c.symbols), len(c.ticks), len(c.out) + c.pending,
+                     c.dropped) for c in self._clients.values()]
+
+    def _syncTicks(self):
+        """按各客户端的订阅注册或注销onTick（在网络线程中调用，事件引擎的注册可以跨线程进行）"""
+        with self._lock:
+            if not self._active:
+                types = set()
+            elif any(c.all for c in self._clients.values()):
+                types = {EVENT_MARKETDATA}
+            else:
+                types = set(topicType(EVENT_MARKETDATA, symbol)
+                            for c in self._clients.values() for symbol in c.symbols)
+        for type_ in self._tickTypes - types:
+            self._ee.unregister(type_, self.onTick)
+        for type_ in types - self._tickTypes:
+            self._ee.register(type_, self.onTick)
+        self._tickTypes = types
+
+    # ----------------------------------------------------------------------
+    # 事件引擎线程中调用，编码出错只打印，不影响事件引擎
+    def onTick(self, event):
+        tick = event.dict_['data']
+        frame = None
+        try:
+            symbol = tick.vtSymbol
+            with self._lock:
+                for client in self._clients.values():
+                    if client.all or symbol in client.symbols:
+                        if frame is None:
+                            frame = encode_tick(tick)
+                        if symbol in client.ticks:
+                            client.dropped += 1
+                        client.ticks[symbol] = frame
+        except Exception as e:
+            print(u'行情编码失败：{0!r}，{1}'.format(getattr(tick, 'vtSymbol', tick), e))
+            return
+        if frame is not None:
+            self._wake()
+
+    def onOrder(self, event):
+        try:
+            frame = _encode_json(MSG_ORDER, list(event.dict_['data']))
+        except Exception as e:
+            print(u'委托编码失败：{0}'.format(e))
+            return
+        self._broadcast(frame)
+
+    def onTrade(self, event):
+        try:
+            frame = _encode_json(MSG_TRADE, event.dict_['data'])
+        except Exception as e:
+            print(u'成交编码失败：{0}'.format(e))
+            return
+        self._broadcast(frame)
+
+    def _broadcast(self, frame):
+        """委托、成交事件发给所有客户端"""
+        with self._lock:
+            if not self._clients:
+                return
+            for client in self._clients.values():
+                client.events.append(frame)
+                client.pending += len(frame)
+        self._wake()
+
+    def _wake(self):
+        """唤醒网络线程"""
+        if self._woken:
+            return
+        self._woken = True
+        try:
+            self._wake_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    # ----------------------------------------------------------------------
+    # 网络线程
+    def __run(self):
+        sel = self._sel
+        while self._active:
+            for key, mask in sel.select(1.0):
+                sock = key.fileobj
+                if sock is self._server:
+                    self.__accept()
+                elif sock is self._wake_r:
+                    # 先取空唤醒字节再清除标志：清除之后的_wake一定会再发一个字节
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except (BlockingIOError, OSError):
+                        pass
+                    self._woken = False
+                else:
+                    client = self._clients.get(sock)
+                    if client is None:
+                        continue
+                    if mask & selectors.EVENT_READ:
+                        self.__read(client)
+                    if mask & selectors.EVENT_WRITE and sock in self._clients:
+                        self.__write(client)
+            # 有新数据且不在等待可写的客户端直接发送，积压过多的客户端在__write中断开
+            with self._lock:
+                ready = [c for c in self._clients.values()
+                         if (not c.writing and (c.ticks or c.events)) or c.pending > self.maxBuffer]
+            for client in ready:
+                self.__write(client)
+
+    def __accept(self):
+        try:
+            sock, _ = self._server.accept()
+        except (BlockingIOError, OSError):
+            return
+        sock.setblocking(False)
+        client = _Client(sock)
+        with self._lock:
+            self._clients[sock] = client
+        self._sel.register(sock, selectors.EVENT_READ)
+
+    def __close(self, client):
+        with self._lock:
+            self._clients.pop(client.sock, None)
+        try:
+            self._sel.unregister(client.sock)
+        except (KeyError, ValueError):
+            pass
+        client.sock.close()
+        if client.all or client.symbols:
+            self._syncTicks()
+
+    def __read(self, client):
+        try:
+            data = client.sock.recv(_RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.__close(client)
+            return
+        frames = client.reader.feed(data)
+        for msg_type, payload in frames:
+            symbols = [s for s in payload.decode('ascii').split(',') if s]
+            with self._lock:
+                if msg_type == MSG_SUB:
+                    if SUB_ALL in symbols:
+                        client.all = True
+                    client.symbols.update(s for s in symbols if s != SUB_ALL)
+                elif msg_type == MSG_UNSUB:
+                    if SUB_ALL in symbols:
+                        client.all = False
+                        client.symbols.clear()
+                    client.symbols.difference_update(symbols)
+                    for symbol in symbols:
+                        client.ticks.pop(symbol, None)
+        if frames:
+            self._syncTicks()
+
+    def __write(self, client):
+        with self._lock:
+            if len(client.out) < _LOW_WATER:
+                # 委托、成交先发，再发各合约最新的行情
+                while client.events:
+                    client.out += client.events.popleft()
+                client.pending = 0
+                if client.ticks:
+                    client.out += b''.join(client.ticks.values())
+                    client.ticks.clear()
+            size = len(client.out) + client.pending
+        if size > self.maxBuffer:
+            # 积压过多的慢客户端断开
+            self.__close(client)
+            return
+        if client.out:
+            try:
+                sent = client.sock.send(client.out)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                self.__close(client)
+                return
+            del client.out[:sent]
+        writing = bool(client.out)
+        if writing != client.writing:
+            client.writing = writing
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if writing else 0)
+            self._sel.modify(client.sock, events)
+
+
+class Subscriber(object):
+    """
+    行情、委托事件订阅
+
+    eventEngine不为None时，收到的行情、委托、成交转为本地事件引擎中的
+    EVENT_MARKETDATA、EVENT_ORDER、EVENT_TRADE事件（带主题），界面可以照常监听；
+    也可以直接指定onTick、onOrder、onTrade回调。
+    """
+
+    def __init__(self, address=PUBSUB_ADDRESS, eventEngine=None, onTick=None, onOrder=None,
+                 onTrade=None):
+        self.address = address
+        self._ee = eventEngine
+        self.onTick = onTick
+        self.onOrder = onOrder
+        self.onTrade = onTrade
+        self._sock = None
+        self._thread = None
+        self._active = False
+        self._sendLock = Lock()
+
+    def start(self):
+        sock = _make_socket(self.address)
+        sock.connect(self.address)
+        self._sock = sock
+        self._active = True
+        self._thread = Thread(target=self.__run, name='Subscriber')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._active = False
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._sock.close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def subscribe(self, symbols):
+        """订阅合约行情，symbols为vtSymbol列表，SUB_ALL为全部"""
+        self.__send(MSG_SUB, symbols)
+
+    def unsubscribe(self, symbols):
+        self.__send(MSG_UNSUB, symbols)
+
+    def __send(self, msg_type, symbols):
+        if isinstance(symbols, str):
+            symbols = [symbols]
+        with self._sendLock:
+            self._sock.sendall(_frame(msg_type, ','.join(symbols).encode('ascii')))
+
+    def __run(self):
+        reader = FrameReader()
+        while self._active:
+            try:
+                data = self._sock.recv(_RECV_SIZE)
+            except OSError:
+                break
+            if not data:
+                break
+            for msg_type, payload in reader.feed(data):
+                try:
+                    self.__dispatch(msg_type, payload)
+                except Exception:
+                    import traceback
+                    traceback.print_exc()
+        self._active = False
+
+    def __dispatch(self, msg_type, payload):
+        if msg_type == MSG_TICK:
+            data = decode_tick(payload)
+            type_, topic, callback = EVENT_MARKETDATA, data.vtSymbol, self.onTick
+        elif msg_type == MSG_ORDER:
+            data = OrderSnapshot(*json.loads(payload.decode('utf-8')))
+            type_, topic, callback = EVENT_ORDER, str(data.client_id), self.onOrder
+        elif msg_type == MSG_TRADE:
+            data = json.loads(payload.decode('utf-8'))
+            type_, topic, callback = EVENT_TRADE, str(data.get('OrderRef', '')), self.onTrade
+        else:
+            return
+        if callback is not None:
+            callback(data)
+        if self._ee is not None:
+            event = Event(type_=type_, topic=topic)
+            event.dict_['data'] = data
+            self._ee.put(event)
+
+
+# ----------------------------------------------------------------------
+class _Engine(object):
+    """测试用的事件引擎，不分发事件"""
+
+    def register(self, type_, handler):
+        pass
+
+    def unregister(self, type_, handler):
+        pass
+
+
+class _RacyWake(object):
+    """测试用：网络线程取唤醒字节时，模拟事件线程正好调用_wake"""
+
+    def __init__(self, pub):
+        self._pub = pub
+        self._sock = pub._wake_r
+        self.armed = False
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def recv(self, size):
+        if self.armed:
+            self.armed = False
+            self._pub._wake()
+        return self._sock.recv(size)
+
+
+def test(trials=30):
+    """唤醒与网络线程取唤醒字节同时发生时，唤醒不能丢失（丢失后_woken一直为True，之后的_wake都不再发送）"""
+    pub = Publisher(_Engine(), ('127.0.0.1', 0))
+    racy = pub._wake_r = _RacyWake(pub)
+    pub.start()
+    lost = 0
+    for _ in range(trials):
+        racy.armed = True
+        pub._wake()
+        sleep(0.02)
+        if pub._woken:
+            lost += 1
+            pub._woken = False
+    pub.stop()
+    print(u'唤醒{0}次，丢失唤醒：{1}'.format(trials, lost))
+    assert not lost
+
+
+def benchmark(symbols=500, loops=20):
+    """一个发布端、两个订阅端（一个只订阅10只），比较行情帧和pickle的大小及吞吐"""
+    import pickle
+
+    tick = VtTickData()
+    tick.datetime = datetime.now()
+    tick.date = '20171108'
+    tick.time = '10:00:00'
+    print(u'行情帧：{0}字节，pickle：{1}字节'.format(len(encode_tick(tick)), len(pickle.dumps(tick))))
+
+    address = ('127.0.0.1', 0)
+    pub = Publisher(_Engine(), address)
+    pub.start()
+    pub.address = pub._server.getsockname()
+    counts = [0, 0]
+
+    def counter(i):
+        def on_tick(data):
+            counts[i] += 1
+        return on_tick
+
+    subs = [Subscriber(pub.address, onTick=counter(i)) for i in range(2)]
+    for sub in subs:
+        sub.start()
+    subs[0].subscribe(SUB_ALL)
+    subs[1].subscribe(['{0:06d}.SH'.format(i) for i in range(10)])
+    sleep(0.2)
+
+    ticks = []
+    for i in range(symbols):
+        t = VtTickData()
+        t.vtSymbol = '{0:06d}.SH'.format(i)
+        t.datetime = tick.datetime
+        ticks.append(t)
+    start = perf_counter()
+    for _ in range(loops):
+        for t in ticks:
+            event = Event(EVENT_MARKETDATA)
+            event.dict_['data'] = t
+            pub.onTick(event)
+    cost = perf_counter() - start
+    sleep(0.5)
+    print(u'发布{0}笔行情，耗时{1:.1f}ms'.format(symbols * loops, cost * 1000))
+    print(u'订阅全部收到{0}笔，订阅10只收到{1}笔'.format(*counts))
+    print(u'客户端状态：{0}'.format(pub.clients()))
+    for sub in subs:
+        sub.stop()
+    pub.stop()
+
+
+# 直接运行脚本可以进行测试
+if __name__ == '__main__':
+    test()
+    benchmark()
@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+@version: v1.0
+@author: sunlei
+@license: Apache Licence
+@contact: 12166056@qq.com
+@site: http://blog.csdn.net/sunlei213
+@software: PyCharm Community Edition
+@file: vnquote.py
+@time: 2017/10/24 21:30
+
+列式行情表：每只证券一行，每个字段一列，数据存放在预先分配的numpy数组中。
+策略按一组证券代码取价格时直接得到二维数组，可以整体比较，不必逐只构造字典。
+
+TickBuffer/TickHistory：每只证券最近若干笔行情的环形缓冲，策略可以直接对一段历史做向量计算。
+"""
+import sys
+from time import perf_counter
+
+import numpy as np
+
+# 买卖盘的列顺序：一档价、一档量、二档价、二档量……五档价、五档量
+BID_FIELDS = ('bid1', 'bidVol1', 'bid2', 'bidVol2', 'bid3', 'bidVol3',
+              'bid4', 'bidVol4', 'bid5', 'bidVol5')
+ASK_FIELDS = ('ask1', 'askVol1', 'ask2', 'askVol2', 'ask3', 'askVol3',
+              'ask4', 'askVol4', 'ask5', 'askVol5')
+
+# 其余行情字段
+QUOTE_FIELDS = ('preClose', 'open', 'high', 'low', 'last', 'close', 'volume', 'amount')
+
+# get_price默认返回的档位数
+DEPTH = 3
+
+# 环形缓冲每笔行情的列：时间（time()的秒数）、最新价、累计成交量、五档买卖盘
+TICK_FIELDS = ('time', 'last', 'volume') + BID_FIELDS + ASK_FIELDS
+TICK_COLUMN = dict((name, i) for i, name in enumerate(TICK_FIELDS))
+
+
+class _QuoteArrays(object):
+    """一份完整的行情数组，QuoteBook交替使用两份，更新时不影响正在读取的一方"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 0
+        self.bid = np.zeros((capacity, len(BID_FIELDS)))
+        self.ask = np.zeros((capacity, len(ASK_FIELDS)))
+        self.fields = dict((name, np.zeros(capacity)) for name in QUOTE_FIELDS)
+        self.trading = np.zeros(capacity, dtype=bool)
+        self.index = {}  # 证券代码 -> 行号
+        self.codes = ()
+        self.rows = {}  # 证券代码组 -> 行号数组，与index一起交换，不会用到另一份数据的行号
+
+
+class QuoteBook(object):
+    """
+    列式行情表
+
+    update()从MktSnapshot整列复制数据；get_price()按证券代码组返回
+    (买盘, 卖盘)两个二维数组，每行一只证券，列为价、量交替（见BID_FIELDS）。
+    不存在的证券对应的行全部为0。
+    """
+
+    def __init__(self, capacity=16384):
+        self._arrays = _QuoteArrays(capacity)  # 当前对外的数据
+        self._spare = _QuoteArrays(capacity)  # 下次更新写入的数据
+        self.date = ''
+        self.time = ''
+
+    def __len__(self):
+        return self._arrays.size
+
+    def __contains__(self, symbol):
+        return symbol in self._arrays.index
+
+    @property
+    def codes(self):
+        return self._arrays.codes
+
+    def update(self, snap):
+        """用一次行情快照更新全表"""
+        size = len(snap)
+        arrays = self._spare
+        if size > arrays.capacity:
+            capacity = arrays.capacity
+            while capacity < size:
+                capacity *= 2
+            arrays = _QuoteArrays(capacity)
+        for i, name in enumerate(BID_FIELDS):
+            arrays.bid[:size, i] = snap[name]
+        for i, name in enumerate(ASK_FIELDS):
+            arrays.ask[:size, i] = snap[name]
+        for name in QUOTE_FIELDS:
+            arrays.fields[name][:size] = snap[name]
+        arrays.trading[:size] = snap.trading
+        # 上一次的数据多出来的行清零
+        if arrays.size > size:
+            arrays.bid[size:arrays.size] = 0
+            arrays.ask[size:arrays.size] = 0
+            arrays.trading[size:arrays.size] = False
+            for col in arrays.fields.values():
+                col[size:arrays.size] = 0
+        arrays.size = size
+
+        current = self._arrays
+        if len(current.codes) == size and np.array_equal(current.codes, snap.codes):
+            # 证券列表未变（通常情况），沿用行号
+            arrays.codes = current.codes
+            arrays.index = current.index
+            arrays.rows = current.rows
+        else:
+            arrays.codes = snap.codes
+            arrays.index = snap.index
+            arrays.rows = {}
+        self.date = snap.date
+        self.time = snap.time
+        # 交换后读取方看到的始终是一份完整的数据
+        self._spare = current if current.capacity == arrays.capacity else _QuoteArrays(arrays.capacity)
+        self._arrays = arrays
+
+    def rows(self, symbols):
+        """证券代码组对应的行号数组，不存在的代码为-1"""
+        return _rows(self._arrays, symbols)
+
+    def get_price(self, symbols, depth=DEPTH):
+        """
+        返回(买盘, 卖盘)，形状均为(证券数, depth * 2)
+        列为：一档价、一档量、二档价、二档量……
+        """
+        arrays = self._arrays
+        rows = _rows(arrays, symbols)
+        width = depth * 2
+        bid = arrays.bid[rows, :width]
+        ask = arrays.ask[rows, :width]
+        missing = rows < 0
+        if missing.any():
+            bid[missing] = 0
+            ask[missing] = 0
+        return bid, ask
+
+    def field(self, name, symbols=None):
+        """单个字段（见QUOTE_FIELDS），不指定证券时返回全表的列"""
+        arrays = self._arrays
+        col = arrays.fields[name][:arrays.size]
+        if symbols is None:
+            return col
+        rows = _rows(arrays, symbols)
+        return np.where(rows < 0, 0, col[rows])
+
+
+def _rows(arrays, symbols):
+    symbols = tuple(symbols)
+    rows = arrays.rows.get(symbols)
+    if rows is None:
+        index = arrays.index
+        rows = np.array([index.get(symbol, -1) for symbol in symbols], dtype=np.int64)
+        arrays.rows[symbols] = rows
+    return rows
+
+
+class TickBuffer(object):
+    """
+    单只证券的定长环形缓冲
+
+    数据存放在(2 * capacity, 列数)的数组中，每笔行情同时写入i和i + capacity两行，
+    这样最近n笔总是连续的一段，window()直接返回视图，不需要复制或拼接。
+    视图是只读的，并且会被之后写入的行情覆盖，需要保留时自行copy()。
+    """
+
+    def __init__(self, capacity=4800):
+        self.capacity = capacity
+        self._data = np.zeros((capacity * 2, len(TICK_FIELDS)))
+        self._head = 0  # 下一笔写入的位置
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, row):
+        """追加一笔行情，row按TICK_FIELDS的顺序"""
+        head = self._head
+        self._data[head] = row
+        self._data[head + self.capacity] = row
+        self._head = head + 1 if head + 1 < self.capacity else 0
+        if self._count < self.capacity:
+            self._count += 1
+
+    def window(self, n=None):
+        """最近n笔（默认全部）行情的视图，按时间先后排列，形状为(笔数, 列数)"""
+        if n is None or n > self._count:
+            n = self._count
+        end = self._head + self.capacity
+        view = self._data[end - n:end]
+        view.flags.writeable = False
+        return view
+
+    def column(self, name, n=None):
+        """最近n笔行情的一列（见TICK_FIELDS）"""
+        return self.window(n)[:, TICK_COLUMN[name]]
+
+    def last(self):
+        """最新一笔行情，没有行情时返回None"""
+        if not self._count:
+            return None
+        return self.window(1)[0]
+
+    def asof(self, name, times):
+        """各时间点（含）之前最近一笔行情的name列，时间点早于第一笔行情时为0"""
+        window = self.window()
+        pos = np.searchsorted(window[:, 0], times, side='right') - 1
+        values = window[np.maximum(pos, 0), TICK_COLUMN[name]] if len(window) else np.zeros(len(pos))
+        return np.where(pos >= 0, values, 0.0)
+
+    def vwap(self, n=None):
+        """最近n笔行情的成交均价（按相邻两笔的成交量增量加权），没有成交时返回最新价"""
+        window = self.window(n)
+        if not len(window):
+            return 0.0
+        volume = np.diff(window[:, TICK_COLUMN['volume']])
+        total = volume.sum()
+        if total <= 0:
+            return float(window[-1, TICK_COLUMN['last']])
+        return float(np.dot(window[1:, TICK_COLUMN['last']], volume) / total)
+
+    def spread(self, n=None):
+        """最近n笔行情的买卖价差（卖一价 - 买一价）"""
+        window = self.window(n)
+        return window[:, TICK_COLUMN['ask1']] - window[:, TICK_COLUMN['bid1']]
+
+
+class TickHistory(object):
+    """
+    按证券代码保存TickBuffer
+
+    只记录track()过的证券，全市场都保存的话内存占用太大。
+    """
+
+    def __init__(self, capacity=4800):
+        self.capacity = capacity
+        self._buffers = {}
+        self._symbols = ()
+
+    def __contains__(self, symbol):
+        return symbol in self._buffers
+
+    def __getitem__(self, symbol):
+        return self._buffers[symbol]
+
+    def get(self, symbol):
+        return self._buffers.get(symbol)
+
+    @property
+    def symbols(self):
+        return self._symbols
+
+    def track(self, symbol):
+        """开始记录symbol的行情，返回其TickBuffer"""
+        buf = self._buffers.get(symbol)
+        if buf is None:
+            buf = self._buffers[symbol] = TickBuffer(self.capacity)
+            self._symbols = tuple(self._buffers)
+        return buf
+
+    def untrack(self, symbol):
+        if self._buffers.pop(symbol, None) is not None:
+            self._symbols = tuple(self._buffers)
+
+    def append(self, symbol, row):
+        """追加一笔行情，没有track的证券忽略"""
+        buf = self._buffers.get(symbol)
+        if buf is not None:
+            buf.append(row)
+
+    def update_from_book(self, book, now):
+        """从QuoteBook取出所有记录中证券的最新行情，时间记为now"""
+        symbols = self._symbols
+        if not symbols:
+            return
+        rows = book.rows(symbols)
+        bid, ask = book.get_price(symbols, depth=len(BID_FIELDS) // 2)
+        table = np.empty((len(symbols), len(TICK_FIELDS)))
+        table[:, 0] = now
+        table[:, 1] = book.field('last', symbols)
+        table[:, 2] = book.field('volume', symbols)
+        table[:, 3:3 + len(BID_FIELDS)] = bid
+        table[:, 3 + len(BID_FIELDS):] = ask
+        for symbol, row, found in zip(symbols, table, rows >= 0):
+            if found:
+                self._buffers[symbol].append(row)
+
+
+# ----------------------------------------------------------------------
+def benchmark(path, loops=1000):
+    """对比按字典逐只取价格和QuoteBook整体取价格的耗时"""
+    from vnmkt import MktParser
+
+    snap = MktParser().read(path)
+    book = QuoteBook()
+    book.update(snap)
+    symbols = [code for code in snap.codes.tolist() if code.startswith('511')][:25]
+
+    # 原来的方式：每只证券的买卖盘组成元组，按代码放入字典
+    table = dict((code, [snap[name][row] for name in BID_FIELDS[:6] + ASK_FIELDS[:6]])
+                 for code, row in snap.index.items())
+    start = perf_counter()
+    for _ in range(loops):
+        buy = {}
+        sell = {}
+        for code in symbols:
+            if code in table:
+                rec = table[code]
+                buy[code] = tuple(rec[:6])
+                sell[code] = tuple(rec[6:])
+        hit_dict = [code for code in sell if 0 < sell[code][0] < 99.95]
+    t_dict = (perf_counter() - start) / loops
+
+    start = perf_counter()
+    for _ in range(loops):
+        bid, ask = book.get_price(symbols)
+        hit_book = np.flatnonzero((ask[:, 0] > 0) & (ask[:, 0] < 99.95))
+    t_book = (perf_counter() - start) / loops
+
+    print(u'证券数：{0}，卖一价低于99.95：{1}/{2}'.format(len(symbols), len(hit_dict), len(hit_book)))
+    print(u'字典取价：{0:.1f}us'.format(t_dict * 1e6))
+    print(u'QuoteBook取价：{0:.1f}us'.format(t_book * 1e6))
+
+    # 环形缓冲：追加和取最近100笔的均价
+    buf = TickBuffer()
+    row = np.arange(len(TICK_FIELDS), dtype=float)
+    start = perf_counter()
+    for i in range(loops * 10):
+        row[0] = i
+        buf.append(row)
+    t_append = (perf_counter() - start) / (loops * 10)
+    start = perf_counter()
+    for _ in range(loops):
+        buf.vwap(100)
+    t_vwap = (perf_counter() - start) / loops
+    print(u'TickBuffer追加：{0:.2f}us，最近100笔均价：{1:.1f}us'.format(t_append * 1e6, t_vwap * 1e6))
+
+
+# 直接运行脚本可以进行性能测试
+if __name__ == '__main__':
+    benchmark(sys.argv[1])
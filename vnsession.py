@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+@version: v1.0
+@author: sunlei
+@license: Apache Licence
+@contact: 12166056@qq.com
+@site: http://blog.csdn.net/sunlei213
+@software: PyCharm Community Edition
+@file: vnsession.py
+@time: 2017/11/01 20:40
+
+交易时段日历和自适应轮询间隔。
+
+行情库、回报库原来按固定间隔读取，午休、开盘前也一样。
+AdaptivePoller在上一次读取有变化（或有未完成的委托）时用最短间隔，
+空闲时间隔按倍数增加到最长间隔；非交易时段使用更长的间隔，但不会越过下一个时段的开始时间。
+"""
+from datetime import datetime
+from threading import Event
+from time import time
+
+# 上交所交易时段（含9:15开始的集合竞价）
+SSE_SESSIONS = (('09:15:00', '11:30:00'), ('13:00:00', '15:00:00'))
+
+
+def _seconds(hms):
+    h, m, s = hms.split(':')
+    return int(h) * 3600 + int(m) * 60 + int(s)
+
+
+class TradingCalendar(object):
+    """
+    交易时段日历
+    sessions：当天的交易时段[(开始, 结束)]，时间格式'HH:MM:SS'
+    holidays：休市日期集合，格式'YYYYMMDD'；周六、周日总是休市
+    """
+
+    def __init__(self, sessions=SSE_SESSIONS, holidays=()):
+        self.sessions = tuple((_seconds(start), _seconds(end)) for start, end in sessions)
+        self.holidays = set(holidays)
+
+    def is_trading_day(self, now=None):
+        now = now or datetime.now()
+        return now.weekday() < 5 and now.strftime('%Y%m%d') not in self.holidays
+
+    def in_session(self, now=None):
+        """当前是否在交易时段内"""
+        now = now or datetime.now()
+        if not self.is_trading_day(now):
+            return False
+        sec = now.hour * 3600 + now.minute * 60 + now.second
+        return any(start <= sec < end for start, end in self.sessions)
+
+    def seconds_to_open(self, now=None):
+        """距离当天下一个交易时段开始的秒数，当天已无交易时段时返回None"""
+        now = now or datetime.now()
+        if not self.is_trading_day(now):
+            return None
+        sec = now.hour * 3600 + now.minute * 60 + now.second + now.microsecond / 1e6
+        starts = [start - sec for start, _ in self.sessions if start > sec]
+        return min(starts) if starts else None
+
+
+class AdaptivePoller(object):
+    """
+    自适应轮询间隔
+
+    busy（上一次读取有变化或有未完成的委托）时间隔回到fast；
+    否则每次乘以factor，最长为slow；
+    有日历且不在交易时段时间隔为closed，但不超过距下一个时段开始的时间。
+    wait可以被wake提前唤醒（如刚下单或退出时）；
+    不用wait等待时（如asyncio的repeat任务）设置waker，wake时调用waker唤醒等待方。
+    """
+
+    def __init__(self, fast=0.05, slow=2.0, factor=2.0, closed=5.0, calendar=None):
+        self.fast = fast
+        self.slow = slow
+        self.factor = factor
+        self.closed = closed
+        self.calendar = calendar
+        self.interval = fast  # 最近一次的间隔
+        self.waker = None  # 设置后wake时调用它，代替唤醒wait
+        self._wakeup = Event()
+
+    def next_interval(self, busy, now=None):
+        """根据本次读取的结果计算下次读取前的等待时间，非交易时段即使busy也按closed等待"""
+        calendar = self.calendar
+        if calendar is not None and not calendar.in_session(now):
+            interval = self.closed
+            to_open = calendar.seconds_to_open(now)
+            if to_open is not None:
+                interval = max(min(interval, to_open), self.fast)
+        elif busy:
+            interval = self.fast
+        else:
+            interval = min(self.interval * self.factor, self.slow)
+        self.interval = interval
+        return interval
+
+    def wait(self, busy):
+        """按本次读取的结果等待，被wake唤醒时提前返回"""
+        # 只在被唤醒时清除标志，等待超时后、下次等待前的wake不会丢失
+        if self._wakeup.wait(self.next_interval(busy)):
+            self._wakeup.clear()
+
+    def wake(self):
+        """间隔回到最短并唤醒等待"""
+        self.interval = self.fast
+        if self.waker is not None:
+            self.waker()
+        else:
+            self._wakeup.set()
+
+
+# ----------------------------------------------------------------------
+def test():
+    """测试空闲退避和交易时段"""
+    poller = AdaptivePoller(calendar=TradingCalendar())
+    day = datetime(2017, 11, 1)
+    for hms, busy in (('10:00:00', True), ('10:00:01', False), ('10:00:02', False),
+                      ('10:00:03', False), ('10:00:04', False), ('10:00:05', False),
+                      ('12:00:00', False), ('12:00:01', True), ('12:59:58', False),
+                      ('15:30:00', False)):
+        h, m, s = [int(x) for x in hms.split(':')]
+        now = day.replace(hour=h, minute=m, second=s)
+        print(u'{0} busy={1!s:<5} 间隔：{2:.2f}s'.format(hms, busy, poller.next_interval(busy, now)))
+
+    # 两次等待之间的wake不会丢失
+    poller = AdaptivePoller(fast=0.01, slow=1.0)
+    poller.wake()
+    start = time()
+    poller.wait(False)
+    print(u'等待前唤醒，等待：{0:.3f}s'.format(time() - start))
+
+
+# 直接运行脚本可以进行测试
+if __name__ == '__main__':
+    test()
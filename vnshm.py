@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+@version: v1.0
+@author: sunlei
+@license: Apache Licence
+@contact: 12166056@qq.com
+@site: http://blog.csdn.net/sunlei213
+@software: PyCharm Community Edition
+@file: vnshm.py
+@time: 2017/11/05 20:40
+
+共享内存行情表：行情进程解码一次行情库（mktdt00.txt或show2003.dbf），把行情写入
+multiprocessing.shared_memory中固定布局的表，其他进程的策略、界面直接读取，不必各自解析行情文件。
+
+布局（均按8字节对齐）：
+    头部     64字节：标识、容量、已用行数、头部序号、行情日期、行情时间、写入进程号、
+             写入进程的resource_tracker进程号
+    seq      每行一个序号（uint64），写入前后各加1，奇数表示正在写入
+    stamp    每行的更新时间（time()的秒数）
+    symbols  每行的证券代码（vtSymbol，如'511990.SH'），行号分配后不再改变
+    values   每行len(SHM_FIELDS)个float64，列顺序见SHM_FIELDS
+
+只有一个写入进程，写入进程还在运行时create()不会重建同名的表；读取方按seqlock读取：先读序号，再复制数据，再读一次序号，
+两次相同且为偶数说明数据完整，否则重读该行。读取不加锁，也不阻塞写入。
+x86的存储顺序保证序号和数据的写入先后不被打乱。
+"""
+import os
+import sys
+from time import perf_counter, sleep, time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from vnquote import QUOTE_FIELDS, BID_FIELDS, ASK_FIELDS, DEPTH
+
+# 默认的共享内存名称
+SHM_NAME = 'cats_quotes'
+
+# 每行的行情字段
+SHM_FIELDS = QUOTE_FIELDS + BID_FIELDS + ASK_FIELDS
+SHM_COLUMN = dict((name, i) for i, name in enumerate(SHM_FIELDS))
+
+_MAGIC = 0x51544143  # 'CATQ'
+_HEADER_SIZE = 64
+_HEADER_DTYPE = np.dtype([('magic', '<u4'), ('width', '<u4'), ('capacity', '<u4'), ('size', '<u4'),
+                          ('seq', '<u8'), ('date', 'S8'), ('time', 'S8'),
+                          ('pid', '<u4'), ('tracker', '<u4')])
+_SYMBOL_DTYPE = np.dtype('S16')
+_BID = np.array([SHM_COLUMN[name] for name in BID_FIELDS])
+_ASK = np.array([SHM_COLUMN[name] for name in ASK_FIELDS])
+
+
+def _table_size(capacity):
+    """容量为capacity行的表占用的字节数"""
+    return _HEADER_SIZE + capacity * (8 + 8 + _SYMBOL_DTYPE.itemsize + len(SHM_FIELDS) * 8)
+
+
+def _read_header(shm):
+    """复制一份头部，不保留对共享内存的引用；不是行情表时返回None"""
+    if shm.size < _HEADER_SIZE:
+        return None
+    header = np.frombuffer(bytes(shm.buf[:_HEADER_DTYPE.itemsize]), _HEADER_DTYPE)[0]
+    return header if header['magic'] == _MAGIC else None
+
+
+def _tracker_pid():
+    """本进程使用的resource_tracker的进程号，没有时为0"""
+    try:
+        from multiprocessing import resource_tracker
+        return resource_tracker._resource_tracker._pid or 0
+    except Exception:
+        return 0
+
+
+def _untrack(shm):
+    """
+    撤销打开已有共享内存时在resource_tracker中的登记，进程退出时不会删除写入方的表
+    与写入方共用resource_tracker（同一进程或fork出的子进程）时，这条登记就是写入方的，不能撤销
+    """
+    if os.name != 'posix':
+        return
+    header = _read_header(shm)
+    if header is not None and header['tracker'] and header['tracker'] == _tracker_pid():
+        return
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+
+
+def _writer_alive(shm):
+    """共享内存是否是写入进程还在运行的行情表"""
+    if os.name != 'posix':
+        # Windows下所有进程关闭后共享内存即被删除，还能打开说明有进程在使用
+        return True
+    header = _read_header(shm)
+    if header is None or not header['pid']:
+        return False
+    try:
+        os.kill(int(header['pid']), 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass  # 进程存在但属于其他用户
+    return True
+
+
+class SharedQuoteTable(object):
+    """
+    共享内存行情表
+
+    写入进程用create()创建，调用update()/update_snapshot()写入；
+    读取进程用attach()连接，调用get()/read()/get_price()读取。
+    """
+
+    def __init__(self, shm, owner, capacity=None):
+        self._shm = shm
+        self._owner = owner
+        buf = shm.buf
+        self._header = np.ndarray((1,), _HEADER_DTYPE, buffer=buf)
+        if owner:
+            self._header['magic'] = 0
+        elif self._header['magic'][0] != _MAGIC or self._header['width'][0] != len(SHM_FIELDS):
+            raise ValueError(u'共享内存{0}不是行情表或字段不一致'.format(shm.name))
+        if not owner:
+            capacity = int(self._header['capacity'][0])
+        self.capacity = capacity
+        offset = _HEADER_SIZE
+        self._seq = np.ndarray((capacity,), np.uint64, buffer=buf, offset=offset)
+        offset += capacity * 8
+        self._stamp = np.ndarray((capacity,), np.float64, buffer=buf, offset=offset)
+        offset += capacity * 8
+        self._symbols = np.ndarray((capacity,), _SYMBOL_DTYPE, buffer=buf, offset=offset)
+        offset += capacity * _SYMBOL_DTYPE.itemsize
+        self._values = np.ndarray((capacity, len(SHM_FIELDS)), np.float64, buffer=buf, offset=offset)
+        self._index = {}  # 证券代码 -> 行号
+        self._known = 0  # 已加入_index的行数
+        self._rows = {}  # 证券代码组 -> (建立时的行数, 行号数组, 是否都存在)
+        self._snap_codes = None  # 上次写入的快照的证券代码
+        self._snap_symbols = None
+        if owner:
+            self._seq[:] = 0
+            self._values[:] = 0
+            self._symbols[:] = b''
+            self._header['width'] = len(SHM_FIELDS)
+            self._header['capacity'] = capacity
+            self._header['size'] = 0
+            self._header['seq'] = 0
+            self._header['pid'] = os.getpid()
+            self._header['tracker'] = _tracker_pid()
+            # 最后写入标识，读取方看到标识时其余头部字段已经写好
+            self._header['magic'] = _MAGIC
+
+    @classmethod
+    def create(cls, name=SHM_NAME, capacity=16384):
+        """创建行情表（写入进程）；同名的表的写入进程还在运行时报错，已退出时删除旧表"""
+        try:
+            old = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            pass
+        else:
+            if _writer_alive(old):
+                _untrack(old)
+                old.close()
+                raise ValueError(u'共享内存{0}正在被其他写入进程使用'.format(name))
+            old.close()
+            old.unlink()
+        shm = shared_memory.SharedMemory(name=name, create=True, size=_table_size(capacity))
+        return cls(shm, True, capacity)
+
+    @classmethod
+    def attach(cls, name=SHM_NAME):
+        """连接已有的行情表（读取进程）"""
+        # 读取进程退出时resource_tracker会删除它登记的共享内存，读取方不应登记
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)  # Python 3.13起
+        except TypeError:
+            shm = shared_memory.SharedMemory(name=name)
+            _untrack(shm)
+        return cls(shm, False)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def __len__(self):
+        return int(self._header['size'][0])
+
+    def __contains__(self, symbol):
+        self._refresh()
+        return symbol in self._index
+
+    def close(self):
+        """断开共享内存，写入进程同时删除共享内存"""
+        if self._shm is None:
+            return
+        # 先释放对共享内存的引用，否则close时报BufferError
+        self._header = self._seq = self._stamp = self._symbols = self._values = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+        self._shm = None
+
+    # ----------------------------------------------------------------------
+    # 写入
+    def _assign(self, symbols):
+        """证券代码组对应的行号，新的代码分配新行"""
+        index = self._index
+        size = start = len(self)
+        rows = np.empty(len(symbols), dtype=np.int64)
+        for i, symbol in enumerate(symbols):
+            row = index.get(symbol)
+            if row is None:
+                if size >= self.capacity:
+                    raise ValueError(u'共享行情表已满：{0}行'.format(self.capacity))
+                row = index[symbol] = size
+                self._symbols[row] = symbol.encode('ascii')
+                size += 1
+            rows[i] = row
+        if size != start:
+            # 代码写好后再增加行数，读取方看到的新行总是有代码的
+            self._header['size'] = size
+            self._known = size
+        return rows
+
+    def set_time(self, date, time_):
+        """更新行情日期和时间（YYYYMMDD、HHMMSS或HH:MM:SS）"""
+        header = self._header
+        header['seq'] += 1
+        header['date'] = date.encode('ascii')
+        header['time'] = time_.encode('ascii')
+        header['seq'] += 1
+
+    def update(self, symbols, values, stamp=None):
+        """
+        写入一组证券的行情
+        symbols：证券代码列表，values：形状为(证券数, len(SHM_FIELDS))的数组
+        只写入数值发生变化的行，返回写入的行数
+        """
+        if not len(symbols):
+            return 0
+        rows = self._assign(symbols)
+        values = np.asarray(values, dtype=np.float64)
+        changed = (self._values[rows] != values).any(axis=1)
+        if not changed.all():
+            rows = rows[changed]
+            values = values[changed]
+        if not len(rows):
+            return 0
+        seq = self._seq
+        seq[rows] += 1  # 奇数：正在写入
+        self._values[rows] = values
+        self._stamp[rows] = time() if stamp is None else stamp
+        seq[rows] += 1
+        return len(rows)
+
+    def update_snapshot(self, snap, exchange='SH', stamp=None):
+        """写入一次mktdt00.txt快照（vnmkt.MktSnapshot），返回写入的行数"""
+        if not len(snap):
+            return 0
+        if self._snap_codes is not None and np.array_equal(self._snap_codes, snap.codes):
+            # 证券列表未变（通常情况），沿用代码列表
+            symbols = self._snap_symbols
+        else:
+            suffix = '.' + exchange
+            symbols = [code + suffix for code in snap.codes.tolist()]
+            self._snap_codes = snap.codes
+            self._snap_symbols = symbols
+        values = np.column_stack([snap[name] for name in SHM_FIELDS])
+        self.set_time(snap.date, snap.time)
+        return self.update(symbols, values, stamp)
+
+    # ----------------------------------------------------------------------
+    # 读取
+    def _refresh(self):
+        """把写入进程新分配的行加入索引"""
+        size = len(self)
+        if size > self._known:
+            for row, symbol in enumerate(self._symbols[self._known:size].tolist(), self._known):
+                self._index[symbol.decode('ascii')] = row
+            self._known = size
+
+    def rows(self, symbols):
+        """证券代码组对应的行号数组，不存在的代码为-1"""
+        symbols = tuple(symbols)
+        cached = self._rows.get(symbols)
+        # 有不存在的代码时，写入进程增加了新行才需要重新查找
+        if cached is not None and (cached[2] or cached[0] == len(self)):
+            return cached[1]
+        self._refresh()
+        index = self._index
+        rows = np.array([index.get(symbol, -1) for symbol in symbols], dtype=np.int64)
+        self._rows[symbols] = (self._known, rows, bool((rows >= 0).all()))
+        return rows
+
+    def quote_time(self):
+        """行情日期和时间，返回(date, time)"""
+        header = self._header
+        while True:
+            seq = header['seq'][0]
+            date = header['date'][0]
+            time_ = header['time'][0]
+            if not seq & 1 and header['seq'][0] == seq:
+                return date.decode('ascii'), time_.decode('ascii')
+            sleep(0)
+
+    def read(self, symbols):
+        """
+        读取一组证券的行情，每行都是完整的一次写入
+        返回(values, versions, stamps)：values形状为(证券数, len(SHM_FIELDS))，
+        versions为各行的写入次数，不存在的证券对应的行全部为0、版本为-1
+        """
+        rows = self.rows(symbols)
+        found = rows >= 0
+        r = rows[found] if not found.all() else rows
+        seq = self._seq
+        first = seq[r]
+        values = self._values[r]
+        stamps = self._stamp[r]
+        bad = np.flatnonzero((first != seq[r]) | (first & 1).astype(bool))
+        while len(bad):
+            # 读取时正好在写入的行重新读取
+            sleep(0)
+            rb = r[bad]
+            s1 = seq[rb]
+            values[bad] = self._values[rb]
+            stamps[bad] = self._stamp[rb]
+            ok = (s1 == seq[rb]) & ~(s1 & 1).astype(bool)
+            first[bad] = s1
+            bad = bad[~ok]
+        versions = (first // 2).astype(np.int64)
+        if r is not rows:
+            out = np.zeros((len(rows), len(SHM_FIELDS)))
+            out[found] = values
+            ver = np.full(len(rows), -1, dtype=np.int64)
+            ver[found] = versions
+            st = np.zeros(len(rows))
+            st[found] = stamps
+            return out, ver, st
+        return values, versions, stamps
+
+    def get(self, symbol):
+        """单只证券的行情字典（含version、stamp），不存在时返回None"""
+        values, versions, stamps = self.read((symbol,))
+        if versions[0] < 0:
+            return None
+        quote = dict(zip(SHM_FIELDS, values[0].tolist()))
+        quote['version'] = int(versions[0])
+        quote['stamp'] = float(stamps[0])
+        return quote
+
+    def get_price(self, symbols, depth=DEPTH):
+        """与vnquote.QuoteBook.get_price相同，返回(买盘, 卖盘)"""
+        values = self.read(symbols)[0]
+        width = depth * 2
+        return values[:, _BID[:width]], values[:, _ASK[:width]]
+
+    def field(self, name, symbols):
+        """一组证券的单个字段（见SHM_FIELDS）"""
+        return self.read(symbols)[0][:, SHM_COLUMN[name]]
+
+    def versions(self, symbols):
+        """各行的写入次数（不复制行情），读取方可以据此只处理有变化的证券"""
+        rows = self.rows(symbols)
+        versions = (self._seq[np.maximum(rows, 0)] // 2).astype(np.int64)
+        versions[rows < 0] = -1
+        return versions
+
+
+# ----------------------------------------------------------------------
+def feed(path, name=SHM_NAME, exchange='SH', capacity=16384):
+    """行情进程：mktdt00.txt每次更新后解析一次，写入共享内存行情表，Ctrl+C结束"""
+    from vnmkt import MktParser, MktWatcher
+
+    parser = MktParser()
+    watcher = MktWatcher(path)
+    table = SharedQuoteTable.create(name, capacity)
+    print(u'共享行情表：{0}，容量{1}行'.format(table.name, table.capacity))
+    try:
+        while True:
+            if not watcher.wait(1.0):
+                continue
+            start = perf_counter()
+            try:
+                snap = parser.read(path)
+            except IOError as e:
+                print(e)
+                continue
+            if not len(snap):
+                # 文件正在改写，稍后重试
+                continue
+            watcher.mark_done()
+            count = table.update_snapshot(snap, exchange)
+            print(u'{0} 更新{1}行，耗时{2:.1f}ms'.format(snap.time, count, (perf_counter() - start) * 1000))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+        table.close()
+
+
+def _reader(name, symbols, loops, result):
+    """test()中的读取进程：检查每次读到的行是否一致（同一行各列的值相同）"""
+    table = SharedQuoteTable.attach(name)
+    torn = 0
+    reads = 0
+    start = perf_counter()
+    for _ in range(loops):
+        values, versions, _ = table.read(symbols)
+        torn += int((values != values[:, :1]).any(axis=1).sum())
+        reads += 1
+    result.put((reads, torn, (perf_counter() - start) / loops))
+    table.close()
+
+
+def test(loops=2000):
+    """一个进程不断写入，另一个进程同时读取，检查读到的数据是否完整"""
+    from multiprocessing import Process, Queue
+
+    name = 'cats_quotes_test'
+    symbols = ['{0:06d}.SH'.format(i) for i in range(2000)]
+    table = SharedQuoteTable.create(name, 4096)
+    table.update(symbols, np.zeros((len(symbols), len(SHM_FIELDS))))
+    result = Queue()
+    reader = Process(target=_reader, args=(name, symbols[:100], loops, result))
+    reader.start()
+    start = perf_counter()
+    writes = 0
+    while reader.is_alive() and result.empty():
+        # 每行所有列写同一个值，读到不同的值说明读到了写了一半的行
+        writes += 1
+        table.update(symbols, np.full((len(symbols), len(SHM_FIELDS)), float(writes)))
+    cost = (perf_counter() - start) / max(writes, 1)
+    reads, torn, read_cost = result.get()
+    reader.join()
+    print(u'写入{0}次，每次{1}只，耗时{2:.1f}us'.format(writes, len(symbols), cost * 1e6))
+    print(u'读取{0}次，每次100只，耗时{1:.1f}us，不完整的行：{2}'.format(reads, read_cost * 1e6, torn))
+    print(table.get(symbols[0]))
+    table.close()
+
+
+# 直接运行脚本可以进行测试：python vnshm.py [feed mktdt00.txt]
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == 'feed':
+        feed(sys.argv[2])
+    else:
+        test()
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+@version: v1.0
+@author: sunlei
+@license: Apache Licence
+@contact: 12166056@qq.com
+@site: http://blog.csdn.net/sunlei213
+@software: PyCharm Community Edition
+@file: vnstat.py
+@time: 2017/10/29 20:05
+
+延迟统计：对数分桶的延迟直方图，事件引擎的处理耗时统计，以及委托从下单到回报的延迟台账。
+"""
+import json
+import math
+from threading import Lock
+from time import perf_counter
+
+# 直方图范围：1微秒到约100秒，每个2倍区间分8个桶（相对误差约9%）
+_MIN_VALUE = 1e-6
+_SUB_BUCKETS = 8
+_BUCKETS = 27 * _SUB_BUCKETS
+_LOG_STEP = math.log(2) / _SUB_BUCKETS
+
+
+class LatencyHistogram(object):
+    """
+    延迟直方图（单位秒）
+
+    按对数分桶计数，内存固定，记录一次只是一次加法；
+    百分位数取所在桶的上界。
+    """
+
+    def __init__(self):
+        self.counts = [0] * (_BUCKETS + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        """记录一个耗时（秒）"""
+        if value <= _MIN_VALUE:
+            index = 0
+        else:
+            index = min(int(math.log(value / _MIN_VALUE) / _LOG_STEP) + 1, _BUCKETS)
+        self.counts[index] += 1
+        if not self.count or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.count += 1
+        self.total += value
+
+    def merge(self, other):
+        """合并另一个直方图"""
+        if not other.count:
+            return
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.min = other.min if not self.count else min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.count += other.count
+        self.total += other.total
+
+    def percentile(self, p):
+        """第p百分位数（p取0～100）"""
+        if not self.count:
+            return 0.0
+        rank = max(int(math.ceil(self.count * p / 100.0)), 1)
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                upper = _MIN_VALUE * math.exp(index * _LOG_STEP)
+                return min(upper, self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def summary(self):
+        """统计摘要：次数、平均、p50、p99、最大值（毫秒）"""
+        return {'count': self.count,
+                'mean': self.mean * 1000,
+                'p50': self.percentile(50) * 1000,
+                'p99': self.percentile(99) * 1000,
+                'max': self.max * 1000}
+
+
+def handler_name(handler):
+    """处理函数的名称，绑定方法带上类名"""
+    owner = getattr(handler, '__self__', None)
+    name = getattr(handler, '__name__', repr(handler))
+    if owner is not None:
+        return '{0}.{1}'.format(type(owner).__name__, name)
+    return name
+
+
+class EventProfiler(object):
+    """
+    事件引擎耗时统计
+
+    wait：事件从存入队列到开始处理的等待时间（按事件类型）
+    handler：每个处理函数的执行时间（按事件类型和处理函数）
+    工作线程池中的处理函数也会调用call，因此记录时加锁
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.wait = {}  # 事件类型 -> LatencyHistogram
+        self.handler = {}  # (事件类型, 处理函数名) -> LatencyHistogram
+        self.depth = 0  # 最近一次取事件时的队列积压数
+        self.max_depth = 0
+
+    def on_get(self, event, depth):
+        """事件开始处理时调用，记录排队时间和队列积压"""
+        put_time = getattr(event, 'putTime', None)
+        if put_time is not None:
+            cost = perf_counter() - put_time
+            with self._lock:
+                hist = self.wait.get(event.type_)
+                if hist is None:
+                    hist = self.wait[event.type_] = LatencyHistogram()
+                hist.record(cost)
+        self.depth = depth
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def call(self, type_, handler, event):
+        """调用处理函数并记录执行时间"""
+        start = perf_counter()
+        try:
+            handler(event)
+        finally:
+            cost = perf_counter() - start
+            key = (type_, handler_name(handler))
+            with self._lock:
+                hist = self.handler.get(key)
+                if hist is None:
+                    hist = self.handler[key] = LatencyHistogram()
+                hist.record(cost)
+
+    def stats(self):
+        """统计结果（耗时单位为毫秒）"""
+        with self._lock:
+            return {'wait': dict((type_, hist.summary()) for type_, hist in self.wait.items()),
+                    'handler': dict(('{0} {1}'.format(type_, name), hist.summary())
+                                    for (type_, name), hist in self.handler.items()),
+                    'depth': self.depth,
+                    'max_depth': self.max_depth}
+
+    def report(self):
+        """按处理函数p99耗时从大到小排列的文字报告"""
+        stats = self.stats()
+        lines = [u'{0:<48}{1:>8}{2:>10}{3:>10}{4:>10}'.format(u'处理函数', u'次数', 'p50(ms)',
+                                                            'p99(ms)', 'max(ms)')]
+        for name, s in sorted(stats['handler'].items(), key=lambda x: -x[1]['p99']):
+            lines.append(u'{0:<48}{1:>8}{2:>10.3f}{3:>10.3f}{4:>10.3f}'.format(
+                name, s['count'], s['p50'], s['p99'], s['max']))
+        lines.append(u'{0:<48}{1:>8}{2:>10}{3:>10}{4:>10}'.format(u'排队等待', u'次数', 'p50(ms)',
+                                                             'p99(ms)', 'max(ms)'))
+        for name, s in sorted(stats['wait'].items(), key=lambda x: -x[1]['p99']):
+            lines.append(u'{0:<48}{1:>8}{2:>10.3f}{3:>10.3f}{4:>10.3f}'.format(
+                name, s['count'], s['p50'], s['p99'], s['max']))
+        lines.append(u'队列最大积压：{0}'.format(stats['max_depth']))
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        """把统计结果写入json文件"""
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.stats(), f, ensure_ascii=False, indent=2, sort_keys=True)
+
+
+# 委托延迟的统计项
+LAT_ACK = 'ack'  # 下单 -> 回报库出现申报编号
+LAT_FIRST_FILL = 'first_fill'  # 申报编号 -> 首笔成交
+LAT_FULL_FILL = 'full_fill'  # 下单 -> 全部成交
+LAT_CANCEL = 'cancel'  # 撤单 -> 撤单确认
+LAT_STAGES = (LAT_ACK, LAT_FIRST_FILL, LAT_FULL_FILL, LAT_CANCEL)
+
+
+class _OrderTimes(object):
+    """一笔委托各阶段的时间"""
+
+    __slots__ = ('acct', 'symbol', 'qty', 'submit', 'ack', 'first_fill', 'full_fill',
+                 'cancel_submit', 'cancel')
+
+    def __init__(self, acct, symbol, qty, submit):
+        self.acct = acct
+        self.symbol = symbol
+        self.qty = qty
+        self.submit = submit
+        self.ack = None
+        self.first_fill = None
+        self.full_fill = None
+        self.cancel_submit = None
+        self.cancel = None
+
+
+class OrderLatencyLedger(object):
+    """
+    委托延迟台账
+
+    按client_id记录下单、确认（回报中出现申报编号）、首笔成交、全部成交、
+    撤单确认的时间，各阶段耗时按账户和证券代码分别计入直方图。
+    只统计本次运行中下的委托，启动时从回报库恢复的委托不计入。
+    """
+
+    def __init__(self, clock=perf_counter):
+        self._clock = clock
+        self._lock = Lock()
+        self._orders = {}  # client_id -> _OrderTimes
+        self._by_acct = {}  # (统计项, 账户) -> LatencyHistogram
+        self._by_symbol = {}  # (统计项, 证券代码) -> LatencyHistogram
+        self._total = dict((stage, LatencyHistogram()) for stage in LAT_STAGES)
+
+    def _record(self, stage, order, cost):
+        self._total[stage].record(cost)
+        for index, key in ((self._by_acct, order.acct), (self._by_symbol, order.symbol)):
+            hist = index.get((stage, key))
+            if hist is None:
+                hist = index[(stage, key)] = LatencyHistogram()
+            hist.record(cost)
+
+    def submit(self, client_id, acct, symbol, qty):
+        """下单时调用"""
+        with self._lock:
+            self._orders[client_id] = _OrderTimes(acct, symbol, qty, self._clock())
+
+    def ack(self, client_id):
+        """回报中第一次出现申报编号时调用，重复调用忽略"""
+        with self._lock:
+            order = self._orders.get(client_id)
+            if order is None or order.ack is not None:
+                return
+            order.ack = self._clock()
+            self._record(LAT_ACK, order, order.ack - order.submit)
+
+    def fill(self, client_id, filled_qty):
+        """收到成交回报时调用，filled_qty为累计成交数量"""
+        with self._lock:
+            order = self._orders.get(client_id)
+            if order is None or filled_qty <= 0:
+                return
+            now = self._clock()
+            if order.first_fill is None:
+                order.first_fill = now
+                start = order.ack if order.ack is not None else order.submit
+                self._record(LAT_FIRST_FILL, order, now - start)
+            if order.full_fill is None and filled_qty >= order.qty:
+                order.full_fill = now
+                self._record(LAT_FULL_FILL, order, now - order.submit)
+
+    def cancel_submit(self, client_id):
+        """对委托client_id发出撤单时调用"""
+        with self._lock:
+            order = self._orders.get(client_id)
+            if order is not None and order.cancel_submit is None:
+                order.cancel_submit = self._clock()
+
+    def cancel(self, client_id):
+        """委托client_id撤单确认时调用"""
+        with self._lock:
+            order = self._orders.get(client_id)
+            if order is None or order.cancel_submit is None or order.cancel is not None:
+                return
+            order.cancel = self._clock()
+            self._record(LAT_CANCEL, order, order.cancel - order.cancel_submit)
+
+    def times(self, client_id):
+        """委托各阶段的时间（秒，相对下单时间），未发生的阶段为None"""
+        with self._lock:
+            order = self._orders.get(client_id)
+            if order is None:
+                return None
+            return dict((name, None if getattr(order, name) is None
+                         else getattr(order, name) - order.submit)
+                        for name in ('ack', 'first_fill', 'full_fill', 'cancel_submit', 'cancel'))
+
+    def stats(self, by=None):
+        """
+        统计结果（毫秒）
+        by为None时返回{统计项: 摘要}，为'acct'或'symbol'时返回{统计项: {账户或代码: 摘要}}
+        """
+        with self._lock:
+            if by is None:
+                return dict((stage, hist.summary()) for stage, hist in self._total.items())
+            index = {'acct': self._by_acct, 'symbol': self._by_symbol}[by]
+            result = dict((stage, {}) for stage in LAT_STAGES)
+            for (stage, key), hist in index.items():
+                result[stage][key] = hist.summary()
+            return result
+
+    def report(self, by='acct'):
+        """文字报告：总体以及按账户（或证券代码）分组的各阶段延迟"""
+        total = self.stats()
+        groups = self.stats(by)
+        lines = [u'{0:<12}{1:<16}{2:>8}{3:>10}{4:>10}{5:>10}'.format(
+            u'统计项', u'分组', u'次数', 'p50(ms)', 'p99(ms)', 'max(ms)')]
+        for stage in LAT_STAGES:
+            rows = [(u'全部', total[stage])] + sorted(groups[stage].items())
+            for name, s in rows:
+                if not s['count']:
+                    continue
+                lines.append(u'{0:<12}{1:<16}{2:>8}{3:>10.1f}{4:>10.1f}{5:>10.1f}'.format(
+                    stage, name, s['count'], s['p50'], s['p99'], s['max']))
+        return '\n'.join(lines)
+
+
+# ----------------------------------------------------------------------
+def test():
+    """测试直方图的百分位数"""
+    import random
+    hist = LatencyHistogram()
+    values = [random.expovariate(1000) for _ in range(100000)]
+    start = perf_counter()
+    for value in values:
+        hist.record(value)
+    cost = perf_counter() - start
+    values.sort()
+    print(u'记录{0}次耗时：{1:.1f}ms'.format(len(values), cost * 1000))
+    print(u'p50：{0:.3f}ms，实际{1:.3f}ms'.format(hist.percentile(50) * 1000, values[50000] * 1000))
+    print(u'p99：{0:.3f}ms，实际{1:.3f}ms'.format(hist.percentile(99) * 1000, values[99000] * 1000))
+    print(hist.summary())
+
+
+# 直接运行脚本可以进行测试
+if __name__ == '__main__':
+    test()
@@ -10,14 +10,23 @@
 @software: PyCharm Community Edition 
 @file: vtobject.py 
 @time: 2017/10/2 11:24 
+
+行情、委托、持仓等数量多、创建频繁的数据类使用__slots__，不为每个实例分配__dict__。
+推送给其他线程的委托和账户使用只读快照（OrderSnapshot、AccountSnapshot），内容未变化时沿用同一个快照。
 """
+from collections import namedtuple
+from operator import attrgetter
 from time import strftime, localtime
+from types import MappingProxyType
 from constant import *
 
 
 class VtBaseData(object):
     """回调函数推送数据的基础类，其他数据类继承于此"""
 
+    # 没有定义__slots__的子类仍然带有__dict__
+    __slots__ = ('gatewayName', 'rawData')
+
     # ----------------------------------------------------------------------
     def __init__(self):
         """Constructor"""
@@ -28,6 +37,14 @@ class VtBaseData(object):
 class VtTickData(VtBaseData):
     """Tick行情数据类"""
 
+    __slots__ = ('symbol', 'exchange', 'vtSymbol',
+                 'lastPrice', 'lastVolume', 'volume', 'openInterest', 'time', 'date', 'datetime',
+                 'openPrice', 'highPrice', 'lowPrice', 'preClosePrice', 'upperLimit', 'lowerLimit',
+                 'sellPrice1', 'sellPrice2', 'sellPrice3', 'sellPrice4', 'sellPrice5',
+                 'buyPrice1', 'buyPrice2', 'buyPrice3', 'buyPrice4', 'buyPrice5',
+                 'sellVolume1', 'sellVolume2', 'sellVolume3', 'sellVolume4', 'sellVolume5',
+                 'buyVolume1', 'buyVolume2', 'buyVolume3', 'buyVolume4', 'buyVolume5')
+
     # ----------------------------------------------------------------------
     def __init__(self):
         """Constructor"""
@@ -81,6 +98,19 @@ class VtTickData(VtBaseData):
         self.buyVolume4 = EMPTY_INT
         self.buyVolume5 = EMPTY_INT
 
+    @classmethod
+    def from_data(cls, data):
+        """由行情字典生成tick，只给set_data不设置的字段赋默认值"""
+        tick = cls.__new__(cls)
+        tick.gatewayName = EMPTY_STRING
+        tick.rawData = None
+        tick.lastVolume = EMPTY_INT
+        tick.openInterest = EMPTY_INT
+        tick.upperLimit = EMPTY_FLOAT
+        tick.lowerLimit = EMPTY_FLOAT
+        tick.set_data(data)
+        return tick
+
     def set_data(self, data):
         self.symbol = data['symbol']
         self.exchange = data['exchange']
@@ -453,10 +483,9 @@ class Portfolio(object):
             self.positions_value += self.long_positions[key].value
 
     def update_account(self, zh):
-        """更新账户信息"""
-        self.available_cash = zh['acct']['zjky']
-        for stock in zh['stocks'].keys():
-            rec = zh['stocks'][stock]
+        """更新账户信息，zh为AccountSnapshot"""
+        self.available_cash = zh.acct['zjky']
+        for stock, rec in zh.stocks.items():
             if stock in self.long_positions:
                 self.long_positions[stock].update(rec)
             else:
@@ -496,6 +525,9 @@ class Portfolio(object):
 class Positions(object):
     """仓位的对象类"""
 
+    __slots__ = ('security', 'name', 'price', 'avg_cost', 'hold_cost', 'init_time', 'transact_time',
+                 'total_amount', 'closeable_amount', 'today_amount', 'locked_amount', 'value', 'is_t0')
+
     def __init__(self, stock, name='', vol=0, avg_px=0.00):
         self.security = stock            # 标的代码
         self.name = name
@@ -592,8 +624,60 @@ class Positions(object):
         return data
 
 
-class Order_rec:
+_ORDER_FIELDS = ('inst_type', 'client_id', 'acct_type', 'acct', 'ord_no', 'symbol', 'tradeside',
+                 'ord_qty', 'ord_price', '_filled_qty', '_avg_px', 'ord_type', 'ord_time',
+                 'can_cancel', 'name', 'cj_je', 'cj_vol', 'is_t0')
+
+
+class OrderSnapshot(namedtuple('OrderSnapshot', [name.lstrip('_') for name in _ORDER_FIELDS] +
+                               ['version'])):
+    """
+    委托的只读快照，字段与Order_rec相同
+    version为快照的版本号，委托每次修改后生成的新快照版本号加1
+    需要改动字段时用_replace生成新的快照
+    """
+
+    __slots__ = ()
+
+    @property
+    def je(self):
+        if self.tradeside == '1' and self.can_cancel and self.cj_je >= 0:
+            return 0
+        else:
+            return self.cj_je * self.cj_vol
+
+    @property
+    def vtOrderID(self):
+        return str(self.client_id)
+
+    def ord(self):
+        return (self.inst_type, self.client_id, self.acct_type, self.acct, self.ord_no, self.symbol,
+                self.tradeside, self.ord_qty, self.ord_price, self.ord_type)
+
+    def __str__(self):
+        return 'client_id={0}, acct={1}, ord_no={2}, symbol={3}, tradeside={4},' \
+               'ord_qty={5}, ord_price={6}, filled_qty={7}, avg_px={8}, je={9}, ' \
+               'can_cancel={10}'.format(self.client_id, self.acct, self.ord_no, self.symbol,
+                                        self.tradeside, self.ord_qty, self.ord_price, self.filled_qty,
+                                        self.avg_px, self.je, self.can_cancel)
+
+
+class Order_rec(object):
+    """
+    委托记录
+
+    snapshot返回只读快照并缓存，任何字段被修改后缓存失效，下次生成新版本的快照；
+    委托没有变化时重复推送不需要复制。
+    """
+
+    __slots__ = _ORDER_FIELDS + ('_version', '_snap')
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        object.__setattr__(self, '_snap', None)
+
     def __init__(self):
+        object.__setattr__(self, '_version', 0)
         self.inst_type = ''
         self.client_id = 0
         self.acct_type = ''
@@ -632,6 +716,21 @@ class Order_rec:
     def vtOrderID(self):
         return str(self.client_id)
 
+    @property
+    def version(self):
+        """最近一次快照的版本号"""
+        return getattr(self, '_version', 0)
+
+    def snapshot(self):
+        """只读快照，推送给界面等其他线程使用；委托没有修改时返回同一个快照"""
+        snap = getattr(self, '_snap', None)
+        if snap is None:
+            version = self.version + 1
+            snap = OrderSnapshot._make(_order_values(self) + (version,))
+            object.__setattr__(self, '_version', version)
+            object.__setattr__(self, '_snap', snap)
+        return snap
+
     def ord(self):
         return (self.inst_type, self.client_id, self.acct_type, self.acct, self.ord_no, self.symbol,
                 self.tradeside, self.ord_qty, self.ord_price, self.ord_type)
@@ -656,3 +755,127 @@ class Order_rec:
                'can_cancel={10}'.format(self.client_id, self.acct, self.ord_no, self.symbol,
                                         self.tradeside, self.ord_qty, self.ord_price, self._filled_qty,
                                         self._avg_px, self.je, self.can_cancel)
+
+
+_order_values = attrgetter(*_ORDER_FIELDS)
+
+
+class AccountSnapshot(namedtuple('AccountSnapshot', ['account', 'version', 'acct', 'stocks'])):
+    """
+    账户的只读快照
+    acct：资金（只读字典，zjky、zzc）
+    stocks：证券代码 -> 持仓元组(数量, 成本, 名称, 市值)的只读字典
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def build(cls, account, zh, last=None):
+        """
+        由TdApi的账户字典{'acct': {...}, 'stocks': {代码: [...]}}生成快照
+        last为该账户上一个快照：内容相同时直接返回last，未变化的持仓元组沿用last中的
+        """
+        old = last.stocks if last is not None else {}
+        stocks = {}
+        for code, pos in list(zh['stocks'].items()):
+            pos = tuple(pos)
+            prev = old.get(code)
+            stocks[code] = prev if prev == pos else pos
+        acct = dict(zh['acct'])
+        if last is not None and last.acct == acct and last.stocks == stocks:
+            return last
+        version = last.version + 1 if last is not None else 1
+        return cls(account, version, MappingProxyType(acct), MappingProxyType(stocks))
+
+
+# ----------------------------------------------------------------------
+def benchmark(symbols=1500, snapshots=100):
+    """
+    全市场行情的内存和分配测试
+    symbols只合约、snapshots次快照（全天约4800次，按比例估算）；
+    对比__slots__的VtTickData和带__dict__的同样字段的对象，以及Order_rec的deepcopy和snapshot
+    """
+    import copy
+    import tracemalloc
+    from datetime import datetime
+    from time import perf_counter
+
+    defaults = dict.fromkeys(VtBaseData.__slots__ + VtTickData.__slots__)
+
+    class DictTick(object):
+        """带__dict__、字段相同的对照类（原来的VtTickData）"""
+        set_data = VtTickData.set_data
+
+        def __init__(self):
+            self.__dict__.update(defaults)
+
+        @classmethod
+        def from_data(cls, data):
+            tick = cls()
+            tick.set_data(data)
+            return tick
+
+    data = {'symbol': '600000', 'exchange': 'SH', 'vtSymbol': '600000.SH', 'lastPrice': 10.0,
+            'volume': 1000, 'UpdateTime': '10:00:00', 'TradingDay': '20171101',
+            'datetime': datetime.now(), 'openPrice': 10.0, 'highPrice': 10.0, 'lowPrice': 10.0,
+            'preClosePrice': 10.0}
+    for i in range(1, 6):
+        for side in ('buy', 'sell'):
+            data['{0}Price{1}'.format(side, i)] = 10.0
+            data['{0}Volume{1}'.format(side, i)] = 100
+
+    for cls in (DictTick, VtTickData):
+        # 常驻内存：每只合约保留最新的一个tick
+        tracemalloc.start()
+        latest = {}
+        for i in range(symbols):
+            latest[i] = cls.from_data(data)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        # 分配速度：每次快照每只合约一个新tick
+        start = perf_counter()
+        for _ in range(snapshots):
+            for i in range(symbols):
+                latest[i] = cls.from_data(data)
+        cost = perf_counter() - start
+        print(u'{0}：{1}只合约常驻{2:.0f}KB（每个{3:.0f}字节），每次快照{4:.2f}ms，全天估算{5:.1f}s'.format(
+            cls.__name__, symbols, size / 1024.0, float(size) / symbols,
+            cost / snapshots * 1000, cost / snapshots * 4800))
+
+    rec = Order_rec()
+    loops = 10000
+    start = perf_counter()
+    for _ in range(loops):
+        copy.deepcopy(rec)
+    t_deep = (perf_counter() - start) / loops
+    start = perf_counter()
+    for i in range(loops):
+        rec.cj_vol = i
+        rec.snapshot()
+    t_snap = (perf_counter() - start) / loops
+    start = perf_counter()
+    for _ in range(loops):
+        rec.snapshot()
+    t_same = (perf_counter() - start) / loops
+    print(u'Order_rec复制：deepcopy {0:.1f}us，修改后snapshot {1:.1f}us，未修改snapshot {2:.2f}us'.format(
+        t_deep * 1e6, t_snap * 1e6, t_same * 1e6))
+
+    zh = {'acct': {'zjky': 1000000.0, 'zzc': 2000000.0},
+          'stocks': dict(('{0:06d}'.format(i), [1000, 10.0, u'名称', 10000.0]) for i in range(200))}
+    start = perf_counter()
+    for _ in range(1000):
+        copy.deepcopy(zh['acct'])
+        copy.deepcopy(zh['stocks'])
+    t_deep = (perf_counter() - start) / 1000
+    last = None
+    start = perf_counter()
+    for _ in range(1000):
+        last = AccountSnapshot.build('A', zh, last)
+    t_snap = (perf_counter() - start) / 1000
+    print(u'200只持仓的账户：deepcopy {0:.1f}us，快照 {1:.1f}us（版本{2}）'.format(
+        t_deep * 1e6, t_snap * 1e6, last.version))
+
+
+# 直接运行脚本可以进行性能测试
+if __name__ == '__main__':
+    benchmark()